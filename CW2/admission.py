@@ -0,0 +1,157 @@
+import math
+import threading
+import time
+from functools import wraps
+from flask import abort, g, request
+from werkzeug.exceptions import HTTPException
+from connexion.resolver import Resolver, Resolution
+from config import app
+from authentication import authenticate_user
+from profiling import profiled
+import metrics
+
+# Idle buckets are dropped once there are more than this many
+MAX_BUCKETS = 10000
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        # Returns 0 if a token was taken, otherwise the seconds until one is available
+        self.refill(time.monotonic())
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+def prune_buckets(now):
+    for key, bucket in list(_buckets.items()):
+        bucket.refill(now)
+        if bucket.tokens >= bucket.burst:
+            del _buckets[key]
+
+def check_rate(bucket_name, identity, rate, burst):
+    key = (bucket_name, identity)
+    with _buckets_lock:
+        bucket = _buckets.get(key)
+        if bucket is None:
+            if len(_buckets) >= MAX_BUCKETS:
+                prune_buckets(time.monotonic())
+            bucket = _buckets[key] = TokenBucket(rate, burst)
+        wait = bucket.take()
+
+    if wait:
+        metrics.increment("admission.rate_limited")
+        print(f"DEBUG: Rate limit exceeded for {identity} on {bucket_name}.")
+        abort(429, "Rate limit exceeded, slow down.", retry_after=math.ceil(wait))
+
+class RouteGate:
+    # Caps the requests running a route at once; up to `queue` more wait for a slot
+    # for at most `timeout` seconds, anything beyond that is shed straight away
+    def __init__(self, name, limit, queue, timeout):
+        self.name = name
+        self.slots = threading.BoundedSemaphore(limit)
+        self.queue = queue
+        self.timeout = timeout
+        self.waiting = 0
+        self.lock = threading.Lock()
+
+    def enter(self):
+        if self.slots.acquire(blocking=False):
+            return
+
+        with self.lock:
+            if self.waiting >= self.queue:
+                metrics.increment("admission.shed.queue_full")
+                print(f"DEBUG: Shedding request to {self.name}, {self.waiting} already queued.")
+                abort(503, "Server is busy, try again shortly.", retry_after=math.ceil(self.timeout) or 1)
+            self.waiting += 1
+
+        try:
+            acquired = self.slots.acquire(timeout=self.timeout)
+        finally:
+            with self.lock:
+                self.waiting -= 1
+
+        if not acquired:
+            metrics.increment("admission.shed.timeout")
+            print(f"DEBUG: Shedding request to {self.name}, no slot within {self.timeout}s.")
+            abort(503, "Server is busy, try again shortly.", retry_after=math.ceil(self.timeout) or 1)
+
+    def leave(self):
+        self.slots.release()
+
+def request_identity():
+    # The authenticated user when there is one, otherwise the client address
+    if "authenticated_user" in g:
+        return g.authenticated_user["email"]
+    if request.authorization:
+        try:
+            return authenticate_user()["email"]
+        except HTTPException:
+            pass
+    return request.remote_addr
+
+def operation_limits(operation):
+    # Defaults from config, overridden per operation by the x-rate-limit and
+    # x-concurrency-limit extensions in swagger.yml
+    spec = operation._operation
+    rate_limit = spec.get("x-rate-limit", {})
+    concurrency_limit = spec.get("x-concurrency-limit", {})
+    return {
+        # Operations with their own rate limit get their own bucket per identity
+        "bucket": operation.operation_id if rate_limit else "default",
+        "rate": rate_limit.get("rate", app.config["RATE_LIMIT_PER_SECOND"]),
+        "burst": rate_limit.get("burst", app.config["RATE_LIMIT_BURST"]),
+        "limit": concurrency_limit.get("limit", app.config["CONCURRENCY_LIMIT"]),
+        "queue": concurrency_limit.get("queue", app.config["CONCURRENCY_QUEUE"]),
+        "timeout": concurrency_limit.get("timeout", app.config["CONCURRENCY_QUEUE_TIMEOUT"]),
+    }
+
+def admission_control(name, limits, function):
+    gate = None
+    if limits["limit"]:
+        gate = RouteGate(name, limits["limit"], limits["queue"], limits["timeout"])
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if limits["rate"]:
+            check_rate(limits["bucket"], request_identity(), limits["rate"], limits["burst"])
+
+        if gate is None:
+            return function(*args, **kwargs)
+
+        gate.enter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            gate.leave()
+
+    return wrapper
+
+# Every operation in the spec by operation ID, for code that calls handlers without
+# going through Connexion and needs their parameters and body schema
+resolved_operations = {}
+
+class AdmissionResolver(Resolver):
+    # Wraps every handler in the spec with its rate limit and concurrency cap, and
+    # inside those with on-demand profiling, so a profile leaves out time spent queued
+    def resolve(self, operation):
+        resolution = super().resolve(operation)
+        resolved_operations[resolution.operation_id] = operation
+        function = admission_control(
+            resolution.operation_id, operation_limits(operation),
+            profiled(resolution.operation_id, resolution.function),
+        )
+        return Resolution(function, resolution.operation_id)
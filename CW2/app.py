@@ -1,8 +1,14 @@
+import sys
 from flask import render_template
-import config
-from trails import get_all_trails  
+import startup
 
-config.connex_app.add_api(config.basedir / "swagger.yml")
+with startup.phase("import config and handlers"):
+    import config
+    from trails import get_all_trails
+
+# Uses the pre-compiled spec from `python startup.py --compile` when it is up to date
+with startup.phase("load OpenAPI spec"):
+    startup.add_api(config.connex_app)
 
 app = config.app
 
@@ -13,4 +19,7 @@ def home():
     return render_template("home.html", trails=trails)
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8000)
+    if "--import-profile" in sys.argv:
+        startup.print_import_profile()
+    else:
+        app.run(host="0.0.0.0", port=8000)
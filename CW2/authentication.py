@@ -1,5 +1,22 @@
-from flask import request, abort
+from flask import request, abort, g
+from config import app
 from models import User
+from invalidation import LocalCache
+from circuit import DatabaseUnavailable, DB_FAILURES
+
+# Role and ID lookups by email, dropped whenever a "user" invalidation is published
+user_cache = LocalCache(["user"], ttl=app.config["LOCAL_CACHE_TTL_SECONDS"])
+
+def lookup_user(email):
+    if app.config["SNAPSHOT_FILE"]:
+        # Read-only mode has no database; users come from the snapshot file
+        from readmodel import read_model
+        return read_model.current().user(email)
+
+    user = User.query.filter_by(Email_address=email).one_or_none()
+    if not user:
+        return None
+    return {"email": user.Email_address, "role": user.Role, "UserID": user.UserID}
 
 # List of users to authenticate
 password_list = [
@@ -9,6 +26,10 @@ password_list = [
 ]
 
 def authenticate_user(username=None, password=None):
+    # Reuse the result if this request (or its batch) has already authenticated
+    if "authenticated_user" in g:
+        return g.authenticated_user
+
     auth = request.authorization
     if not auth:
         print("DEBUG: Missing authorization header.")
@@ -24,14 +45,19 @@ def authenticate_user(username=None, password=None):
         print("DEBUG: Password validation failed.")
         abort(401, "Invalid credentials.")
 
-    # Fetch the user's role and ID from the database
-    user = User.query.filter_by(Email_address=email).one_or_none()
+    # Fetch the user's role and ID from the database (cached per worker). While the
+    # database is down an expired entry is used, so stale reads keep working for
+    # users this worker has seen.
+    user = user_cache.get_or_compute(
+        email, lambda: lookup_user(email), stale_on=(DatabaseUnavailable,) + DB_FAILURES
+    )
     if not user:
         print("DEBUG: User not found in the database.")
         abort(401, "User not found in the database.")
 
-    print(f"DEBUG: User authenticated successfully with email: {email}, role: {user.Role}, UserID: {user.UserID}")
-    return {"email": user.Email_address, "role": user.Role, "UserID": user.UserID}
+    print(f"DEBUG: User authenticated successfully with email: {email}, role: {user['role']}, UserID: {user['UserID']}")
+    g.authenticated_user = user
+    return g.authenticated_user
 
 def require_auth(): 
     user = authenticate_user() 
@@ -0,0 +1,188 @@
+import inspect
+import json
+from flask import abort, current_app, g, request
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import HTTPException
+from connexion.decorators.validation import TypeValidationError, coerce_type
+from connexion.exceptions import ProblemException
+from connexion.lifecycle import ConnexionRequest
+from connexion.utils import is_nullable
+from config import db
+from authentication import require_auth
+from transactions import commit_changes
+from invalidation import discard_pending
+from admission import resolved_operations
+import trails
+
+# Handlers from trails.py that can be called as batch sub-operations
+BATCH_OPERATIONS = {
+    name: getattr(trails, name)
+    for name in (
+        "get_one_trail",
+        "update_trail",
+        "delete_trail",
+        "get_point_locations_for_trail",
+        "add_location_point_to_trail",
+        "update_trail_location_point",
+        "delete_location_point_from_trail",
+        "get_features_for_trail",
+        "add_feature_to_trail",
+        "delete_feature_from_trail",
+        "get_all_features",
+        "get_feature_by_id",
+        "add_new_feature",
+        "update_feature",
+        "delete_feature_by_id",
+        "get_all_location_points",
+        "get_location_point",
+        "add_location_point",
+        "update_location_point",
+        "delete_location_point",
+    )
+}
+
+MAX_BATCH_OPERATIONS = 100
+
+def run_batch():
+    # Authenticate once; sub-operations reuse the cached user for their own role checks
+    user = require_auth()
+    if not user:
+        abort(401, "Authentication required.")
+
+    request_data = request.get_json()
+    operations = request_data.get("operations") if request_data else None
+    if not operations:
+        abort(400, "At least one operation is required.")
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        abort(400, f"A batch can contain at most {MAX_BATCH_OPERATIONS} operations.")
+
+    # Reject unknown operations and bad path parameters before anything runs
+    for index, operation in enumerate(operations):
+        handler = BATCH_OPERATIONS.get(operation.get("operation"))
+        if not handler:
+            abort(400, f"Operation {index} has unknown operation '{operation.get('operation')}'.")
+        try:
+            inspect.signature(handler).bind(**(operation.get("params") or {}))
+        except TypeError as error:
+            abort(400, f"Operation {index} has invalid params: {error}")
+        try:
+            validate_operation(operation)
+        except ProblemException as error:
+            abort(400, f"Operation {index} is invalid: {error.detail}")
+
+    results = []
+    failed = None
+    g.defer_commit = True
+    try:
+        for index, operation in enumerate(operations):
+            result = run_operation(index, operation)
+            results.append(result)
+            if result["status"] >= 400:
+                failed = result
+                break
+
+        g.defer_commit = False
+
+        # One commit for the whole batch, or nothing at all if any operation failed
+        if failed:
+            db.session.rollback()
+            discard_pending()
+        else:
+            commit_changes()
+    except Exception:
+        db.session.rollback()
+        discard_pending()
+        raise
+    finally:
+        g.defer_commit = False
+
+    for operation in operations[len(results):]:
+        results.append({"index": len(results), "operation": operation["operation"], "status": None, "skipped": True})
+
+    if failed:
+        return {"committed": False, "failed_index": failed["index"], "results": results}, failed["status"]
+
+    return {"committed": True, "results": results}, 200
+
+def validate_operation(operation):
+    # Sub-operations skip Connexion's request validation, so each one is checked with
+    # the same validators against its operation in the spec. Handler params are path
+    # or query parameters, which arrive in a URL as text, so they are written out as
+    # text and converted to their declared types the way Connexion converts them.
+    spec = resolved_operations.get(f"trails.{operation['operation']}")
+    if spec is None:
+        return
+
+    params = operation.get("params") or {}
+    path_params = {}
+    query = dict(operation.get("query") or {})
+    for parameter in spec.parameters:
+        name = parameter["name"]
+        if name not in params or parameter["in"] not in ("path", "query"):
+            continue
+        value = params[name] if isinstance(params[name], str) else json.dumps(params[name])
+        try:
+            params[name] = coerce_type(parameter, value, parameter["in"], name)
+        except TypeValidationError:
+            # Left as it is for the validator to report
+            pass
+        if parameter["in"] == "path":
+            path_params[name] = params[name]
+        else:
+            query[name] = params[name]
+
+    body = operation.get("body")
+    sub_request = ConnexionRequest(
+        request.path,
+        operation.get("method", "POST"),
+        path_params=path_params,
+        query=query,
+        headers=Headers(operation.get("headers") or {}),
+        body=None if body is None else json.dumps(body).encode(),
+        json_getter=lambda: body,
+    )
+
+    def validated(sub_request):
+        return None
+
+    if spec.parameters:
+        validated = spec.validator_map["parameter"](spec.parameters, spec.api)(validated)
+    if spec.body_schema:
+        validated = spec.validator_map["body"](
+            spec.body_schema, spec.consumes, spec.api, is_nullable(spec.body_definition)
+        )(validated)
+    validated(sub_request)
+
+def run_operation(index, operation):
+    handler = BATCH_OPERATIONS[operation["operation"]]
+    params = operation.get("params") or {}
+
+    # Give each sub-operation its own request so handlers can read its body and query
+    # string; the app context (and with it db.session and g) is shared with the batch
+    with current_app.test_request_context(
+        request.path,
+        method=operation.get("method", "POST"),
+        query_string=operation.get("query"),
+        json=operation.get("body"),
+        headers=operation.get("headers"),
+    ):
+        try:
+            response = current_app.make_response(handler(**params))
+        except HTTPException as error:
+            return {
+                "index": index,
+                "operation": operation["operation"],
+                "status": error.code,
+                "body": {"detail": error.description},
+            }
+
+    body = response.get_json(silent=True)
+    if body is None:
+        body = response.get_data(as_text=True)
+
+    return {
+        "index": index,
+        "operation": operation["operation"],
+        "status": response.status_code,
+        "body": body,
+    }
@@ -0,0 +1,229 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+import pytz
+from flask import abort
+from sqlalchemy import and_, event, or_, select, update
+from config import db
+from models import (
+    Trail, trail_schema, Feature, LocationPoint, location_point_schema,
+    TrailFeature, TrailLocationPt, Tombstone, ChangeCounter, ChangeCommit
+)
+from authentication import require_auth
+from routing import read_only, RoutingSession
+
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+
+# SQL Server caps a statement at 2100 parameters, so IN lists are chunked
+STAMP_CHUNK = 1000
+
+# Each stream is paged independently on its (Change_seq, id) keyset index
+STREAMS = {
+    "trails": (Trail, Trail.TrailID),
+    "features": (Feature, Feature.Trail_FeatureID),
+    "location_points": (LocationPoint, LocationPoint.Location_Point),
+    "tombstones": (Tombstone, Tombstone.TombstoneID),
+}
+
+TOMBSTONE_GROUPS = {
+    "trail": "trails",
+    "feature": "features",
+    "location_point": "location_points",
+}
+
+def record_tombstone(entity, entity_id):
+    # Called by the delete handlers, in the same transaction as the delete
+    db.session.add(Tombstone(Entity=entity, EntityID=entity_id))
+
+# Change sequence numbers. Timestamps are taken when a row is written, not when its
+# transaction commits, so a feed paging on them skips rows from transactions that
+# commit late. Instead every transaction that changes the catalogue takes the next
+# number from cw2_change_counter as it commits and stamps its rows with it. The
+# counter row stays locked until the commit, so a later number is never visible
+# before an earlier one.
+
+def take_change_seq(session):
+    # The current transaction's sequence number, taken on first use. Bulk loaders can
+    # call this up front and write Change_seq into their rows themselves.
+    seq = session.info.get("change_seq")
+    if seq is None:
+        counter = ChangeCounter.__table__
+        session.execute(update(counter).where(counter.c.CounterID == 1).values(Change_seq=counter.c.Change_seq + 1))
+        seq = session.execute(select(counter.c.Change_seq).where(counter.c.CounterID == 1)).scalar_one()
+        session.execute(ChangeCommit.__table__.insert().values(
+            Change_seq=seq, committed=datetime.now(pytz.utc).replace(tzinfo=None)
+        ))
+        session.info["change_seq"] = seq
+    return seq
+
+def mark_changed(model, ids, created=False, session=None):
+    # For rows written without the ORM unit of work (bulk INSERTs and UPDATEs), which
+    # track_flush does not see
+    changed = (session or db.session).info.setdefault("changed", {})
+    changed.setdefault(model, set()).update(ids)
+    if created:
+        changed.setdefault((model, "created"), set()).update(ids)
+
+def track_flush(session, flush_context):
+    for instance in list(session.new) + list(session.dirty):
+        if isinstance(instance, (Trail, Feature, LocationPoint)):
+            key = instance.__mapper__.primary_key_from_instance(instance)[0]
+            mark_changed(type(instance), [key], created=instance in session.new, session=session)
+        elif isinstance(instance, Tombstone):
+            mark_changed(Tombstone, [instance.TombstoneID], session=session)
+    # Adding or removing a trail's points or features changes the trail
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(instance, (TrailFeature, TrailLocationPt)):
+            mark_changed(Trail, [instance.TrailID], session=session)
+
+def stamp_changes(session):
+    # Savepoints are left to the transaction around them, which may still roll back
+    if session.in_nested_transaction():
+        return
+    session.flush()
+    changed = session.info.pop("changed", None)
+    if not changed:
+        return
+    seq = take_change_seq(session)
+    for key, ids in changed.items():
+        model, column = key if isinstance(key, tuple) else (key, None)
+        table = model.__table__
+        primary_key = table.primary_key.columns.values()[0]
+        values = {"Created_seq": seq} if column == "created" else {"Change_seq": seq}
+        ids = sorted(ids)
+        for start in range(0, len(ids), STAMP_CHUNK):
+            session.execute(update(table).where(primary_key.in_(ids[start:start + STAMP_CHUNK])).values(**values))
+
+def clear_changes(session, transaction):
+    if transaction.parent is None:
+        session.info.pop("changed", None)
+        session.info.pop("change_seq", None)
+
+event.listen(RoutingSession, "after_flush", track_flush)
+event.listen(RoutingSession, "before_commit", stamp_changes)
+event.listen(RoutingSession, "after_transaction_end", clear_changes)
+
+def encode_cursor(positions):
+    payload = {stream: [seq, last_id] for stream, (seq, last_id) in positions.items()}
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+def decode_since(since):
+    # `since` is either a cursor returned by a previous page or an ISO 8601 timestamp
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(since.encode()))
+        return {stream: (int(payload[stream][0]), int(payload[stream][1])) for stream in STREAMS}
+    except (binascii.Error, ValueError, KeyError, TypeError, IndexError):
+        pass
+
+    try:
+        timestamp = datetime.fromisoformat(since.replace("Z", "+00:00"))
+    except ValueError:
+        abort(400, "since must be an ISO 8601 timestamp or a cursor from a previous response.")
+
+    # A timestamp without a zone is London time. In the hour that repeats when the
+    # clocks go back it is taken as the earlier one, so nothing is skipped.
+    if not timestamp.tzinfo:
+        timestamp = pytz.timezone('Europe/London').localize(timestamp, is_dst=True)
+    timestamp = timestamp.astimezone(pytz.utc).replace(tzinfo=None)
+
+    # Start at the first transaction that had not committed by then
+    seq = db.session.query(db.func.max(ChangeCommit.Change_seq)).filter(
+        ChangeCommit.committed <= timestamp
+    ).scalar() or 0
+    return {stream: (seq + 1, 0) for stream in STREAMS}
+
+def fetch_page(model, id_column, position, limit):
+    seq, last_id = position
+    return model.query.filter(
+        or_(
+            model.Change_seq > seq,
+            and_(model.Change_seq == seq, id_column > last_id)
+        )
+    ).order_by(model.Change_seq, id_column).limit(limit).all()
+
+def format_trails(trails):
+    trail_ids = [trail.TrailID for trail in trails]
+    if not trail_ids:
+        return {}
+
+    # Fetch the links for the whole page in two queries
+    feature_ids = {trail_id: [] for trail_id in trail_ids}
+    for link in TrailFeature.query.filter(TrailFeature.TrailID.in_(trail_ids)).all():
+        feature_ids[link.TrailID].append(link.Trail_FeatureID)
+
+    location_points = {trail_id: [] for trail_id in trail_ids}
+    for link in TrailLocationPt.query.filter(
+        TrailLocationPt.TrailID.in_(trail_ids)
+    ).order_by(TrailLocationPt.TrailID, TrailLocationPt.Order_no).all():
+        location_points[link.TrailID].append({
+            "Location_Point": link.Location_Point,
+            "Order_no": link.Order_no,
+        })
+
+    formatted = {}
+    for trail in trails:
+        data = trail_schema.dump(trail)
+        data["Features"] = feature_ids[trail.TrailID]
+        data["LocationPoints"] = location_points[trail.TrailID]
+        formatted[trail.TrailID] = data
+    return formatted
+
+def format_feature(feature):
+    return {
+        "FeatureID": feature.Trail_FeatureID,
+        "Feature": feature.Trail_Feature,
+        # Naive London time, written out without a zone as the schema dumps do
+        "timestamp": feature.timestamp.isoformat() if feature.timestamp else None,
+    }
+
+def split_changes(rows, id_column, format_row, position):
+    # Rows created after the caller's position are inserts, the rest are updates
+    changes = {"inserted": [], "updated": [], "deleted": []}
+    for row in rows:
+        created = row.Created_seq is not None and (row.Created_seq, getattr(row, id_column.key)) > position
+        kind = "inserted" if created else "updated"
+        changes[kind].append(format_row(row))
+    return changes
+
+@read_only
+def get_changes(since, limit=DEFAULT_PAGE_SIZE):
+    user = require_auth()
+    if not user:
+        abort(401, "Authentication required.")
+
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    positions = decode_since(since)
+
+    pages = {
+        stream: fetch_page(model, id_column, positions[stream], limit)
+        for stream, (model, id_column) in STREAMS.items()
+    }
+
+    trails = format_trails(pages["trails"])
+    result = {
+        "trails": split_changes(
+            pages["trails"], Trail.TrailID, lambda trail: trails[trail.TrailID], positions["trails"]
+        ),
+        "features": split_changes(
+            pages["features"], Feature.Trail_FeatureID, format_feature, positions["features"]
+        ),
+        "location_points": split_changes(
+            pages["location_points"], LocationPoint.Location_Point, location_point_schema.dump, positions["location_points"]
+        ),
+    }
+
+    for tombstone in pages["tombstones"]:
+        result[TOMBSTONE_GROUPS[tombstone.Entity]]["deleted"].append(tombstone.EntityID)
+
+    # Move each stream's position to the last row it returned
+    for stream, (model, id_column) in STREAMS.items():
+        if pages[stream]:
+            last = pages[stream][-1]
+            positions[stream] = (last.Change_seq, getattr(last, id_column.key))
+
+    result["next_cursor"] = encode_cursor(positions)
+    result["has_more"] = any(len(page) == limit for page in pages.values())
+
+    return result, 200
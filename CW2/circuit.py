@@ -0,0 +1,195 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.exc import InterfaceError, OperationalError
+from werkzeug.exceptions import ServiceUnavailable
+import metrics
+
+# Errors that mean the database could not be reached or did not answer in time, as
+# opposed to errors in what was asked of it (constraint violations and the like)
+DB_FAILURES = (OperationalError, InterfaceError)
+
+# Last good responses kept per worker for @serve_stale, least recently used dropped first
+MAX_STALE_RESPONSES = 1000
+
+class DatabaseUnavailable(ServiceUnavailable):
+    description = "The database is unavailable, try again shortly."
+
+class CircuitBreaker:
+    # Watches every connection and statement on the primary database. After `failures`
+    # failures in a row (errors, or statements slower than `slow_seconds`) it opens:
+    # from then on statements fail at once instead of waiting on the database, until a
+    # background probe gets an answer again and closes it.
+    def __init__(self, engine, failures, slow_seconds, probe_seconds):
+        self.engine = engine
+        self.failures = failures
+        self.slow_seconds = slow_seconds
+        self.probe_seconds = probe_seconds
+        self.consecutive = 0
+        self.is_open = False
+        self.lock = threading.Lock()
+        # Set on the probe's thread, whose queries must get through while open
+        self.probing = threading.local()
+
+    @property
+    def state(self):
+        return "open" if self.is_open else "closed"
+
+    def check(self):
+        if self.is_open and not getattr(self.probing, "active", False):
+            metrics.increment("circuit.rejected")
+            raise DatabaseUnavailable(retry_after=math.ceil(self.probe_seconds) or 1)
+
+    def record(self, failed):
+        if getattr(self.probing, "active", False):
+            return
+
+        with self.lock:
+            if not failed:
+                self.consecutive = 0
+                return
+            metrics.increment("circuit.failures")
+            self.consecutive += 1
+            if self.is_open or self.consecutive < self.failures:
+                return
+            self.is_open = True
+
+        metrics.increment("circuit.opened")
+        print(f"DEBUG: Database circuit opened after {self.failures} failures in a row.")
+        threading.Thread(target=self.probe, name="circuit-probe", daemon=True).start()
+
+    def probe(self):
+        self.probing.active = True
+        while True:
+            time.sleep(self.probe_seconds)
+            started = time.perf_counter()
+            try:
+                with self.engine.connect() as connection:
+                    connection.exec_driver_sql("SELECT 1")
+            except Exception as error:
+                metrics.increment("circuit.probe_failed")
+                print(f"DEBUG: Database probe failed: {error}")
+                continue
+            if self.slow_seconds and time.perf_counter() - started > self.slow_seconds:
+                metrics.increment("circuit.probe_failed")
+                print("DEBUG: Database probe answered, but too slowly.")
+                continue
+            break
+
+        with self.lock:
+            self.is_open = False
+            self.consecutive = 0
+        metrics.increment("circuit.closed")
+        print("DEBUG: Database probe succeeded, circuit closed.")
+
+    # Engine event listeners
+
+    def before_connect(self, dialect, connection_record, cargs, cparams):
+        self.check()
+
+    def before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.check()
+        conn.info["circuit_started"] = time.perf_counter()
+
+    def after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info.pop("circuit_started")
+        self.record(bool(self.slow_seconds) and elapsed > self.slow_seconds)
+
+    def on_error(self, context):
+        if context.connection is not None:
+            context.connection.info.pop("circuit_started", None)
+        if isinstance(context.original_exception, DatabaseUnavailable):
+            return
+        if context.is_disconnect or isinstance(context.sqlalchemy_exception, DB_FAILURES):
+            self.record(True)
+
+breaker = None
+
+_stale = OrderedDict()
+_stale_lock = threading.Lock()
+
+def stale_key(handler, args, kwargs):
+    # Keyed by role as well, so a response is only served to requests authorised the
+    # same way as the one that got it
+    user = g.get("authenticated_user")
+    return (
+        handler.__name__,
+        args,
+        tuple(sorted(kwargs.items())),
+        request.query_string,
+        user["role"] if user else "anonymous",
+    )
+
+def serve_stale(handler):
+    # Keeps the last good response of a read and serves it, marked stale, when the
+    # database is unavailable. Goes above @coalesce so requests that joined a failed
+    # call each get the stale response too.
+    @wraps(handler)
+    def wrapper(*args, **kwargs):
+        # A batch reads its own uncommitted writes, so it never gets an old answer
+        if not has_request_context() or g.get("defer_commit"):
+            return handler(*args, **kwargs)
+
+        try:
+            result = handler(*args, **kwargs)
+        except (DatabaseUnavailable,) + DB_FAILURES:
+            with _stale_lock:
+                entry = _stale.get(stale_key(handler, args, kwargs))
+            if entry is None:
+                raise
+            stored_at, result = entry
+            g.stale_age = time.monotonic() - stored_at
+            metrics.increment(f"circuit.stale.{handler.__name__}")
+            print(f"DEBUG: Database unavailable, serving a stale response to {handler.__name__}.")
+            return result
+
+        key = stale_key(handler, args, kwargs)
+        with _stale_lock:
+            _stale[key] = (time.monotonic(), result)
+            _stale.move_to_end(key)
+            if len(_stale) > MAX_STALE_RESPONSES:
+                _stale.popitem(last=False)
+        return result
+
+    return wrapper
+
+def mark_stale(response):
+    stale_age = g.get("stale_age")
+    if stale_age is not None:
+        response.headers["Warning"] = '110 - "Response is Stale"'
+        response.headers["Age"] = str(int(stale_age))
+    return response
+
+def database_state():
+    return breaker.state if breaker else "unguarded"
+
+def init_app(app, db):
+    global breaker
+    app.after_request(mark_stale)
+
+    with app.app_context():
+        engine = db.engine
+
+    if engine.dialect.driver == "pyodbc" and app.config["DB_QUERY_TIMEOUT"]:
+        @event.listens_for(engine, "connect")
+        def set_query_timeout(dbapi_connection, connection_record):
+            # pyodbc's per-statement timeout, in seconds
+            dbapi_connection.timeout = app.config["DB_QUERY_TIMEOUT"]
+
+    if not app.config["DB_BREAKER_FAILURES"]:
+        return
+
+    breaker = CircuitBreaker(
+        engine,
+        app.config["DB_BREAKER_FAILURES"],
+        app.config["DB_BREAKER_SLOW_SECONDS"],
+        app.config["DB_BREAKER_PROBE_SECONDS"],
+    )
+    event.listen(engine, "do_connect", breaker.before_connect)
+    event.listen(engine, "before_cursor_execute", breaker.before_execute)
+    event.listen(engine, "after_cursor_execute", breaker.after_execute)
+    event.listen(engine, "handle_error", breaker.on_error)
@@ -0,0 +1,76 @@
+import threading
+from functools import wraps
+from flask import g, has_request_context, request
+from werkzeug.exceptions import HTTPException
+from authentication import authenticate_user
+import metrics
+
+class Flight:
+    # One in-flight call that identical requests wait on
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+def role_class():
+    # Requests only share a result with requests that are authorised the same way
+    if "authenticated_user" in g:
+        return g.authenticated_user["role"]
+    if not request.authorization:
+        return "anonymous"
+    try:
+        return authenticate_user()["role"]
+    except HTTPException:
+        return "invalid"
+
+def flight_key(handler, args, kwargs):
+    return (
+        handler.__name__,
+        args,
+        tuple(sorted(kwargs.items())),
+        request.query_string,
+        role_class(),
+        # Clients in their read-your-writes window read from the primary and
+        # must not be given a result read from a replica
+        g.get("db_bind_key") is None,
+    )
+
+def coalesce(handler):
+    # Single-flight: concurrent identical calls run the handler once and share the result.
+    # Goes below @read_only so the key knows which database the call reads from.
+    @wraps(handler)
+    def wrapper(*args, **kwargs):
+        # A batch reads its own uncommitted writes, so it always runs the handler itself
+        if not has_request_context() or g.get("defer_commit"):
+            return handler(*args, **kwargs)
+
+        key = flight_key(handler, args, kwargs)
+        with _flights_lock:
+            flight = _flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _flights[key] = Flight()
+
+        if not leader:
+            metrics.increment(f"coalesce.{handler.__name__}.joined")
+            flight.done.wait()
+            if flight.error:
+                raise flight.error
+            return flight.result
+
+        metrics.increment(f"coalesce.{handler.__name__}.executed")
+        try:
+            flight.result = handler(*args, **kwargs)
+            return flight.result
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with _flights_lock:
+                del _flights[key]
+            flight.done.set()
+
+    return wrapper
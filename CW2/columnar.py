@@ -0,0 +1,401 @@
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+import numpy as np
+from flask import abort
+from config import app, db
+from models import User, Trail, Feature, TrailFeature, LocationPoint, TrailLocationPt, london_now
+from admission import AdmissionResolver
+from readmodel import BASIC_FIELDS, SCHEMA_FIELDS, TRAIL_COLUMNS, isoformat, to_datetime64
+
+# Snapshot file layout: MAGIC, the header length as a little-endian uint64, a JSON
+# header naming every column with its dtype, length and offset, then the columns.
+# Each column is a fixed-width array starting on an ALIGNMENT boundary. Strings live
+# once each in a string table (UTF-8 bytes plus an offsets column), and string
+# columns hold int32 indexes into it, -1 for NULL.
+MAGIC = b"CW2COLS1"
+HEADER_START = len(MAGIC) + 8
+ALIGNMENT = 64
+
+# GET operations a read-only server answers from the snapshot file; every other
+# operation needs the database
+SNAPSHOT_OPERATIONS = {
+    "trails.get_all_trails",
+    "trails.get_all_trails_details",
+    "trails.get_one_trail",
+    "trails.get_point_locations_for_trail",
+    "trails.get_features_for_trail",
+    "trails.get_all_features",
+    "trails.get_feature_by_id",
+    "trails.get_all_location_points",
+    "trails.get_location_point",
+    "facets.get_facets",
+    "interchange.export_trails",
+    "interchange.export_trail",
+    "monitoring.get_metrics",
+}
+
+def align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+class StringTable:
+    # Each distinct string once, so repeated locations and difficulties cost 4 bytes a row
+    def __init__(self):
+        self.index = {}
+
+    def refs(self, values):
+        return np.array([-1 if value is None else self.index.setdefault(value, len(self.index)) for value in values], dtype=np.int32)
+
+    def columns(self):
+        encoded = [value.encode() for value in self.index]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(value) for value in encoded])
+        return {
+            "strings.offsets": offsets,
+            "strings.data": np.frombuffer(b"".join(encoded), dtype=np.uint8),
+        }
+
+def write_snapshot_file(path, columns, string_columns):
+    directory = {}
+    offset = 0
+    for name, array in columns.items():
+        offset = align(offset)
+        directory[name] = {"dtype": array.dtype.str, "length": len(array), "offset": offset}
+        offset += array.nbytes
+
+    header = json.dumps({
+        "created": london_now().isoformat(),
+        "string_columns": sorted(string_columns),
+        "columns": directory,
+    }).encode()
+    data_start = align(HEADER_START + len(header))
+
+    # Written beside the old file and renamed over it, so servers that still have the
+    # old one mapped keep reading it until they restart
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as file:
+        file.write(MAGIC + struct.pack("<Q", len(header)) + header)
+        for name, array in columns.items():
+            file.write(b"\0" * (data_start + directory[name]["offset"] - file.tell()))
+            file.write(np.ascontiguousarray(array).tobytes())
+    os.replace(temporary, path)
+
+def query_columns(model, fields, order_by):
+    rows = db.session.query(*[getattr(model, field) for field in fields]).order_by(*order_by).all()
+    return [list(values) for values in zip(*rows)] if rows else [[] for _ in fields]
+
+def export_snapshot(path):
+    # Writes the catalogue and its users to a snapshot file for read-only serving
+    strings = StringTable()
+    columns = {}
+    string_columns = set()
+
+    def add(table, fields, values, dtypes):
+        for field, field_values, dtype in zip(fields, values, dtypes):
+            name = f"{table}.{field}"
+            if dtype == "string":
+                columns[name] = strings.refs(field_values)
+                string_columns.add(name)
+            elif dtype == "datetime":
+                columns[name] = to_datetime64(field_values)
+            else:
+                columns[name] = np.array(field_values, dtype=dtype)
+
+    point_fields = ("Location_Point", "Latitude", "Longitude", "Description", "created", "timestamp")
+    add("point", point_fields, query_columns(LocationPoint, point_fields, [LocationPoint.Location_Point]),
+        (np.int64, np.float64, np.float64, "string", "datetime", "datetime"))
+
+    feature_fields = ("Trail_FeatureID", "Trail_Feature")
+    add("feature", feature_fields, query_columns(Feature, feature_fields, [Feature.Trail_FeatureID]), (np.int64, "string"))
+
+    trail_types = {
+        "TrailID": np.int64, "Length": np.float64, "Elevation_gain": np.float64, "OwnerID": np.int64,
+        "created": "datetime", "timestamp": "datetime", "Version": np.int64,
+    }
+    add("trail", TRAIL_COLUMNS, query_columns(Trail, TRAIL_COLUMNS, [Trail.TrailID]),
+        [trail_types.get(field, "string") for field in TRAIL_COLUMNS])
+
+    user_fields = ("UserID", "Email_address", "Role")
+    add("user", user_fields, query_columns(User, user_fields, [User.UserID]), (np.int64, "string", "string"))
+
+    # Trails' points in Order_no order and their features, as one run of rows per
+    # trail between its start and end. Links to rows written after those tables were
+    # read are left out.
+    trail_ids = columns["trail.TrailID"]
+    link_trails, link_points, link_orders = query_columns(
+        TrailLocationPt, ("TrailID", "Location_Point", "Order_no"), [TrailLocationPt.TrailID, TrailLocationPt.Order_no]
+    )
+    keep = np.isin(link_points, columns["point.Location_Point"]) & np.isin(link_trails, trail_ids)
+    link_trails = np.array(link_trails, dtype=np.int64)[keep]
+    columns["trail_point.Location_Point"] = np.array(link_points, dtype=np.int64)[keep]
+    columns["trail_point.Order_no"] = np.array(link_orders, dtype=np.int32)[keep]
+    columns["trail.point_start"] = np.searchsorted(link_trails, trail_ids, side="left").astype(np.int64)
+    columns["trail.point_end"] = np.searchsorted(link_trails, trail_ids, side="right").astype(np.int64)
+
+    feature_trails, feature_ids = query_columns(
+        TrailFeature, ("TrailID", "Trail_FeatureID"), [TrailFeature.TrailID, TrailFeature.Trail_FeatureID]
+    )
+    keep = np.isin(feature_ids, columns["feature.Trail_FeatureID"]) & np.isin(feature_trails, trail_ids)
+    feature_trails = np.array(feature_trails, dtype=np.int64)[keep]
+    columns["trail_feature.Trail_FeatureID"] = np.array(feature_ids, dtype=np.int64)[keep]
+    columns["trail.feature_start"] = np.searchsorted(feature_trails, trail_ids, side="left").astype(np.int64)
+    columns["trail.feature_end"] = np.searchsorted(feature_trails, trail_ids, side="right").astype(np.int64)
+
+    columns.update(strings.columns())
+    write_snapshot_file(path, columns, string_columns)
+    return {
+        "trails": len(trail_ids),
+        "features": len(columns["feature.Trail_FeatureID"]),
+        "location_points": len(columns["point.Location_Point"]),
+        "bytes": os.path.getsize(path),
+    }
+
+def find(ids, key):
+    # Row of an ID in a sorted ID column, or None; IDs from a path may be strings
+    try:
+        key = int(key)
+    except (TypeError, ValueError):
+        return None
+    row = int(np.searchsorted(ids, key))
+    return row if row < len(ids) and ids[row] == key else None
+
+class MappedCatalogue:
+    # The catalogue served straight from a snapshot file, with the same methods as
+    # readmodel.Snapshot. Every column is a numpy view of the memory-mapped file, so
+    # opening it reads only the header and worker processes share its pages through
+    # the page cache.
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.buffer[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a catalogue snapshot file")
+
+        (header_length,) = struct.unpack_from("<Q", self.buffer, len(MAGIC))
+        header = json.loads(self.buffer[HEADER_START:HEADER_START + header_length])
+        data_start = align(HEADER_START + header_length)
+        self.created = header["created"]
+        self.string_columns = set(header["string_columns"])
+        self.columns = {
+            name: np.frombuffer(self.buffer, dtype=column["dtype"], count=column["length"], offset=data_start + column["offset"])
+            if column["length"] else np.empty(0, dtype=column["dtype"])
+            for name, column in header["columns"].items()
+        }
+        self.string_offsets = self.columns["strings.offsets"]
+        self.string_data = self.columns["strings.data"]
+        self.users = None
+        self.basic_list = None
+        self.feature_list = None
+
+    def string(self, ref):
+        if ref < 0:
+            return None
+        return self.string_data[self.string_offsets[ref]:self.string_offsets[ref + 1]].tobytes().decode()
+
+    def values(self, name, rows=slice(None)):
+        # Python values of a column, for all rows or a slice or array of them
+        selected = self.columns[name][rows]
+        if name in self.string_columns:
+            return [self.string(ref) for ref in selected.tolist()]
+        return selected.tolist()
+
+    def value(self, name, row):
+        return self.values(name, slice(row, row + 1))[0]
+
+    def records(self, table, fields, rows=slice(None)):
+        columns = [self.values(f"{table}.{field}", rows) for field in fields]
+        return [dict(zip(fields, values)) for values in zip(*columns)]
+
+    def point_rows(self, point_ids):
+        # Links only name points that are in the file
+        return np.searchsorted(self.columns["point.Location_Point"], point_ids)
+
+    def trail_points(self, row):
+        # Zero-copy slice of the trail's point IDs and Order_no values
+        start, end = int(self.columns["trail.point_start"][row]), int(self.columns["trail.point_end"][row])
+        return self.columns["trail_point.Location_Point"][start:end], self.columns["trail_point.Order_no"][start:end]
+
+    def trail_feature_ids(self, row):
+        start, end = int(self.columns["trail.feature_start"][row]), int(self.columns["trail.feature_end"][row])
+        return self.columns["trail_feature.Trail_FeatureID"][start:end]
+
+    def feature_names(self, feature_ids):
+        rows = np.searchsorted(self.columns["feature.Trail_FeatureID"], feature_ids)
+        return self.values("feature.Trail_Feature", rows)
+
+    def dump_points(self, rows):
+        # As location_points_schema dumps them
+        points = self.records("point", ("Location_Point", "Latitude", "Longitude", "Description", "created", "timestamp"), rows)
+        for point in points:
+            point["created"] = isoformat(point["created"])
+            point["timestamp"] = isoformat(point["timestamp"])
+        return points
+
+    def basic_trails(self):
+        if self.basic_list is None:
+            self.basic_list = self.records("trail", BASIC_FIELDS)
+        return self.basic_list
+
+    def trail(self, trail_id):
+        row = find(self.columns["trail.TrailID"], trail_id)
+        if row is None:
+            return None
+        result = self.records("trail", SCHEMA_FIELDS + ("created", "timestamp"), slice(row, row + 1))[0]
+        result["created"] = isoformat(result["created"])
+        result["timestamp"] = isoformat(result["timestamp"])
+        return result
+
+    def trail_details(self):
+        details = self.records("trail", [field for field in TRAIL_COLUMNS if field != "created"])
+        for row, result in enumerate(details):
+            point_ids, order_nos = self.trail_points(row)
+            rows = self.point_rows(point_ids)
+            feature_ids = self.trail_feature_ids(row)
+            result["Features"] = [
+                {"Trail_FeatureID": feature_id, "Trail_Feature": name}
+                for feature_id, name in zip(feature_ids.tolist(), self.feature_names(feature_ids))
+            ]
+            result["LocationPoints"] = [
+                {
+                    "Location_Point": point_id,
+                    "Latitude": lat,
+                    "Longitude": lon,
+                    "Description": description,
+                    "Order_no": order_no,
+                    "timestamp": timestamp,
+                }
+                for point_id, lat, lon, description, order_no, timestamp in zip(
+                    point_ids.tolist(), self.values("point.Latitude", rows), self.values("point.Longitude", rows),
+                    self.values("point.Description", rows), order_nos.tolist(), self.values("point.timestamp", rows),
+                )
+            ]
+        return details
+
+    def trail_location_points(self, trail_id):
+        row = find(self.columns["trail.TrailID"], trail_id)
+        if row is None:
+            return None
+        point_ids, _ = self.trail_points(row)
+        return self.dump_points(self.point_rows(point_ids))
+
+    def trail_features(self, trail_id):
+        row = find(self.columns["trail.TrailID"], trail_id)
+        if row is None:
+            return None
+        feature_ids = self.trail_feature_ids(row)
+        return [
+            {"FeatureID": feature_id, "Feature": name}
+            for feature_id, name in zip(feature_ids.tolist(), self.feature_names(feature_ids))
+        ]
+
+    def all_features(self):
+        if self.feature_list is None:
+            self.feature_list = [
+                {"FeatureID": feature["Trail_FeatureID"], "Feature": feature["Trail_Feature"]}
+                for feature in self.records("feature", ("Trail_FeatureID", "Trail_Feature"))
+            ]
+        return self.feature_list
+
+    def feature(self, feature_id):
+        row = find(self.columns["feature.Trail_FeatureID"], feature_id)
+        if row is None:
+            return None
+        return {"FeatureID": int(self.columns["feature.Trail_FeatureID"][row]), "Feature": self.value("feature.Trail_Feature", row)}
+
+    def location_points(self):
+        return self.dump_points(slice(None))
+
+    def location_point(self, point_id):
+        row = find(self.columns["point.Location_Point"], point_id)
+        if row is None:
+            return None
+        return self.dump_points(slice(row, row + 1))[0]
+
+    def user(self, email):
+        # As authentication.lookup_user returns it
+        if self.users is None:
+            self.users = {
+                user["Email_address"]: {"email": user["Email_address"], "role": user["Role"], "UserID": user["UserID"]}
+                for user in self.records("user", ("UserID", "Email_address", "Role"))
+            }
+        return self.users.get(email)
+
+    def facets(self, facet_names):
+        # As facets.get_facets reports them
+        facets = {}
+        for name in facet_names:
+            refs, counts = np.unique(self.columns[f"trail.{name}"], return_counts=True)
+            facets[name] = {self.string(ref): count for ref, count in zip(refs.tolist(), counts.tolist()) if ref >= 0}
+
+        feature_ids, counts = np.unique(self.columns["trail_feature.Trail_FeatureID"], return_counts=True)
+        facets["Feature"] = sorted(
+            [
+                {"FeatureID": feature_id, "Feature": name, "count": count}
+                for feature_id, name, count in zip(feature_ids.tolist(), self.feature_names(feature_ids), counts.tolist())
+            ],
+            key=lambda item: item["count"],
+            reverse=True
+        )
+        return facets
+
+    def exported_trails(self, fields, trail_id=None):
+        # As interchange.exported_trails yields them: each trail with an iterator over
+        # its (latitude, longitude, description) points
+        trail_ids = self.columns["trail.TrailID"]
+        if trail_id is None:
+            rows = range(len(trail_ids))
+        else:
+            row = find(trail_ids, trail_id)
+            rows = [] if row is None else [row]
+
+        for row in rows:
+            trail = self.records("trail", fields, slice(row, row + 1))[0]
+            trail["Features"] = sorted(self.feature_names(self.trail_feature_ids(row)))
+            point_rows = self.point_rows(self.trail_points(row)[0])
+            yield trail, zip(
+                self.values("point.Latitude", point_rows), self.values("point.Longitude", point_rows),
+                self.values("point.Description", point_rows),
+            )
+
+class MappedReadModel:
+    # Stands in for readmodel.ReadModel in read-only mode; the file never changes, so
+    # there is nothing to invalidate
+    def __init__(self, path):
+        started = time.perf_counter()
+        self.snapshot = MappedCatalogue(path)
+        print(f"DEBUG: Mapped snapshot {path} written {self.snapshot.created} in {(time.perf_counter() - started) * 1000:.1f} ms.")
+
+    def current(self):
+        return self.snapshot
+
+def database_required(operation_id):
+    def handler(*args, **kwargs):
+        abort(501, f"{operation_id} needs the database; this server only serves a read-only snapshot.")
+
+    handler.__name__ = operation_id.rsplit(".", 1)[-1]
+    return handler
+
+class SnapshotResolver(AdmissionResolver):
+    # Read-only mode: the operations in SNAPSHOT_OPERATIONS resolve to their usual
+    # handlers, which read through read_model and so from the file; the rest answer
+    # 501 without their modules being imported. Admission control and profiling
+    # apply to both, as AdmissionResolver adds them.
+    def resolve_function_from_operation_id(self, operation_id):
+        if operation_id in SNAPSHOT_OPERATIONS:
+            return super().resolve_function_from_operation_id(operation_id)
+        return database_required(operation_id)
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--export":
+        with app.app_context():
+            started = time.perf_counter()
+            counts = export_snapshot(sys.argv[2])
+            print(
+                f"Wrote {counts['trails']} trails, {counts['features']} features and "
+                f"{counts['location_points']} location points to {sys.argv[2]} "
+                f"({counts['bytes']} bytes) in {time.perf_counter() - started:.1f}s."
+            )
+    else:
+        print("Usage: python columnar.py --export <file>")
@@ -1,9 +1,13 @@
 # config.py
 
+import os
 import pathlib
 from flask_sqlalchemy import SQLAlchemy
-from flask_marshmallow import Marshmallow
 import connexion
+import routing
+import invalidation
+import negotiation
+import circuit
 
 # Initialize Connexion
 basedir = pathlib.Path(__file__).parent.resolve()
@@ -11,7 +15,7 @@ connex_app = connexion.App(__name__, specification_dir=basedir)
 
 # Flask app and configurations
 app = connex_app.app
-app.config["SQLALCHEMY_DATABASE_URI"] = (
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URI") or (
     "mssql+pyodbc:///?odbc_connect="
     "DRIVER={ODBC Driver 17 for SQL Server};"
     "SERVER=dist-6-505.uopnet.plymouth.ac.uk;"
@@ -23,6 +27,87 @@ app.config["SQLALCHEMY_DATABASE_URI"] = (
 )
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+# Read-only mode for edge and offline deployments: the GET operations are answered from
+# a snapshot file written by `python columnar.py --export <file>` and no database is
+# needed, so an in-memory SQLite one stands in unless DATABASE_URI is given
+app.config["SNAPSHOT_FILE"] = os.environ.get("SNAPSHOT_FILE")
+if app.config["SNAPSHOT_FILE"] and not os.environ.get("DATABASE_URI"):
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+
+# How long pyodbc waits to log in to SQL Server and for any one statement, in seconds,
+# so a slow or unreachable server fails requests instead of holding their threads
+app.config["DB_CONNECT_TIMEOUT"] = int(os.environ.get("DB_CONNECT_TIMEOUT", 15))
+app.config["DB_QUERY_TIMEOUT"] = int(os.environ.get("DB_QUERY_TIMEOUT", 30))
+if app.config["SQLALCHEMY_DATABASE_URI"].startswith("mssql+pyodbc"):
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {"connect_args": {"timeout": app.config["DB_CONNECT_TIMEOUT"]}}
+
+# Circuit breaker on the primary database: after this many failures in a row (errors,
+# or statements slower than DB_BREAKER_SLOW_SECONDS) database access fails at once with
+# 503, and catalogue reads get their last good response, until a probe every
+# DB_BREAKER_PROBE_SECONDS succeeds. 0 failures turns it off, 0 seconds ignores latency.
+app.config["DB_BREAKER_FAILURES"] = int(os.environ.get("DB_BREAKER_FAILURES", 5))
+app.config["DB_BREAKER_SLOW_SECONDS"] = float(os.environ.get("DB_BREAKER_SLOW_SECONDS", 5))
+app.config["DB_BREAKER_PROBE_SECONDS"] = float(os.environ.get("DB_BREAKER_PROBE_SECONDS", 5))
+
+# Optional read replicas (comma separated URIs). Read-only handlers are routed to
+# them, except for a client's reads shortly after it wrote something.
+replica_uris = [uri.strip() for uri in os.environ.get("REPLICA_DATABASE_URIS", "").split(",") if uri.strip()]
+app.config["SQLALCHEMY_BINDS"] = {f"replica_{i}": uri for i, uri in enumerate(replica_uris)}
+app.config["REPLICA_BIND_KEYS"] = list(app.config["SQLALCHEMY_BINDS"])
+app.config["READ_YOUR_WRITES_SECONDS"] = float(os.environ.get("READ_YOUR_WRITES_SECONDS", 5))
+
+# Cross-worker cache invalidation: "memory" for a single process, "socket" for
+# several workers on one host (INVALIDATION_URL is a shared directory) or "redis"
+# (INVALIDATION_URL is a redis:// URL)
+app.config["INVALIDATION_BACKEND"] = os.environ.get("INVALIDATION_BACKEND", "memory")
+app.config["INVALIDATION_URL"] = os.environ.get("INVALIDATION_URL", "/tmp/cw2-invalidation")
+app.config["LOCAL_CACHE_TTL_SECONDS"] = float(os.environ.get("LOCAL_CACHE_TTL_SECONDS", 300))
+
+# Response compression, chosen from Accept-Encoding. zstd needs the optional
+# zstandard package; application/msgpack bodies need the optional msgpack package.
+app.config["COMPRESSION_MIN_SIZE"] = int(os.environ.get("COMPRESSION_MIN_SIZE", 1024))
+app.config["GZIP_LEVEL"] = int(os.environ.get("GZIP_LEVEL", 6))
+app.config["ZSTD_LEVEL"] = int(os.environ.get("ZSTD_LEVEL", 3))
+
+# Admission control, applied to every operation unless swagger.yml overrides it with
+# x-rate-limit / x-concurrency-limit. Rates are per authenticated user (or client
+# address) per worker; a rate or limit of 0 turns that check off.
+app.config["RATE_LIMIT_PER_SECOND"] = float(os.environ.get("RATE_LIMIT_PER_SECOND", 20))
+app.config["RATE_LIMIT_BURST"] = int(os.environ.get("RATE_LIMIT_BURST", 40))
+app.config["CONCURRENCY_LIMIT"] = int(os.environ.get("CONCURRENCY_LIMIT", 8))
+app.config["CONCURRENCY_QUEUE"] = int(os.environ.get("CONCURRENCY_QUEUE", 16))
+app.config["CONCURRENCY_QUEUE_TIMEOUT"] = float(os.environ.get("CONCURRENCY_QUEUE_TIMEOUT", 2))
+
+# What POST /trails does with a trail that follows the same route as an existing one
+# under another name: "warn" lists the similar trails in the response, "reject" refuses
+# duplicates and "off" skips the check
+app.config["DUPLICATE_TRAIL_CHECK"] = os.environ.get("DUPLICATE_TRAIL_CHECK", "warn")
+
+# Where requests profiled with the X-Profile header (admins only) are written
+app.config["PROFILE_DIR"] = os.environ.get("PROFILE_DIR", "/tmp/cw2-profiles")
+
+# How long a write's response is kept for retries sent with the same Idempotency-Key
+app.config["IDEMPOTENCY_TTL_SECONDS"] = float(os.environ.get("IDEMPOTENCY_TTL_SECONDS", 86400))
+
+# Serve catalogue reads (trails, features, location points) from the in-memory read
+# model in readmodel.py instead of querying through the ORM: "on" or "off". Off by
+# default, since the read model loads from the primary and so takes those reads off
+# the replicas in REPLICA_DATABASE_URIS.
+app.config["READ_MODEL"] = os.environ.get("READ_MODEL", "off") == "on" or bool(app.config["SNAPSHOT_FILE"])
+
 # Initialize extensions
-db = SQLAlchemy(app)
-ma = Marshmallow(app)
+db = SQLAlchemy(app, session_options={"class_": routing.RoutingSession})
+routing.init_app(app)
+invalidation.init_app(app)
+negotiation.init_app(app)
+circuit.init_app(app, db)
+
+# flask_marshmallow is slow to import, so it is only set up when the first schema is built
+ma = None
+
+def get_marshmallow():
+    global ma
+    if ma is None:
+        from flask_marshmallow import Marshmallow
+        ma = Marshmallow(app)
+    return ma
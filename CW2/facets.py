@@ -0,0 +1,125 @@
+import sys
+from flask import abort
+from sqlalchemy.exc import IntegrityError
+from config import app, db
+from models import Trail, Feature, TrailFeature, TrailFacet
+from routing import read_only
+from readmodel import read_model
+
+# Trail columns that are counted directly; features are counted through cw2_trail_feature
+TRAIL_FACETS = ("Difficulty", "Route_type", "Location")
+
+def adjust_facet(facet, value, delta):
+    if value is None:
+        return
+    value = str(value)
+
+    updated = TrailFacet.query.filter_by(Facet=facet, Value=value).update(
+        {"Trail_count": TrailFacet.Trail_count + delta}, synchronize_session=False
+    )
+    if updated:
+        if delta < 0:
+            # Drop values no trail has any more so reads stay O(number of facets)
+            TrailFacet.query.filter(
+                TrailFacet.Facet == facet, TrailFacet.Value == value, TrailFacet.Trail_count <= 0
+            ).delete(synchronize_session=False)
+        return
+
+    if delta > 0:
+        try:
+            with db.session.begin_nested():
+                db.session.add(TrailFacet(Facet=facet, Value=value, Trail_count=delta))
+        except IntegrityError:
+            # Another transaction created the row first
+            TrailFacet.query.filter_by(Facet=facet, Value=value).update(
+                {"Trail_count": TrailFacet.Trail_count + delta}, synchronize_session=False
+            )
+
+def trail_facet_values(trail):
+    return {facet: getattr(trail, facet) for facet in TRAIL_FACETS}
+
+def trail_added(trail):
+    for facet, value in trail_facet_values(trail).items():
+        adjust_facet(facet, value, 1)
+
+def trail_changed(old_values, trail):
+    for facet, value in trail_facet_values(trail).items():
+        if old_values[facet] != value:
+            adjust_facet(facet, old_values[facet], -1)
+            adjust_facet(facet, value, 1)
+
+def trail_removed(trail, feature_ids):
+    for facet, value in trail_facet_values(trail).items():
+        adjust_facet(facet, value, -1)
+    for feature_id in feature_ids:
+        adjust_facet("Feature", feature_id, -1)
+
+def feature_linked(feature_id):
+    adjust_facet("Feature", feature_id, 1)
+
+def feature_unlinked(feature_id):
+    adjust_facet("Feature", feature_id, -1)
+
+def feature_deleted(feature_id):
+    TrailFacet.query.filter_by(Facet="Feature", Value=str(feature_id)).delete(synchronize_session=False)
+
+def rebuild_facets():
+    # Recompute every count from the trail tables, for recovery or after bulk loads
+    TrailFacet.query.delete(synchronize_session=False)
+
+    rows = []
+    for facet in TRAIL_FACETS:
+        column = getattr(Trail, facet)
+        for value, count in db.session.query(column, db.func.count()).group_by(column).all():
+            if value is not None:
+                rows.append(TrailFacet(Facet=facet, Value=str(value), Trail_count=count))
+
+    for feature_id, count in db.session.query(
+        TrailFeature.Trail_FeatureID, db.func.count()
+    ).group_by(TrailFeature.Trail_FeatureID).all():
+        rows.append(TrailFacet(Facet="Feature", Value=str(feature_id), Trail_count=count))
+
+    db.session.add_all(rows)
+    return len(rows)
+
+@read_only
+def get_facets():
+    if app.config["SNAPSHOT_FILE"]:
+        facets = read_model.current().facets(TRAIL_FACETS)
+        if not any(facets.values()):
+            abort(404, "No trails found")
+        return facets, 200
+
+    facet_rows = TrailFacet.query.filter(TrailFacet.Trail_count > 0).all()
+    if not facet_rows:
+        abort(404, "No trails found")
+
+    facets = {facet: {} for facet in TRAIL_FACETS}
+    feature_counts = {}
+    for row in facet_rows:
+        if row.Facet == "Feature":
+            feature_counts[int(row.Value)] = row.Trail_count
+        else:
+            facets[row.Facet][row.Value] = row.Trail_count
+
+    # Only the features that have a count are looked up, never the trails
+    features = Feature.query.filter(Feature.Trail_FeatureID.in_(list(feature_counts))).all() if feature_counts else []
+    facets["Feature"] = sorted(
+        [
+            {"FeatureID": feature.Trail_FeatureID, "Feature": feature.Trail_Feature, "count": feature_counts[feature.Trail_FeatureID]}
+            for feature in features
+        ],
+        key=lambda item: item["count"],
+        reverse=True
+    )
+
+    return facets, 200
+
+if __name__ == "__main__":
+    if "--rebuild" in sys.argv:
+        with app.app_context():
+            count = rebuild_facets()
+            db.session.commit()
+            print(f"Rebuilt {count} facet counts.")
+    else:
+        print("Usage: python facets.py --rebuild")
@@ -0,0 +1,221 @@
+import threading
+from collections import namedtuple
+import numpy as np
+from sqlalchemy.orm import Session
+from config import db
+from models import Trail, LocationPoint, TrailLocationPt
+from invalidation import subscribe
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = np.pi * EARTH_RADIUS_KM / 180
+
+# SQL Server caps a statement at 2100 parameters, so IN lists are chunked
+TRAIL_ID_CHUNK = 1000
+
+# A trail's points in Order_no order, as parallel arrays
+TrailSequence = namedtuple("TrailSequence", "trail_id name point_ids order_nos lat lon")
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    # Vectorised great-circle distance; arguments broadcast like any NumPy arrays
+    lat1, lon1, lat2, lon2 = (np.radians(value) for value in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def segment_lengths_km(sequence):
+    return haversine_km(sequence.lat[:-1], sequence.lon[:-1], sequence.lat[1:], sequence.lon[1:])
+
+def project_to_segments(lat, lon, a_lat, a_lon, b_lat, b_lon):
+    # Distance (km) from each point to each paired segment and how far along the
+    # segment (0-1) the nearest point is. Uses a flat projection around each point,
+    # which is accurate over the few kilometres a segment spans.
+    kx = np.cos(np.radians(lat)) * KM_PER_DEGREE
+    ax = (a_lon - lon) * kx
+    ay = (a_lat - lat) * KM_PER_DEGREE
+    dx = (b_lon - a_lon) * kx
+    dy = (b_lat - a_lat) * KM_PER_DEGREE
+    length_sq = dx * dx + dy * dy
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = np.where(length_sq > 0, -(ax * dx + ay * dy) / length_sq, 0.0)
+    t = np.clip(t, 0.0, 1.0)
+    return np.hypot(ax + t * dx, ay + t * dy), t
+
+# Grid cells for the spatial indexes, about 1.1 km north-south
+CELL_DEGREES = 0.01
+CELL_KEY_SPAN = 40000
+
+def cell_of(lat, lon):
+    return np.floor(np.asarray(lat) / CELL_DEGREES).astype(np.int64), np.floor(np.asarray(lon) / CELL_DEGREES).astype(np.int64)
+
+def cell_key(cell_i, cell_j):
+    # One int64 per cell, so cells can be sorted and searched as a flat array
+    return (cell_i + CELL_KEY_SPAN // 2) * CELL_KEY_SPAN + (cell_j + CELL_KEY_SPAN // 2)
+
+def expand_ranges(starts, counts):
+    # For ranges [start, start + count), the owning range of every element and the element itself
+    owners = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)
+    return owners, np.repeat(starts, counts) + offsets
+
+def grid_index(min_lat, min_lon, max_lat, max_lon):
+    # Sorted (cell keys, item numbers) for every cell each bounding box overlaps
+    i0, j0 = cell_of(min_lat, min_lon)
+    i1, j1 = cell_of(max_lat, max_lon)
+    columns = j1 - j0 + 1
+    items, offsets = expand_ranges(np.zeros(len(i0), dtype=np.int64), (i1 - i0 + 1) * columns)
+    keys = cell_key(i0[items] + offsets // columns[items], j0[items] + offsets % columns[items])
+    order = np.argsort(keys, kind="stable")
+    return keys[order], items[order]
+
+def grid_lookup(cell_keys, cell_items, lat, lon, radius_km):
+    # (query number, item number) pairs for the items in cells within radius_km of each query point
+    i, j = cell_of(lat, lon)
+    reach_i = int(np.ceil(radius_km / (CELL_DEGREES * KM_PER_DEGREE)))
+    widest = max(np.cos(np.radians(np.max(np.abs(lat)))), 0.01)
+    reach_j = int(np.ceil(radius_km / (CELL_DEGREES * KM_PER_DEGREE * widest)))
+    di, dj = np.meshgrid(np.arange(-reach_i, reach_i + 1), np.arange(-reach_j, reach_j + 1), indexing="ij")
+    keys = cell_key(i[:, None] + di.ravel(), j[:, None] + dj.ravel())
+
+    left = np.searchsorted(cell_keys, keys.ravel(), side="left")
+    right = np.searchsorted(cell_keys, keys.ravel(), side="right")
+    owners, positions = expand_ranges(left, right - left)
+    queries = owners // keys.shape[1]
+    items = cell_items[positions]
+
+    # An item spanning several nearby cells is found more than once
+    span = int(cell_items.max(initial=0)) + 1
+    pairs = np.unique(queries * span + items)
+    return pairs // span, pairs % span
+
+def load_trail_sequences(session, trail_ids=None):
+    # Every trail's ordered points in one query (or one per chunk of trail_ids)
+    if trail_ids is None:
+        chunks = [None]
+    else:
+        trail_ids = sorted(trail_ids)
+        chunks = [trail_ids[start:start + TRAIL_ID_CHUNK] for start in range(0, len(trail_ids), TRAIL_ID_CHUNK)]
+
+    names = {}
+    rows = {}
+    for chunk in chunks:
+        trail_query = session.query(Trail.TrailID, Trail.Trail_name)
+        point_query = session.query(
+            TrailLocationPt.TrailID, TrailLocationPt.Location_Point, TrailLocationPt.Order_no,
+            LocationPoint.Latitude, LocationPoint.Longitude
+        ).join(
+            LocationPoint, LocationPoint.Location_Point == TrailLocationPt.Location_Point
+        ).order_by(TrailLocationPt.TrailID, TrailLocationPt.Order_no)
+
+        if chunk is not None:
+            trail_query = trail_query.filter(Trail.TrailID.in_(chunk))
+            point_query = point_query.filter(TrailLocationPt.TrailID.in_(chunk))
+
+        names.update(trail_query.all())
+        for trail_id, point_id, order_no, latitude, longitude in point_query.all():
+            rows.setdefault(trail_id, []).append((point_id, order_no, latitude, longitude))
+
+    sequences = {}
+    for trail_id, name in names.items():
+        points = rows.get(trail_id, [])
+        sequences[trail_id] = TrailSequence(
+            trail_id=trail_id,
+            name=name,
+            point_ids=np.array([point[0] for point in points], dtype=np.int64),
+            order_nos=np.array([point[1] for point in points], dtype=np.int64),
+            lat=np.array([point[2] for point in points], dtype=np.float64),
+            lon=np.array([point[3] for point in points], dtype=np.float64),
+        )
+    return sequences
+
+class TrailSequenceStore:
+    # Ordered point sequences of every trail, kept in memory. Invalidations only mark
+    # trails dirty; the next reader reloads just those from the primary. Indexes built
+    # on top ask changed_since() which trails they need to rebuild.
+    def __init__(self):
+        self.sequences = {}
+        self.point_trails = {}
+        self.version = 0
+        self.changed = {}
+        self.reset_version = None
+        self.dirty = set()
+        self.reload_all = True
+        self.lock = threading.RLock()
+        subscribe(self.on_invalidate)
+
+    def on_invalidate(self, topic, keys):
+        with self.lock:
+            if topic not in ("trail", "location_point"):
+                return
+            if not keys:
+                self.reload_all = True
+            elif topic == "trail":
+                self.dirty.update(keys)
+            else:
+                for point_id in keys:
+                    self.dirty.update(self.point_trails.get(point_id, ()))
+
+    def refresh(self):
+        # Returns (version, sequences), reloading whatever has been invalidated first.
+        # The sequences dict is replaced rather than changed, so callers can keep it.
+        with self.lock:
+            if not self.reload_all and not self.dirty:
+                return self.version, self.sequences
+
+            previous = self.sequences
+            # On a connection of its own to the primary, so only committed trails are loaded
+            with Session(db.engine) as session:
+                if self.reload_all:
+                    loaded = load_trail_sequences(session)
+                    changed = set(previous) | set(loaded)
+                    sequences = loaded
+                    self.point_trails = {}
+                else:
+                    loaded = load_trail_sequences(session, self.dirty)
+                    changed = set(self.dirty)
+                    sequences = dict(previous)
+
+            for trail_id in changed:
+                if not self.reload_all:
+                    self.unlink_points(previous.get(trail_id))
+                    # Trails missing from the reload have been deleted
+                    if trail_id in loaded:
+                        sequences[trail_id] = loaded[trail_id]
+                    else:
+                        sequences.pop(trail_id, None)
+                self.link_points(sequences.get(trail_id))
+
+            self.version += 1
+            if self.reload_all:
+                self.reset_version = self.version
+                self.changed = {}
+            for trail_id in changed:
+                self.changed[trail_id] = self.version
+            self.sequences = sequences
+            self.reload_all = False
+            self.dirty = set()
+            return self.version, self.sequences
+
+    def link_points(self, sequence):
+        if sequence is None:
+            return
+        for point_id in sequence.point_ids.tolist():
+            self.point_trails.setdefault(point_id, set()).add(sequence.trail_id)
+
+    def unlink_points(self, sequence):
+        if sequence is None:
+            return
+        for point_id in sequence.point_ids.tolist():
+            trails = self.point_trails.get(point_id)
+            if trails:
+                trails.discard(sequence.trail_id)
+                if not trails:
+                    del self.point_trails[point_id]
+
+    def changed_since(self, version):
+        # Trail IDs changed after `version`, or None if everything must be rebuilt
+        with self.lock:
+            if version is None or (self.reset_version is not None and self.reset_version > version):
+                return None
+            return {trail_id for trail_id, changed_at in self.changed.items() if changed_at > version}
+
+# Shared by the trail matching, route planning and similarity indexes
+trail_sequences = TrailSequenceStore()
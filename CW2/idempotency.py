@@ -0,0 +1,118 @@
+import hashlib
+import time
+from datetime import timedelta
+from functools import wraps
+from flask import abort, current_app, g, has_request_context, request
+from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import HTTPException
+from config import db
+from models import IdempotencyKey, london_now
+from authentication import authenticate_user
+from transactions import commit_changes
+from invalidation import discard_pending
+import metrics
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 255
+
+# Expired keys are deleted at most this often per worker, in the transaction of a
+# write that stores a new one
+PURGE_INTERVAL = 60.0
+
+_next_purge = 0.0
+
+def request_hash():
+    # The same key sent with a different request is a client bug, not a retry
+    digest = hashlib.sha256()
+    for part in (request.method, request.path, request.query_string.decode()):
+        digest.update(part.encode() + b"\0")
+    digest.update(request.get_data(cache=True))
+    return digest.hexdigest()
+
+def find_record(client, key):
+    record = db.session.get(IdempotencyKey, (client, key))
+    if record is not None and record.expires < london_now().replace(tzinfo=None):
+        # Expired but not purged yet; removed so the key can be stored again
+        db.session.delete(record)
+        db.session.flush()
+        return None
+    return record
+
+def replay(record, key, digest):
+    if record.Request_hash != digest:
+        abort(422, f"{IDEMPOTENCY_HEADER} {key} was already used for a different request.")
+    metrics.increment("idempotency.replayed")
+    print(f"DEBUG: Replaying the stored response for {IDEMPOTENCY_HEADER} {key}.")
+    response = current_app.response_class(record.Response_body, status=record.Status_code)
+    response.headers["Content-Type"] = record.Content_type
+    if record.ETag:
+        response.headers["ETag"] = record.ETag
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+def purge_expired():
+    global _next_purge
+    now = time.monotonic()
+    if now < _next_purge:
+        return
+    _next_purge = now + PURGE_INTERVAL
+    purged = IdempotencyKey.query.filter(
+        IdempotencyKey.expires < london_now().replace(tzinfo=None)
+    ).delete(synchronize_session=False)
+    if purged:
+        metrics.increment("idempotency.purged", purged)
+
+def idempotent(handler):
+    # With an Idempotency-Key header the response to a successful write is stored in
+    # the same transaction as the write, and a retry with the same key gets it back
+    # without the handler running again. Concurrent retries both run, but only one
+    # can commit the key; the other rolls back and replays the winner's response.
+    @wraps(handler)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER) if has_request_context() else None
+        # Inside a batch the batch's own transaction decides what is committed
+        if not key or g.get("defer_commit"):
+            return handler(*args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            abort(400, f"{IDEMPOTENCY_HEADER} must be at most {MAX_KEY_LENGTH} characters.")
+
+        # Keys are per client, so one client cannot replay another's response
+        client = authenticate_user()["email"]
+        digest = request_hash()
+        record = find_record(client, key)
+        if record is not None:
+            return replay(record, key, digest)
+
+        # Handlers only flush, so the stored response commits together with the write
+        g.defer_commit = True
+        try:
+            response = current_app.make_response(handler(*args, **kwargs))
+            if 200 <= response.status_code < 300:
+                db.session.add(IdempotencyKey(
+                    Client=client,
+                    Key=key,
+                    Request_hash=digest,
+                    Status_code=response.status_code,
+                    Content_type=response.content_type,
+                    Response_body=response.get_data(as_text=True),
+                    ETag=response.headers.get("ETag"),
+                    expires=(london_now() + timedelta(seconds=current_app.config["IDEMPOTENCY_TTL_SECONDS"])).replace(tzinfo=None),
+                ))
+                purge_expired()
+                metrics.increment("idempotency.stored")
+            g.defer_commit = False
+            commit_changes()
+        except (HTTPException, IntegrityError):
+            # A concurrent retry with the same key may have committed first, and this
+            # one then ran into the rows it wrote ("trail already exists") or its key
+            db.session.rollback()
+            discard_pending()
+            record = find_record(client, key)
+            if record is None:
+                raise
+            return replay(record, key, digest)
+        finally:
+            g.defer_commit = False
+        return response
+
+    return wrapper
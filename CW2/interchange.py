@@ -0,0 +1,505 @@
+import itertools
+import json
+from xml.etree.ElementTree import iterparse, ParseError
+from xml.sax.saxutils import escape, quoteattr
+from flask import Response, abort, request, stream_with_context
+from sqlalchemy import insert, select
+from config import app, db
+from models import (
+    Trail, LocationPoint, TrailLocationPt, Feature, TrailFeature, coordinate_key, london_now
+)
+from authentication import require_auth, require_auth_and_role
+from transactions import commit_changes
+from invalidation import invalidate
+from changes import mark_changed
+from admission import admission_control
+from profiling import profiled
+from trails import calculate_distance, check_coordinates
+from readmodel import read_model
+import facets
+import metrics
+
+# Optional dependency: without ijson a GeoJSON file is read into memory whole
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Points are looked up and inserted this many at a time. SQL Server caps a statement
+# at 2100 parameters, so this also bounds the IN lists.
+IMPORT_BATCH = 1000
+
+# Points are exported in chunks of this many, so a response is a few hundred
+# writes rather than one per point
+EXPORT_CHUNK = 1000
+
+# Each point of an imported trail must be within this distance of the one before it
+MAX_DISTANCE = 10.0
+
+# Imports hold a transaction open for the whole file, so only a few run at once
+IMPORT_CONCURRENCY = 2
+
+GPX_MIMETYPE = "application/gpx+xml"
+GEOJSON_MIMETYPE = "application/geo+json"
+GPX_NAMESPACE = "http://www.topografix.com/GPX/1/1"
+
+# Trail columns an imported file can set; the query string fills in anything it leaves out
+IMPORT_FIELDS = ("Trail_name", "Trail_Summary", "Trail_Description", "Difficulty", "Location", "Route_type")
+REQUIRED_FIELDS = ("Trail_name", "Difficulty", "Location", "Route_type")
+IMPORT_PARAMS = {
+    "name": "Trail_name",
+    "summary": "Trail_Summary",
+    "description": "Trail_Description",
+    "difficulty": "Difficulty",
+    "location": "Location",
+    "route_type": "Route_type",
+}
+
+# Trail elements in a GPX file and what they map to
+GPX_TRAILS = ("trk", "rte")
+GPX_POINTS = ("trkpt", "rtept")
+GPX_FIELDS = {"name": "Trail_name", "cmt": "Trail_Summary", "desc": "Trail_Description", "type": "Route_type"}
+
+# GeoJSON properties written by other tools, besides the trail column names
+GEOJSON_FIELDS = dict({field: field for field in IMPORT_FIELDS}, name="Trail_name", description="Trail_Description")
+
+JSON_ERRORS = (ValueError, ijson.JSONError) if ijson else (ValueError,)
+
+def local_name(tag):
+    # "{http://www.topografix.com/GPX/1/1}trkpt" -> "trkpt", for GPX 1.0 and 1.1 alike
+    return tag.rpartition("}")[2]
+
+def parse_number(value, name):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        abort(400, f"Invalid {name}: {value!r}")
+
+def gpx_events(stream):
+    # Trails, their fields and their points in file order, read incrementally.
+    # iterparse keeps everything it has read attached to the tree, so each point
+    # and trail is detached from its parent once read to keep memory flat.
+    parents = []
+    try:
+        for event, element in iterparse(stream, events=("start", "end")):
+            name = local_name(element.tag)
+            if event == "start":
+                parents.append(element)
+                if name in GPX_TRAILS:
+                    yield ("start",)
+                continue
+
+            parents.pop()
+            parent = local_name(parents[-1].tag) if parents else None
+            if name in GPX_POINTS:
+                children = {local_name(child.tag): (child.text or "").strip() for child in element}
+                yield (
+                    "point",
+                    parse_number(element.get("lat"), "latitude"),
+                    parse_number(element.get("lon"), "longitude"),
+                    parse_number(children["ele"], "elevation") if children.get("ele") else None,
+                    children.get("desc") or children.get("name") or None,
+                )
+                parents[-1].remove(element)
+            elif name in GPX_TRAILS:
+                yield ("end",)
+                if parents:
+                    parents[-1].remove(element)
+            elif name in GPX_FIELDS and parent in GPX_TRAILS:
+                yield ("field", GPX_FIELDS[name], (element.text or "").strip())
+    except ParseError as error:
+        abort(400, f"Invalid GPX file: {error}")
+
+def json_events(value, prefix=""):
+    # The (prefix, event, value) events ijson.parse gives, for an already loaded document
+    if isinstance(value, dict):
+        yield prefix, "start_map", None
+        for key, item in value.items():
+            yield from json_events(item, f"{prefix}.{key}" if prefix else key)
+        yield prefix, "end_map", None
+    elif isinstance(value, list):
+        yield prefix, "start_array", None
+        for item in value:
+            yield from json_events(item, f"{prefix}.item" if prefix else "item")
+        yield prefix, "end_array", None
+    elif value is None or isinstance(value, bool):
+        yield prefix, "null" if value is None else "boolean", value
+    else:
+        yield prefix, "number" if isinstance(value, (int, float)) else "string", value
+
+def geojson_events(stream):
+    # Accepts a FeatureCollection (a trail per feature), a single Feature or a bare
+    # LineString / MultiLineString. Coordinates are [longitude, latitude, elevation?].
+    try:
+        events = ijson.parse(stream, use_float=True) if ijson else json_events(json.load(stream))
+        coordinate = []
+        for prefix, event, value in events:
+            if prefix in ("", "features.item"):
+                if event == "start_map":
+                    yield ("start",)
+                elif event == "end_map":
+                    yield ("end",)
+                continue
+
+            path = prefix[len("features.item."):] if prefix.startswith("features.item.") else prefix
+            if path.startswith("properties.") and event in ("string", "number"):
+                field = GEOJSON_FIELDS.get(path[len("properties."):])
+                if field:
+                    yield ("field", field, str(value))
+            elif path.startswith(("geometry.coordinates", "coordinates")):
+                if event == "number":
+                    coordinate.append(value)
+                elif event == "end_array" and coordinate:
+                    if len(coordinate) < 2:
+                        abort(400, f"Invalid GeoJSON position: {coordinate}")
+                    yield ("point", coordinate[1], coordinate[0], coordinate[2] if len(coordinate) > 2 else None, None)
+                    coordinate = []
+    except JSON_ERRORS as error:
+        abort(400, f"Invalid GeoJSON file: {error}")
+
+PARSERS = {"gpx": gpx_events, "geojson": geojson_events}
+
+class TrailImport:
+    # One trail being read from a file. Its row is created with the first point so
+    # points can be linked as they arrive; fields that come later in the file are
+    # filled in by finish(). Only the current batch of points is held in memory.
+    def __init__(self, defaults, owner_id):
+        self.defaults = defaults
+        self.owner_id = owner_id
+        self.fields = {}
+        self.trail = None
+        self.pending = []
+        self.previous = None
+        self.elevation = None
+        self.point_count = 0
+        self.new_points = 0
+        self.skipped_points = 0
+        self.length_km = 0.0
+        self.elevation_gain = 0.0
+
+    def set_field(self, field, value):
+        if value:
+            self.fields[field] = value
+
+    def add_point(self, latitude, longitude, elevation, description):
+        check_coordinates(latitude, longitude)
+
+        if self.previous is not None:
+            prev_lat, prev_lon = self.previous
+            distance = calculate_distance(prev_lat, prev_lon, latitude, longitude)
+            if distance > MAX_DISTANCE:
+                abort(400, {
+                    "detail": f"Location point exceeds the maximum distance of {MAX_DISTANCE} km from the point before it.",
+                    "from": {"Latitude": prev_lat, "Longitude": prev_lon},
+                    "to": {"Latitude": latitude, "Longitude": longitude},
+                    "distance_km": round(distance, 2),
+                })
+            self.length_km += distance
+        self.previous = (latitude, longitude)
+        if elevation is not None:
+            if self.elevation is not None and elevation > self.elevation:
+                self.elevation_gain += elevation - self.elevation
+            self.elevation = elevation
+
+        if self.trail is None:
+            # Placeholders until finish(); the row is not visible before the commit
+            self.trail = Trail(
+                Trail_name="", Difficulty="", Location="", Route_type="",
+                Length=0, Elevation_gain=0, OwnerID=self.owner_id,
+            )
+            db.session.add(self.trail)
+            db.session.flush()
+
+        self.pending.append({
+            "Latitude": latitude,
+            "Longitude": longitude,
+            "Description": description[:255] if description else None,
+            "Coord_key": coordinate_key(latitude, longitude),
+        })
+        if len(self.pending) >= IMPORT_BATCH:
+            self.write_batch()
+
+    def write_batch(self):
+        rows, self.pending = self.pending, []
+        if not rows:
+            return
+
+        # Reuse points that already exist, insert the rest in one statement
+        point_ids = dict(
+            db.session.query(LocationPoint.Coord_key, LocationPoint.Location_Point)
+            .filter(LocationPoint.Coord_key.in_({row["Coord_key"] for row in rows}))
+            .all()
+        )
+        new_rows = {}
+        for row in rows:
+            if row["Coord_key"] not in point_ids and row["Coord_key"] not in new_rows:
+                new_rows[row["Coord_key"]] = dict(row, timestamp=london_now())
+        if new_rows:
+            inserted = db.session.execute(
+                insert(LocationPoint).returning(LocationPoint.Coord_key, LocationPoint.Location_Point),
+                list(new_rows.values()),
+            ).all()
+            point_ids.update(inserted)
+            self.new_points += len(inserted)
+            mark_changed(LocationPoint, [point_id for _, point_id in inserted], created=True)
+            invalidate("location_point", *[point_id for _, point_id in inserted])
+
+        # A trail passes through a point at most once, so a track that comes back to
+        # the same spot keeps only its first visit
+        linked = {
+            point_id for (point_id,) in db.session.query(TrailLocationPt.Location_Point).filter(
+                TrailLocationPt.TrailID == self.trail.TrailID,
+                TrailLocationPt.Location_Point.in_({point_ids[row["Coord_key"]] for row in rows}),
+            )
+        }
+        links = []
+        for row in rows:
+            point_id = point_ids[row["Coord_key"]]
+            if point_id in linked:
+                self.skipped_points += 1
+                continue
+            linked.add(point_id)
+            self.point_count += 1
+            links.append({"TrailID": self.trail.TrailID, "Location_Point": point_id, "Order_no": self.point_count})
+        if links:
+            db.session.execute(insert(TrailLocationPt), links)
+        metrics.increment("interchange.points_imported", len(rows))
+
+    def finish(self):
+        if self.trail is None:
+            if self.fields:
+                abort(400, f"Trail {self.fields.get('Trail_name', '')!r} has no location points.")
+            # Nothing read, e.g. the FeatureCollection wrapping the trails
+            return None
+        self.write_batch()
+
+        values = dict(self.defaults, **self.fields)
+        for field in REQUIRED_FIELDS:
+            if not values.get(field):
+                abort(400, f"Missing required field: {field}. Set it in the file or with the {field_param(field)} query parameter.")
+        for field, value in values.items():
+            max_length = Trail.__table__.c[field].type.length
+            if len(value) > max_length:
+                abort(400, f"{field} is longer than {max_length} characters.")
+
+        existing = Trail.query.filter(Trail.Trail_name == values["Trail_name"], Trail.TrailID != self.trail.TrailID).first()
+        if existing:
+            abort(406, f"Trail with name {values['Trail_name']} already exists.")
+
+        for field, value in values.items():
+            setattr(self.trail, field, value)
+        self.trail.Length = round(self.length_km, 2)
+        self.trail.Elevation_gain = round(self.elevation_gain, 1)
+        db.session.flush()
+        facets.trail_added(self.trail)
+        invalidate("trail", self.trail.TrailID)
+
+        return {
+            "TrailID": self.trail.TrailID,
+            "Trail_name": self.trail.Trail_name,
+            "Length": self.trail.Length,
+            "Elevation_gain": self.trail.Elevation_gain,
+            "points": self.point_count,
+            "new_points": self.new_points,
+            "skipped_points": self.skipped_points,
+        }
+
+def field_param(field):
+    return next(param for param, name in IMPORT_PARAMS.items() if name == field)
+
+def request_format():
+    file_format = request.args.get("format")
+    if not file_format:
+        mimetype = request.mimetype
+        if mimetype in (GPX_MIMETYPE, "application/xml", "text/xml"):
+            file_format = "gpx"
+        elif mimetype in (GEOJSON_MIMETYPE, "application/json"):
+            file_format = "geojson"
+    if file_format not in PARSERS:
+        abort(415, "Send a GPX or GeoJSON file, or set format=gpx or format=geojson.")
+    return file_format
+
+def import_trails():
+    # POST /api/trails/import: the request body is read as a stream, never as a whole
+    user = require_auth_and_role("admin")
+    if app.config["SNAPSHOT_FILE"]:
+        abort(501, "Importing needs the database; this server only serves a read-only snapshot.")
+    parser = PARSERS[request_format()]
+    defaults = {field: request.args[param] for param, field in IMPORT_PARAMS.items() if request.args.get(param)}
+
+    imported = []
+    current = None
+    for event in parser(request.stream):
+        kind = event[0]
+        if kind == "start":
+            if current is not None:
+                result = current.finish()
+                if result:
+                    imported.append(result)
+            current = TrailImport(defaults, user["UserID"])
+        elif kind == "end":
+            if current is not None:
+                result = current.finish()
+                if result:
+                    imported.append(result)
+            current = None
+        elif kind == "field":
+            current.set_field(event[1], event[2])
+        else:
+            current.add_point(*event[1:])
+
+    if not imported:
+        abort(400, "No trails with location points found in the file.")
+
+    commit_changes()
+    metrics.increment("interchange.trails_imported", len(imported))
+    print(f"DEBUG: Imported {len(imported)} trail(s) with {sum(t['points'] for t in imported)} points.")
+    return {"trails": imported}, 201
+
+# connexion reads the whole request body before calling a handler, so the import is a
+# plain Flask route, given the same admission control and profiling as the API
+app.add_url_rule(
+    "/api/trails/import",
+    "interchange.import_trails",
+    admission_control(
+        "interchange.import_trails",
+        {
+            "bucket": "default",
+            "rate": app.config["RATE_LIMIT_PER_SECOND"],
+            "burst": app.config["RATE_LIMIT_BURST"],
+            "limit": IMPORT_CONCURRENCY,
+            "queue": app.config["CONCURRENCY_QUEUE"],
+            "timeout": app.config["CONCURRENCY_QUEUE_TIMEOUT"],
+        },
+        profiled("interchange.import_trails", import_trails),
+    ),
+    methods=["POST"],
+)
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+EXPORT_COLUMNS = (
+    "TrailID", "Trail_name", "Trail_Summary", "Trail_Description", "Difficulty", "Location",
+    "Length", "Elevation_gain", "Route_type",
+)
+
+def exported_trails(trail_id=None):
+    # Each trail with an iterator over its points. Trail rows are read up front (one
+    # per trail); points are streamed from a single query ordered by trail, so no
+    # second query runs while its cursor is open.
+    if app.config["SNAPSHOT_FILE"]:
+        yield from read_model.current().exported_trails(EXPORT_COLUMNS, trail_id)
+        return
+
+    trail_query = db.session.query(*[getattr(Trail, column) for column in EXPORT_COLUMNS]).order_by(Trail.TrailID)
+    point_query = (
+        select(
+            TrailLocationPt.TrailID, LocationPoint.Latitude, LocationPoint.Longitude,
+            LocationPoint.Description,
+        )
+        .join(LocationPoint, LocationPoint.Location_Point == TrailLocationPt.Location_Point)
+        .order_by(TrailLocationPt.TrailID, TrailLocationPt.Order_no)
+        .execution_options(yield_per=EXPORT_CHUNK)
+    )
+    feature_query = (
+        db.session.query(TrailFeature.TrailID, Feature.Trail_Feature)
+        .join(Feature, Feature.Trail_FeatureID == TrailFeature.Trail_FeatureID)
+        .order_by(TrailFeature.TrailID, Feature.Trail_Feature)
+    )
+    if trail_id is not None:
+        trail_query = trail_query.filter(Trail.TrailID == trail_id)
+        point_query = point_query.where(TrailLocationPt.TrailID == trail_id)
+        feature_query = feature_query.filter(TrailFeature.TrailID == trail_id)
+
+    trails = [dict(zip(EXPORT_COLUMNS, row)) for row in trail_query.all()]
+    features = {}
+    for feature_trail_id, name in feature_query.all():
+        features.setdefault(feature_trail_id, []).append(name)
+
+    groups = itertools.groupby(db.session.execute(point_query), key=lambda row: row[0])
+    group = next(groups, None)
+    for trail in trails:
+        trail["Features"] = features.get(trail["TrailID"], [])
+        while group is not None and group[0] < trail["TrailID"]:
+            group = next(groups, None)
+        if group is not None and group[0] == trail["TrailID"]:
+            yield trail, (row[1:] for row in group[1])
+            group = next(groups, None)
+        else:
+            yield trail, iter(())
+
+def gpx_text(tag, value, indent):
+    return f"{indent}<{tag}>{escape(value)}</{tag}>\n" if value else ""
+
+def write_gpx(trails):
+    yield (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<gpx version="1.1" creator="CW2 Trails API" xmlns="{GPX_NAMESPACE}">\n'
+    )
+    for trail, points in trails:
+        yield "".join([
+            "  <trk>\n",
+            gpx_text("name", trail["Trail_name"], "    "),
+            gpx_text("cmt", trail["Trail_Summary"], "    "),
+            gpx_text("desc", trail["Trail_Description"], "    "),
+            gpx_text("type", trail["Route_type"], "    "),
+            "    <trkseg>\n",
+        ])
+        for chunk in chunked(points, EXPORT_CHUNK):
+            yield "".join(
+                f'      <trkpt lat="{latitude!r}" lon="{longitude!r}">'
+                + (f"<desc>{escape(description)}</desc>" if description else "")
+                + "</trkpt>\n"
+                for latitude, longitude, description in chunk
+            )
+        yield "    </trkseg>\n  </trk>\n"
+    yield "</gpx>\n"
+
+def write_geojson(trails, collection=True):
+    # A FeatureCollection, or a single Feature for one trail
+    if collection:
+        yield '{"type": "FeatureCollection", "features": [\n'
+    for index, (trail, points) in enumerate(trails):
+        separator = ",\n" if index else ""
+        yield (
+            f'{separator}{{"type": "Feature", "id": {trail["TrailID"]}, "properties": {json.dumps(trail)}, '
+            '"geometry": {"type": "LineString", "coordinates": ['
+        )
+        for chunk_index, chunk in enumerate(chunked(points, EXPORT_CHUNK)):
+            yield ("," if chunk_index else "") + ",".join(
+                f"[{longitude!r},{latitude!r}]" for latitude, longitude, _ in chunk
+            )
+        yield "]}}"
+    yield "\n]}\n" if collection else "\n"
+
+WRITERS = {"gpx": (write_gpx, GPX_MIMETYPE, "gpx"), "geojson": (write_geojson, GEOJSON_MIMETYPE, "geojson")}
+
+def export_response(file_format, body, filename):
+    _, mimetype, extension = WRITERS[file_format]
+    metrics.increment(f"interchange.export.{file_format}")
+    response = Response(stream_with_context(body), mimetype=mimetype)
+    response.headers["Content-Disposition"] = f"attachment; filename={quoteattr(f'{filename}.{extension}')}"
+    return response
+
+def export_trails(format="gpx"):
+    require_auth()
+    writer = WRITERS[format][0]
+    return export_response(format, writer(exported_trails()), "trails")
+
+def export_trail(trail_id, format="gpx"):
+    require_auth()
+    if app.config["SNAPSHOT_FILE"]:
+        exists = read_model.current().trail(trail_id) is not None
+    else:
+        exists = Trail.query.filter(Trail.TrailID == trail_id).one_or_none() is not None
+    if not exists:
+        abort(404, f"Trail with ID {trail_id} not found.")
+    trails = exported_trails(trail_id)
+    body = write_gpx(trails) if format == "gpx" else write_geojson(trails, collection=False)
+    return export_response(format, body, f"trail-{trail_id}")
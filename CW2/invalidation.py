@@ -0,0 +1,212 @@
+import atexit
+import glob
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from flask import g, has_app_context
+import metrics
+
+# Identifies this worker so it can ignore its own messages coming back from the bus
+WORKER_ID = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+# A message must fit in one datagram for the socket backend, and past a few thousand
+# keys reloading a topic is cheaper for subscribers than looking each key up
+MAX_INVALIDATION_KEYS = 5000
+
+# Callbacks taking (topic, keys); keys is a list of IDs, or None for "everything"
+_subscribers = []
+_backend = None
+_backend_pid = None
+_backend_lock = threading.Lock()
+
+class InMemoryBackend:
+    # Single process: publish() already delivers to local subscribers
+    def start(self, on_message):
+        pass
+
+    def publish(self, message):
+        pass
+
+class SocketBackend:
+    # Several workers on one host: every worker binds a Unix datagram socket in a
+    # shared directory and publishers send to each socket they find there
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, f"{WORKER_ID}.sock")
+        self.sock = None
+
+    def start(self, on_message):
+        os.makedirs(self.directory, exist_ok=True)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        atexit.register(self._remove_socket)
+        threading.Thread(target=self._listen, args=(on_message,), daemon=True).start()
+
+    def _remove_socket(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _listen(self, on_message):
+        while True:
+            data = self.sock.recv(65536)
+            on_message(data)
+
+    def publish(self, message):
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sender.setblocking(False)
+        try:
+            for path in glob.glob(os.path.join(self.directory, "*.sock")):
+                if path == self.path:
+                    continue
+                try:
+                    sender.sendto(message, path)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # The worker that owned this socket has exited
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+                except BlockingIOError:
+                    metrics.increment("invalidation.dropped")
+        finally:
+            sender.close()
+
+class RedisBackend:
+    # Several hosts: Redis (or any server speaking its pub/sub protocol)
+    def __init__(self, url, channel="cw2-invalidation"):
+        import redis  # optional dependency, only needed for this backend
+
+        self.client = redis.Redis.from_url(url)
+        self.channel = channel
+
+    def start(self, on_message):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel)
+        threading.Thread(target=self._listen, args=(pubsub, on_message), daemon=True).start()
+
+    def _listen(self, pubsub, on_message):
+        for message in pubsub.listen():
+            on_message(message["data"])
+
+    def publish(self, message):
+        self.client.publish(self.channel, message)
+
+def create_backend(name, url):
+    if name == "memory":
+        return InMemoryBackend()
+    if name == "socket":
+        return SocketBackend(url)
+    if name == "redis":
+        return RedisBackend(url)
+    raise ValueError(f"Unknown invalidation backend: {name}")
+
+def subscribe(callback):
+    _subscribers.append(callback)
+
+def deliver(topic, keys):
+    for callback in list(_subscribers):
+        try:
+            callback(topic, keys)
+        except Exception as error:
+            print(f"DEBUG: Invalidation subscriber failed for topic {topic}: {error}")
+
+def on_message(data):
+    message = json.loads(data)
+    if message["origin"] == WORKER_ID:
+        return
+    metrics.increment("invalidation.received")
+    deliver(message["topic"], message["keys"])
+
+def ensure_started(app):
+    # Start the backend lazily in each process, so forked workers get their own listener
+    global _backend, _backend_pid
+    if _backend_pid == os.getpid():
+        return
+
+    with _backend_lock:
+        if _backend_pid == os.getpid():
+            return
+        _backend = create_backend(app.config["INVALIDATION_BACKEND"], app.config["INVALIDATION_URL"])
+        _backend.start(on_message)
+        _backend_pid = os.getpid()
+
+def publish(topic, keys=None):
+    # Local subscribers are updated straight away, other workers through the backend
+    deliver(topic, keys)
+    metrics.increment("invalidation.published")
+    if _backend is not None and _backend_pid == os.getpid():
+        _backend.publish(json.dumps({"origin": WORKER_ID, "topic": topic, "keys": keys}).encode())
+
+def invalidate(topic, *keys):
+    # Queue an invalidation to publish once the current transaction has committed.
+    # No keys, or more than MAX_INVALIDATION_KEYS, invalidates the whole topic.
+    pending = g.setdefault("pending_invalidations", {})
+    if topic in pending and pending[topic] is None:
+        return
+    if not keys:
+        pending[topic] = None
+        return
+    topic_keys = pending.setdefault(topic, set())
+    topic_keys.update(keys)
+    if len(topic_keys) > MAX_INVALIDATION_KEYS:
+        pending[topic] = None
+
+def publish_pending():
+    if not has_app_context():
+        return
+    pending = g.pop("pending_invalidations", {})
+    for topic, keys in pending.items():
+        publish(topic, sorted(keys) if keys is not None else None)
+
+def discard_pending():
+    if has_app_context():
+        g.pop("pending_invalidations", None)
+
+class LocalCache:
+    # Per-worker cache whose entries are dropped when one of its topics is published.
+    # Entries also expire after ttl seconds as a safety net.
+    def __init__(self, topics, ttl):
+        self.topics = set(topics)
+        self.ttl = ttl
+        self._entries = {}
+        self._generation = 0
+        subscribe(self._on_invalidate)
+
+    def _on_invalidate(self, topic, keys):
+        if topic in self.topics:
+            self._generation += 1
+            self._entries = {}
+
+    def get_or_compute(self, key, compute, stale_on=()):
+        # A batch reads its own uncommitted writes, which must not be cached
+        if has_app_context() and g.get("defer_commit"):
+            return compute()
+
+        entry = self._entries.get(key)
+        if entry and entry[1] > time.monotonic():
+            metrics.increment("local_cache.hit")
+            return entry[0]
+
+        # Don't store a value computed while an invalidation arrived, it may be stale
+        generation = self._generation
+        try:
+            value = compute()
+        except stale_on:
+            # Expired entries are kept until an invalidation drops them, so when
+            # compute fails with one of stale_on an expired value can still be used
+            if entry is None:
+                raise
+            metrics.increment("local_cache.stale")
+            return entry[0]
+        if generation == self._generation:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+        metrics.increment("local_cache.miss")
+        return value
+
+def init_app(app):
+    app.before_request(lambda: ensure_started(app))
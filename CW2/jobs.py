@@ -0,0 +1,371 @@
+import inspect
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+from datetime import timedelta
+from flask import abort, current_app, g, request
+from sqlalchemy import or_, update
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
+from werkzeug.exceptions import HTTPException
+from config import app, db
+from models import Job, User, london_now
+from authentication import require_auth, require_auth_and_role
+from transactions import commit_changes
+from progress import report_progress
+from invalidation import discard_pending, ensure_started, invalidate
+from build_database import build_database
+import facets
+import similarity
+import trails
+
+# A job whose worker crashed is retried until it has been started this many times
+MAX_ATTEMPTS = 3
+
+# Seconds between checks for new jobs when a worker is idle
+POLL_SECONDS = 1.0
+
+# Running jobs update their timestamp this often; a job that has not been updated for
+# STALE_SECONDS is assumed to belong to a dead worker and is queued again. Not on
+# SQLite, where a job's own transaction blocks its heartbeat; there only jobs of
+# workers seen to exit (or of this host, at startup) are queued again.
+HEARTBEAT_SECONDS = 10
+STALE_SECONDS = 60
+
+def import_trails():
+    # Body: {"trails": [...]}, each in the POST /trails format and committed on its own
+    require_auth_and_role("admin")
+    trails_data = (request.get_json() or {}).get("trails") or []
+    if not trails_data:
+        abort(400, "At least one trail is required.")
+
+    created = []
+    failed = []
+    for index, trail_data in enumerate(trails_data):
+        report_progress(index, len(trails_data))
+        with current_app.test_request_context(request.path, method="POST", json=trail_data):
+            try:
+                response = current_app.make_response(trails.create_trail())
+            except HTTPException as error:
+                db.session.rollback()
+                discard_pending()
+                failed.append({"index": index, "status": error.code, "detail": error.description})
+                continue
+        created.append(response.get_json()["TrailID"])
+
+    return {"created": created, "failed": failed}, 200
+
+def rebuild_facet_counts():
+    require_auth_and_role("admin")
+    rows = facets.rebuild_facets()
+    commit_changes()
+    return {"facet_rows": rows}, 200
+
+def rebuild_database():
+    require_auth_and_role("admin")
+    build_database(keep_jobs=True)
+
+    # Every cached trail, feature, point and user is now out of date
+    for topic in ("trail", "feature", "location_point", "user"):
+        invalidate(topic)
+    commit_changes()
+    return {"message": "Database rebuilt with sample data."}, 200
+
+# Operations that can be queued with POST /jobs; handlers check their own roles
+JOB_OPERATIONS = {
+    "create_trail": trails.create_trail,
+    "update_trail": trails.update_trail,
+    "delete_trail": trails.delete_trail,
+    "delete_feature_by_id": trails.delete_feature_by_id,
+    "import_trails": import_trails,
+    "rebuild_facets": rebuild_facet_counts,
+    "rebuild_database": rebuild_database,
+    "find_duplicates": similarity.find_duplicates,
+}
+
+def job_details(job):
+    return {
+        "JobID": job.JobID,
+        "Operation": job.Operation,
+        "Params": json.loads(job.Params),
+        "Status": job.Status,
+        "Progress": job.Progress,
+        "Result": json.loads(job.Result) if job.Result else None,
+        "Attempts": job.Attempts,
+        "created": job.created,
+        "started": job.started,
+        "finished": job.finished,
+    }
+
+def submit_job():
+    user = require_auth_and_role("admin")
+    if not user:
+        abort(403, "Unable to authenticate user.")
+
+    job_data = request.get_json()
+    if not job_data:
+        abort(400, "No data provided or invalid format.")
+
+    operation = job_data.get("operation")
+    handler = JOB_OPERATIONS.get(operation)
+    if not handler:
+        abort(400, f"Unknown operation '{operation}'.")
+
+    params = job_data.get("params") or {}
+    try:
+        inspect.signature(handler).bind(**params)
+    except TypeError as error:
+        abort(400, f"Invalid params: {error}")
+
+    job = Job(
+        Operation=operation,
+        Params=json.dumps(params),
+        Body=json.dumps(job_data["body"]) if "body" in job_data else None,
+        SubmittedBy=user["UserID"],
+    )
+    db.session.add(job)
+    commit_changes()
+
+    print(f"DEBUG: Queued job {job.JobID} ({operation}) for user {user['email']}")
+    return job_details(job), 202, {"Location": f"{request.script_root}/api/jobs/{job.JobID}"}
+
+def get_job(job_id):
+    user = require_auth()
+    if not user:
+        abort(401, "Authentication required.")
+
+    # Read from the primary: job rows change every few seconds while they run
+    job = db.session.get(Job, job_id)
+    if not job or (user["role"] != "admin" and job.SubmittedBy != user["UserID"]):
+        abort(404, f"Job with ID {job_id} not found.")
+
+    return job_details(job), 200
+
+def update_job(job_id, **values):
+    # Own connection and transaction, so progress is visible while the job's
+    # transaction is still open
+    with app.app_context():
+        with db.engine.begin() as connection:
+            connection.execute(update(Job).where(Job.JobID == job_id).values(**values))
+
+class ProgressWriter:
+    # Set as g.job_progress while a job runs; writes at most once a second
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.progress = 0
+        self.written_at = 0
+
+    def __call__(self, progress):
+        now = time.monotonic()
+        if progress <= self.progress or now - self.written_at < 1:
+            return
+        self.progress = progress
+        self.written_at = now
+        try:
+            update_job(self.job_id, Progress=progress)
+        except SQLAlchemyError as error:
+            print(f"DEBUG: Could not record progress of job {self.job_id}: {error}")
+
+class Heartbeat(threading.Thread):
+    def __init__(self, job_id):
+        super().__init__(daemon=True)
+        self.job_id = job_id
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(HEARTBEAT_SECONDS):
+            try:
+                update_job(self.job_id, timestamp=london_now())
+            except SQLAlchemyError as error:
+                print(f"DEBUG: Heartbeat for job {self.job_id} failed: {error}")
+
+def has_heartbeats():
+    # SQLite allows one writer at a time, so a write on a second connection would wait
+    # for the job's own transaction to finish
+    with app.app_context():
+        return db.engine.dialect.name != "sqlite"
+
+def claim_next_job(worker_id):
+    # Several workers may see the same queued job; the conditional update lets one win
+    with app.app_context():
+        queued = db.session.query(Job.JobID).filter(Job.Status == "queued").order_by(Job.JobID).limit(10).all()
+        for (job_id,) in queued:
+            claimed = db.session.execute(
+                update(Job)
+                .where(Job.JobID == job_id, Job.Status == "queued")
+                .values(
+                    Status="running",
+                    WorkerID=worker_id,
+                    Attempts=Job.Attempts + 1,
+                    Progress=0,
+                    started=london_now(),
+                )
+            ).rowcount
+            db.session.commit()
+            if claimed:
+                return job_id
+    return None
+
+def run_job(job_id):
+    with app.app_context():
+        job = db.session.get(Job, job_id)
+        operation = job.Operation
+        params = json.loads(job.Params)
+        body = json.loads(job.Body) if job.Body else None
+        submitter = db.session.get(User, job.SubmittedBy)
+        user = submitter and {"email": submitter.Email_address, "role": submitter.Role, "UserID": submitter.UserID}
+
+    print(f"DEBUG: Running job {job_id} ({operation})")
+    heartbeat = Heartbeat(job_id)
+    if has_heartbeats():
+        heartbeat.start()
+
+    # Run the handler as if the submitter had called it, with the job's body as the request body
+    with app.test_request_context(f"/api/jobs/{job_id}", method="POST", json=body):
+        try:
+            if not user:
+                abort(401, "The user who submitted this job no longer exists.")
+            g.authenticated_user = user
+
+            # Progress is written on a second connection, like the heartbeat
+            if has_heartbeats():
+                g.job_progress = ProgressWriter(job_id)
+
+            response = app.make_response(JOB_OPERATIONS[operation](**params))
+            status = response.status_code
+            result = response.get_json(silent=True)
+            if result is None:
+                result = {"message": response.get_data(as_text=True)}
+            elif not isinstance(result, dict):
+                result = {"result": result}
+        except HTTPException as error:
+            db.session.rollback()
+            discard_pending()
+            status, result = error.code, {"detail": error.description}
+        except Exception as error:
+            db.session.rollback()
+            discard_pending()
+            print(f"DEBUG: Job {job_id} raised {error!r}")
+            status, result = 500, {"detail": str(error)}
+        finally:
+            heartbeat.stopped.set()
+
+    result["status"] = status
+    finish_job(job_id, status, result)
+
+def finish_job(job_id, status, result):
+    # Retry briefly if the database is busy; if this never succeeds the job is picked
+    # up again once its heartbeat is stale
+    for attempt in range(5):
+        try:
+            update_job(
+                job_id,
+                Status="succeeded" if status < 400 else "failed",
+                Progress=100,
+                Result=json.dumps(result, default=str),
+                finished=london_now(),
+            )
+            print(f"DEBUG: Job {job_id} finished with status {status}")
+            return
+        except OperationalError as error:
+            print(f"DEBUG: Could not record the result of job {job_id}: {error}")
+            time.sleep(2 ** attempt)
+
+def recover_jobs(host=None, worker_id=None):
+    # Queue again the running jobs whose worker has died: those of a given worker or host,
+    # and any whose heartbeat has stopped. Jobs that keep killing their worker are failed.
+    dead = []
+    if has_heartbeats():
+        stale_before = (london_now() - timedelta(seconds=STALE_SECONDS)).replace(tzinfo=None)
+        dead.append(Job.timestamp < stale_before)
+    if host:
+        dead.append(Job.WorkerID.like(f"{host}:%"))
+    if worker_id:
+        dead.append(Job.WorkerID == worker_id)
+    if not dead:
+        return
+
+    with app.app_context():
+        for job in Job.query.filter(Job.Status == "running", or_(*dead)).all():
+            if job.Attempts >= MAX_ATTEMPTS:
+                values = dict(
+                    Status="failed",
+                    Result=json.dumps({"status": 500, "detail": "The job's worker stopped before it finished."}),
+                    finished=london_now(),
+                )
+            else:
+                values = dict(Status="queued", WorkerID=None)
+            # Only if it is still running and still looks dead: a heartbeat or the job
+            # finishing since it was read means its worker is alive
+            changed = db.session.execute(
+                update(Job)
+                .where(Job.JobID == job.JobID, Job.Status == "running", or_(*dead))
+                .values(**values)
+            ).rowcount
+            if changed and values["Status"] == "failed":
+                print(f"DEBUG: Job {job.JobID} failed after {job.Attempts} attempts.")
+            elif changed:
+                print(f"DEBUG: Requeueing job {job.JobID} from worker {job.WorkerID}.")
+        db.session.commit()
+
+def worker_id_for(pid):
+    return f"{socket.gethostname()}:{pid}"
+
+def worker_main():
+    # Don't share the parent's pooled connections with the forked worker
+    with app.app_context():
+        db.engine.dispose(close=False)
+    ensure_started(app)
+
+    worker_id = worker_id_for(os.getpid())
+    while True:
+        job_id = claim_next_job(worker_id)
+        if job_id is None:
+            time.sleep(POLL_SECONDS)
+            continue
+        run_job(job_id)
+
+def run_workers(count):
+    # Anything still running on this host is left over from before a restart. This has
+    # to happen before the new workers claim jobs under the same host name.
+    while True:
+        try:
+            recover_jobs(host=socket.gethostname())
+            break
+        except OperationalError as error:
+            print(f"DEBUG: Could not recover this host's jobs, retrying: {error}")
+            time.sleep(HEARTBEAT_SECONDS)
+
+    # Recoveries that fail (the database busy or unreachable) are tried again on the
+    # next pass
+    pending = []
+    workers = [None] * count
+    while True:
+        for index, process in enumerate(workers):
+            if process and process.is_alive():
+                continue
+            if process:
+                print(f"DEBUG: Job worker {process.pid} exited with code {process.exitcode}, restarting.")
+                pending.append({"worker_id": worker_id_for(process.pid)})
+            workers[index] = multiprocessing.Process(target=worker_main, daemon=True)
+            workers[index].start()
+
+        for criteria in pending + [{}]:
+            try:
+                recover_jobs(**criteria)
+            except OperationalError as error:
+                print(f"DEBUG: Could not recover jobs ({criteria or 'stale'}): {error}")
+                continue
+            if criteria:
+                pending.remove(criteria)
+
+        time.sleep(HEARTBEAT_SECONDS)
+
+if __name__ == "__main__":
+    if "--workers" in sys.argv:
+        run_workers(int(sys.argv[sys.argv.index("--workers") + 1]))
+    else:
+        print("Usage: python jobs.py --workers N")
@@ -0,0 +1,170 @@
+import threading
+import numpy as np
+from flask import abort, request
+from authentication import require_auth
+from routing import read_only
+from geometry import (
+    trail_sequences, segment_lengths_km, project_to_segments, grid_index, grid_lookup
+)
+import metrics
+
+MAX_FIXES = 10000
+DEFAULT_MAX_OFF_ROUTE_KM = 0.1
+# The grid lookup returns every segment within the radius of every fix, so the cost
+# grows with the square of the radius: 1,000 fixes against 2,000 trails of 200 points
+# take roughly 25-100 ms at 0.1 km, 1.5 times that at 1 km and ten times at 5 km
+MAX_OFF_ROUTE_KM = 1.0
+
+class MatchSnapshot:
+    # Every trail segment as flat arrays plus a grid over their bounding boxes.
+    # Built from one version of the trail sequences and never changed afterwards.
+    def __init__(self, sequences):
+        self.sequences = sequences
+        self.trail_ids = []
+        parts = []
+        for sequence in sequences.values():
+            count = len(sequence.lat)
+            if count == 0:
+                continue
+            # A single-point trail is matched as a zero-length segment
+            a = np.arange(max(count - 1, 1))
+            b = np.minimum(a + 1, count - 1)
+            lengths = segment_lengths_km(sequence) if count > 1 else np.zeros(1)
+            parts.append((
+                np.full(len(a), len(self.trail_ids)), a,
+                sequence.lat[a], sequence.lon[a], sequence.lat[b], sequence.lon[b],
+                np.concatenate(([0.0], np.cumsum(lengths)[:-1])), lengths,
+            ))
+            self.trail_ids.append(sequence.trail_id)
+
+        columns = [np.concatenate(column) for column in zip(*parts)] if parts else [np.zeros(0)] * 8
+        (self.seg_trail, self.seg_index, self.a_lat, self.a_lon,
+         self.b_lat, self.b_lon, self.seg_start_km, self.seg_length_km) = columns
+        self.seg_trail = self.seg_trail.astype(np.int64)
+        self.seg_index = self.seg_index.astype(np.int64)
+
+        # Segments of each trail are contiguous
+        self.trail_first_seg = np.searchsorted(self.seg_trail, np.arange(len(self.trail_ids)))
+        self.trail_last_seg = np.searchsorted(self.seg_trail, np.arange(len(self.trail_ids)), side="right")
+
+        self.cell_keys, self.cell_segments = grid_index(
+            np.minimum(self.a_lat, self.b_lat), np.minimum(self.a_lon, self.b_lon),
+            np.maximum(self.a_lat, self.b_lat), np.maximum(self.a_lon, self.b_lon),
+        )
+
+    def match(self, lat, lon, max_off_route_km):
+        fixes, segments = grid_lookup(self.cell_keys, self.cell_segments, lat, lon, max_off_route_km)
+        if len(fixes) == 0:
+            return None
+
+        distances, _ = project_to_segments(
+            lat[fixes], lon[fixes],
+            self.a_lat[segments], self.a_lon[segments], self.b_lat[segments], self.b_lon[segments],
+        )
+        trails = self.seg_trail[segments]
+
+        # Nearest segment of each trail to each fix
+        order = np.lexsort((distances, trails, fixes))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (fixes[order][1:] != fixes[order][:-1]) | (trails[order][1:] != trails[order][:-1])
+        nearest = order[first]
+        on_route = distances[nearest] <= max_off_route_km
+
+        # The trail that most fixes are on, then the one they are closest to
+        matched = np.bincount(trails[nearest], weights=on_route, minlength=len(self.trail_ids))
+        total_distance = np.bincount(
+            trails[nearest], weights=np.where(on_route, distances[nearest], 0.0), minlength=len(self.trail_ids)
+        )
+        if matched.max() == 0:
+            return None
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean_distance = np.where(matched > 0, total_distance / matched, np.inf)
+        best = int(np.lexsort((mean_distance, -matched))[0])
+
+        result = self.position(best, lat[-1], lon[-1])
+        result.update({
+            "matched_fixes": int(matched[best]),
+            "total_fixes": len(lat),
+            "mean_off_route_km": round(float(mean_distance[best]), 4),
+        })
+        return result
+
+    def position(self, trail, lat, lon):
+        # Where along the trail a fix is: nearest segment, distance along and off route
+        first, last = self.trail_first_seg[trail], self.trail_last_seg[trail]
+        distances, t = project_to_segments(
+            lat, lon,
+            self.a_lat[first:last], self.a_lon[first:last], self.b_lat[first:last], self.b_lon[first:last],
+        )
+        nearest = int(np.argmin(distances))
+        segment = first + nearest
+        along = self.seg_start_km[segment] + t[nearest] * self.seg_length_km[segment]
+        route_length = float(self.seg_start_km[last - 1] + self.seg_length_km[last - 1])
+
+        sequence = self.sequences[self.trail_ids[trail]]
+        a = int(self.seg_index[segment])
+        b = min(a + 1, len(sequence.point_ids) - 1)
+        return {
+            "TrailID": sequence.trail_id,
+            "Trail_name": sequence.name,
+            "route_length_km": round(route_length, 4),
+            "segment": {
+                "from_Location_Point": int(sequence.point_ids[a]),
+                "from_Order_no": int(sequence.order_nos[a]),
+                "to_Location_Point": int(sequence.point_ids[b]),
+                "to_Order_no": int(sequence.order_nos[b]),
+            },
+            "distance_along_km": round(float(along), 4),
+            "off_route_km": round(float(distances[nearest]), 4),
+            "progress": round(float(along / route_length), 4) if route_length else 1.0,
+        }
+
+class MatchIndex:
+    # Rebuilt from memory whenever the trail sequences have changed
+    def __init__(self):
+        self.version = None
+        self.snapshot = None
+        self.lock = threading.Lock()
+
+    def current(self):
+        version, sequences = trail_sequences.refresh()
+        with self.lock:
+            if version != self.version:
+                self.snapshot = MatchSnapshot(sequences)
+                self.version = version
+                metrics.increment("match_index.rebuild")
+            return self.snapshot
+
+match_index = MatchIndex()
+
+@read_only
+def match_trace():
+    user = require_auth()
+    if not user:
+        abort(401, "Authentication required.")
+
+    trace = request.get_json()
+    fixes = trace.get("fixes") if trace else None
+    if not fixes:
+        abort(400, "At least one GPS fix is required.")
+    if len(fixes) > MAX_FIXES:
+        abort(400, f"A trace can contain at most {MAX_FIXES} fixes.")
+
+    try:
+        lat = np.array([fix["Latitude"] for fix in fixes], dtype=np.float64)
+        lon = np.array([fix["Longitude"] for fix in fixes], dtype=np.float64)
+    except (KeyError, TypeError, ValueError):
+        abort(400, "Each fix must have a numeric Latitude and Longitude.")
+
+    try:
+        max_off_route_km = float(trace.get("max_off_route_km", DEFAULT_MAX_OFF_ROUTE_KM))
+    except (TypeError, ValueError):
+        abort(400, "max_off_route_km must be a number.")
+    if not 0 < max_off_route_km <= MAX_OFF_ROUTE_KM:
+        abort(400, f"max_off_route_km must be more than 0 and at most {MAX_OFF_ROUTE_KM} km.")
+
+    result = match_index.current().match(lat, lon, max_off_route_km)
+    if result is None:
+        abort(404, f"No trail is within {max_off_route_km} km of the trace.")
+
+    return result, 200
@@ -0,0 +1,14 @@
+import threading
+from collections import Counter
+
+# Process-wide counters, e.g. db_route.replica or db_route.primary.read_your_writes
+_counters = Counter()
+_lock = threading.Lock()
+
+def increment(name, amount=1):
+    with _lock:
+        _counters[name] += amount
+
+def snapshot():
+    with _lock:
+        return dict(_counters)
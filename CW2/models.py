@@ -1,8 +1,26 @@
+import threading
 from datetime import datetime
 import pytz
-from config import db, ma
-from sqlalchemy import CheckConstraint
-from marshmallow import fields
+from config import db, get_marshmallow
+from sqlalchemy import DDL, CheckConstraint, event
+
+# Coordinates are stored to microdegree precision (~0.1 m) for dedup
+COORD_SCALE = 1_000_000
+LON_KEY_SPAN = 360 * COORD_SCALE + 1
+
+def london_now():
+    # Timestamps shown to clients are London wall-clock time. That repeats an hour when
+    # the clocks go back, so the change feed orders changes by Change_seq instead.
+    return datetime.now(pytz.timezone('Europe/London'))
+
+def coordinate_key(latitude, longitude):
+    # Pack the quantised latitude/longitude into a single non-negative integer. Out of
+    # range values would overlap other points' keys, so they are refused.
+    if not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+        raise ValueError(f"Coordinates ({latitude}, {longitude}) are out of range.")
+    lat_key = int(round(latitude * COORD_SCALE)) + 90 * COORD_SCALE
+    lon_key = int(round(longitude * COORD_SCALE)) + 180 * COORD_SCALE
+    return lat_key * LON_KEY_SPAN + lon_key
 
 # USER
 class User(db.Model):
@@ -15,8 +33,8 @@ class User(db.Model):
 
     timestamp = db.Column(
         db.DateTime,
-        default=lambda: datetime.now(pytz.timezone('Europe/London')),
-        onupdate=lambda: datetime.now(pytz.timezone('Europe/London'))
+        default=london_now,
+        onupdate=london_now
     )
 
     _table_args__ = (
@@ -59,12 +77,29 @@ class Trail(db.Model):
         cascade="all, delete-orphan"
     )
 
+    created = db.Column(db.DateTime, default=london_now)
+
     timestamp = db.Column(
         db.DateTime,
-        default=lambda: datetime.now(pytz.timezone('Europe/London')),
-        onupdate=lambda: datetime.now(pytz.timezone('Europe/London'))
+        default=london_now,
+        onupdate=london_now
+    )
+
+    # Optimistic concurrency: the ORM bumps Version on every update of the trail and
+    # only applies an update or delete to the version it read (see versioning.py)
+    Version = db.Column(db.Integer, nullable=False, server_default="1")
+
+    # Commit-ordered change sequence of the last write and of the insert (see changes.py)
+    Change_seq = db.Column(db.BigInteger)
+    Created_seq = db.Column(db.BigInteger)
+
+    # Keyset index for the change feed
+    __table_args__ = (
+        db.Index('ix_trail_change_seq', 'Change_seq', 'TrailID'),
     )
 
+    __mapper_args__ = {"version_id_col": Version}
+
 # FEATURE
 class Feature(db.Model):
     __tablename__ = 'cw2_feature'
@@ -78,12 +113,27 @@ class Feature(db.Model):
     
     Trail_Feature = db.Column(db.String(100), nullable=False)
 
+    created = db.Column(db.DateTime, default=london_now)
+
+    timestamp = db.Column(
+        db.DateTime,
+        default=london_now,
+        onupdate=london_now
+    )
+
     trail_features = db.relationship(
         'TrailFeature',
         backref='feature',
         cascade="all, delete-orphan"
     )
 
+    Change_seq = db.Column(db.BigInteger)
+    Created_seq = db.Column(db.BigInteger)
+
+    __table_args__ = (
+        db.Index('ix_feature_change_seq', 'Change_seq', 'Trail_FeatureID'),
+    )
+
 # TRAIL-FEATURE 
 class TrailFeature(db.Model):
     __tablename__ = 'cw2_trail_feature'
@@ -108,10 +158,15 @@ class LocationPoint(db.Model):
     Longitude = db.Column(db.Float, nullable=False)
     Description = db.Column(db.String(255))
 
+    # Quantised coordinate key used for dedup lookups (see coordinate_key)
+    Coord_key = db.Column(db.BigInteger, nullable=False)
+
+    created = db.Column(db.DateTime, default=london_now)
+
     timestamp = db.Column(
         db.DateTime,
-        default=lambda: datetime.now(pytz.timezone('Europe/London')),
-        onupdate=lambda: datetime.now(pytz.timezone('Europe/London'))
+        default=london_now,
+        onupdate=london_now
     )
 
     trail_location_pts = db.relationship(
@@ -120,10 +175,20 @@ class LocationPoint(db.Model):
         cascade="all, delete-orphan"
     )
 
+    Change_seq = db.Column(db.BigInteger)
+    Created_seq = db.Column(db.BigInteger)
+
     __table_args__ = (
-        db.UniqueConstraint('Latitude', 'Longitude', name='unique_lat_lon'),
+        db.Index('ix_location_point_coord_key', 'Coord_key', unique=True),
+        db.Index('ix_location_point_change_seq', 'Change_seq', 'Location_Point'),
     )
 
+# Keep Coord_key in step with Latitude/Longitude for ORM inserts and updates
+@event.listens_for(LocationPoint, "before_insert")
+@event.listens_for(LocationPoint, "before_update")
+def set_coordinate_key(mapper, connection, target):
+    target.Coord_key = coordinate_key(target.Latitude, target.Longitude)
+
 # TRAIL-LOCATIONPt 
 class TrailLocationPt(db.Model):
     __tablename__ = 'cw2_trail_location_pt'
@@ -148,54 +213,208 @@ class TrailLocationPt(db.Model):
         CheckConstraint('Order_no >= 1', name='ck_order_no_positive'),
     )
 
+# TRAIL-FACET
+# Materialised trail counts per facet value, maintained by the write handlers.
+# For the Feature facet, Value holds the Trail_FeatureID.
+class TrailFacet(db.Model):
+    __tablename__ = 'cw2_trail_facet'
+
+    Facet = db.Column(db.String(20), primary_key=True)
+    Value = db.Column(db.String(100), primary_key=True)
+    Trail_count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        CheckConstraint(
+            "Facet IN ('Difficulty', 'Route_type', 'Location', 'Feature')",
+            name="ck_trail_facet_valid"
+        ),
+    )
+
+# TOMBSTONE
+# Records deletes so the change feed can report them after the rows are gone
+class Tombstone(db.Model):
+    __tablename__ = 'cw2_tombstone'
+
+    TombstoneID = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    Entity = db.Column(db.String(20), nullable=False)
+    EntityID = db.Column(db.Integer, nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False, default=london_now)
+    Change_seq = db.Column(db.BigInteger)
+
+    __table_args__ = (
+        CheckConstraint(
+            "Entity IN ('trail', 'feature', 'location_point')",
+            name="ck_tombstone_entity_valid"
+        ),
+        db.Index('ix_tombstone_change_seq', 'Change_seq', 'TombstoneID'),
+    )
+
+# CHANGE COUNTER
+# One row holding the last change sequence number taken. A committing transaction
+# increments it and keeps the row locked until it commits, so sequence numbers are
+# taken in commit order (see changes.py).
+class ChangeCounter(db.Model):
+    __tablename__ = 'cw2_change_counter'
+
+    CounterID = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    Change_seq = db.Column(db.BigInteger, nullable=False)
+
+event.listen(
+    ChangeCounter.__table__, "after_create",
+    DDL("INSERT INTO cw2_change_counter (CounterID, Change_seq) VALUES (1, 0)")
+)
+
+# CHANGE COMMIT
+# When each change sequence number was committed (UTC), so a change feed can start
+# from a point in time
+class ChangeCommit(db.Model):
+    __tablename__ = 'cw2_change_commit'
+
+    Change_seq = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    committed = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_change_commit_committed', 'committed'),
+    )
+
+# JOB
+# Long-running operations queued by POST /jobs and run by `python jobs.py`
+class Job(db.Model):
+    __tablename__ = 'cw2_job'
+
+    JobID = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    Operation = db.Column(db.String(50), nullable=False)
+    Params = db.Column(db.Text, nullable=False, default="{}")
+    Body = db.Column(db.Text, nullable=True)
+    Status = db.Column(db.String(10), nullable=False, default="queued")
+    Progress = db.Column(db.Integer, nullable=False, default=0)
+    Result = db.Column(db.Text, nullable=True)
+    Attempts = db.Column(db.Integer, nullable=False, default=0)
+    WorkerID = db.Column(db.String(100), nullable=True)
+    # No foreign key, so jobs (including a reseed job) survive cw2_user being rebuilt
+    SubmittedBy = db.Column(db.Integer, nullable=False)
+    created = db.Column(db.DateTime, nullable=False, default=london_now)
+    started = db.Column(db.DateTime, nullable=True)
+    finished = db.Column(db.DateTime, nullable=True)
+    # Heartbeat while running, so jobs of a worker that died can be picked up again
+    timestamp = db.Column(db.DateTime, nullable=False, default=london_now, onupdate=london_now)
+
+    __table_args__ = (
+        CheckConstraint(
+            "Status IN ('queued', 'running', 'succeeded', 'failed')",
+            name="ck_job_status_valid"
+        ),
+        CheckConstraint("Progress BETWEEN 0 AND 100", name="ck_job_progress_range"),
+        db.Index('ix_job_status', 'Status', 'JobID'),
+    )
+
+# IDEMPOTENCY KEY
+# Responses to writes sent with an Idempotency-Key header, replayed when the client
+# retries with the same key. Keys are per client (by email) and expire.
+class IdempotencyKey(db.Model):
+    __tablename__ = 'cw2_idempotency_key'
+
+    Client = db.Column(db.String(255), primary_key=True)
+    Key = db.Column(db.String(255), primary_key=True)
+    # SHA-256 of the method, path, query string and body of the original request
+    Request_hash = db.Column(db.String(64), nullable=False)
+    Status_code = db.Column(db.Integer, nullable=False)
+    Content_type = db.Column(db.String(100), nullable=False)
+    Response_body = db.Column(db.UnicodeText, nullable=False)
+    # The trail's ETag, for writes that return one
+    ETag = db.Column(db.String(100))
+    created = db.Column(db.DateTime, nullable=False, default=london_now)
+    expires = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_idempotency_key_expires', 'expires'),
+    )
+
 # Schemas
-class UserSchema(ma.SQLAlchemyAutoSchema):
-    class Meta:
-        model = User
-        load_instance = True
-        sqla_session = db.session
-
-class TrailSchema(ma.SQLAlchemyAutoSchema):
-    class Meta:
-        model = Trail
-        load_instance = True
-        sqla_session = db.session
-        
-class FeatureSchema(ma.SQLAlchemyAutoSchema):
-    class Meta:
-        model = Feature
-        load_instance = True
-        sqla_session = db.session
-
-class TrailFeatureSchema(ma.SQLAlchemyAutoSchema):
-    class Meta:
-        model = TrailFeature
-        load_instance = True
-        sqla_session = db.session
-        include_fk = True
-
-class LocationPointSchema(ma.SQLAlchemyAutoSchema):
-    class Meta:
-        model = LocationPoint
-        load_instance = True
-        sqla_session = db.session
-
-class TrailLocationPtSchema(ma.SQLAlchemyAutoSchema):
-    class Meta:
-        model = TrailLocationPt
-        load_instance = True
-        sqla_session = db.session
-        include_fk = True
-
-user_schema = UserSchema()
-users_schema = UserSchema(many=True)
-trail_schema = TrailSchema()
-trails_schema = TrailSchema(many=True)
-location_point_schema = LocationPointSchema()
-location_points_schema = LocationPointSchema(many=True)
-feature_schema = FeatureSchema()
-features_schema = FeatureSchema(many=True)
-trail_feature_schema = TrailFeatureSchema()
-trail_features_schema = TrailFeatureSchema(many=True)
-trail_location_pt_schema = TrailLocationPtSchema()
-trail_location_pts_schema = TrailLocationPtSchema(many=True)
\ No newline at end of file
+# The marshmallow auto-schemas are built the first time one is used rather than at
+# import, since building them (and importing flask_marshmallow) slows worker startup
+_schema_lock = threading.Lock()
+_schema_classes = {}
+
+def schema_classes():
+    with _schema_lock:
+        if _schema_classes:
+            return _schema_classes
+
+        ma = get_marshmallow()
+
+        class UserSchema(ma.SQLAlchemyAutoSchema):
+            class Meta:
+                model = User
+                load_instance = True
+                sqla_session = db.session
+
+        class TrailSchema(ma.SQLAlchemyAutoSchema):
+            class Meta:
+                model = Trail
+                load_instance = True
+                sqla_session = db.session
+                exclude = ("Change_seq", "Created_seq")
+
+        class FeatureSchema(ma.SQLAlchemyAutoSchema):
+            class Meta:
+                model = Feature
+                load_instance = True
+                sqla_session = db.session
+                exclude = ("Change_seq", "Created_seq")
+
+        class TrailFeatureSchema(ma.SQLAlchemyAutoSchema):
+            class Meta:
+                model = TrailFeature
+                load_instance = True
+                sqla_session = db.session
+                include_fk = True
+
+        class LocationPointSchema(ma.SQLAlchemyAutoSchema):
+            class Meta:
+                model = LocationPoint
+                load_instance = True
+                sqla_session = db.session
+                exclude = ("Coord_key", "Change_seq", "Created_seq")
+
+        class TrailLocationPtSchema(ma.SQLAlchemyAutoSchema):
+            class Meta:
+                model = TrailLocationPt
+                load_instance = True
+                sqla_session = db.session
+                include_fk = True
+
+        _schema_classes.update({
+            "UserSchema": UserSchema,
+            "TrailSchema": TrailSchema,
+            "FeatureSchema": FeatureSchema,
+            "TrailFeatureSchema": TrailFeatureSchema,
+            "LocationPointSchema": LocationPointSchema,
+            "TrailLocationPtSchema": TrailLocationPtSchema,
+        })
+        return _schema_classes
+
+class LazySchema:
+    # Stands in for a schema instance and creates it on first attribute access
+    def __init__(self, class_name, **kwargs):
+        self._class_name = class_name
+        self._kwargs = kwargs
+        self._schema = None
+
+    def __getattr__(self, name):
+        if self._schema is None:
+            self._schema = schema_classes()[self._class_name](**self._kwargs)
+        return getattr(self._schema, name)
+
+user_schema = LazySchema("UserSchema")
+users_schema = LazySchema("UserSchema", many=True)
+trail_schema = LazySchema("TrailSchema")
+trails_schema = LazySchema("TrailSchema", many=True)
+location_point_schema = LazySchema("LocationPointSchema")
+location_points_schema = LazySchema("LocationPointSchema", many=True)
+feature_schema = LazySchema("FeatureSchema")
+features_schema = LazySchema("FeatureSchema", many=True)
+trail_feature_schema = LazySchema("TrailFeatureSchema")
+trail_features_schema = LazySchema("TrailFeatureSchema", many=True)
+trail_location_pt_schema = LazySchema("TrailLocationPtSchema")
+trail_location_pts_schema = LazySchema("TrailLocationPtSchema", many=True)
@@ -0,0 +1,11 @@
+from flask import abort
+from authentication import require_auth_and_role
+import metrics
+import circuit
+
+def get_metrics():
+    user = require_auth_and_role("admin")
+    if not user:
+        abort(403, "Unable to authenticate user.")
+
+    return {"counters": metrics.snapshot(), "database": circuit.database_state()}, 200
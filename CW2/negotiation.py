@@ -0,0 +1,128 @@
+import json
+import zlib
+from flask import abort, request
+import metrics
+
+# Optional dependencies: zstd and MessagePack are only offered when installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_MIMETYPE = "application/msgpack"
+
+COMPRESSIBLE_MIMETYPES = {
+    "application/json",
+    "application/problem+json",
+    "application/javascript",
+    "application/xml",
+    "application/gpx+xml",
+    "application/geo+json",
+    MSGPACK_MIMETYPE,
+}
+
+def available_encodings():
+    # In order of preference when the client accepts several with the same quality
+    encodings = ["zstd"] if zstandard else []
+    return encodings + ["gzip", "deflate"]
+
+def create_compressor(encoding, level):
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    if encoding == "gzip":
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    # HTTP "deflate" is the zlib format
+    return zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS)
+
+def is_compressible(response):
+    return response.mimetype.startswith("text/") or response.mimetype in COMPRESSIBLE_MIMETYPES
+
+def wants_msgpack():
+    if msgpack is None:
+        return False
+    return request.accept_mimetypes.best_match(["application/json", MSGPACK_MIMETYPE]) == MSGPACK_MIMETYPE
+
+def check_acceptable():
+    # Checked before the handler runs, so a write is not made for a response the
+    # client would refuse
+    accept = request.accept_mimetypes
+    if msgpack is None and accept.best_match(["application/json"]) is None and accept.best_match([MSGPACK_MIMETYPE]):
+        abort(406, "MessagePack responses need the msgpack package, which is not installed; accept application/json instead.")
+
+def to_msgpack(response):
+    # Re-encode a finished JSON body; streamed bodies are left as JSON
+    if response.is_streamed or response.mimetype != "application/json":
+        return
+    response.set_data(msgpack.packb(json.loads(response.get_data())))
+    response.mimetype = MSGPACK_MIMETYPE
+    metrics.increment("negotiation.msgpack")
+    weaken_etag(response)
+
+def compress_stream(chunks, compressor):
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+def compress(response, encoding, level, min_size):
+    if response.is_streamed:
+        # Size is unknown up front, so streamed bodies are always compressed
+        response.response = compress_stream(response.response, create_compressor(encoding, level))
+        response.direct_passthrough = False
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < min_size:
+            return
+        compressor = create_compressor(encoding, level)
+        compressed = compressor.compress(data) + compressor.flush()
+        response.set_data(compressed)
+        metrics.increment("negotiation.bytes_before", len(data))
+        metrics.increment("negotiation.bytes_after", len(compressed))
+
+    response.headers["Content-Encoding"] = encoding
+    metrics.increment(f"negotiation.{encoding}")
+
+    # The compressed body is a different representation of the same resource
+    weaken_etag(response)
+
+def weaken_etag(response):
+    # A strong ETag promises identical bytes, which a re-encoded body no longer has
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+
+def negotiate(response, app):
+    response.vary.add("Accept")
+    response.vary.add("Accept-Encoding")
+
+    if response.status_code < 200 or response.status_code in (204, 206, 304):
+        return response
+
+    if wants_msgpack():
+        to_msgpack(response)
+
+    if "Content-Encoding" in response.headers or not is_compressible(response):
+        return response
+
+    encoding = request.accept_encodings.best_match(available_encodings())
+    if encoding:
+        level = app.config["ZSTD_LEVEL"] if encoding == "zstd" else app.config["GZIP_LEVEL"]
+        compress(response, encoding, level, app.config["COMPRESSION_MIN_SIZE"])
+    return response
+
+def init_app(app):
+    app.before_request(check_acceptable)
+    app.after_request(lambda response: negotiate(response, app))
@@ -0,0 +1,227 @@
+import itertools
+import threading
+from math import radians, cos, sin, asin, sqrt
+from flask import abort, request
+from authentication import require_auth
+from routing import read_only
+from coalescing import coalesce
+from geometry import trail_sequences, segment_lengths_km, EARTH_RADIUS_KM
+import metrics
+
+DEFAULT_MAX_TRAILS = 3
+MAX_TRAILS = 10
+
+def haversine(a, b):
+    # Scalar version for the A* heuristic; a and b are (lat, lon) in degrees
+    lat1, lon1, lat2, lon2 = radians(a[0]), radians(a[1]), radians(b[0]), radians(b[1])
+    h = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * asin(min(1.0, sqrt(h)))
+
+class TrailNetwork:
+    # Location points shared by several trails join the trails into a network. Only
+    # junctions (shared points and trail ends) matter for getting from one trail to
+    # another, so each trail is kept as the indexes of its junctions along it. Updated
+    # trail by trail as the trail sequences change.
+    def __init__(self):
+        self.version = None
+        self.reset()
+        self.lock = threading.Lock()
+
+    def reset(self):
+        self.trails = {}          # trail ID -> (name, point IDs, cumulative km, point ID -> index)
+        self.point_trails = {}    # point ID -> IDs of the trails it is on
+        self.ends = {}            # point ID -> number of trails starting or ending there
+        self.coordinates = {}     # point ID -> (lat, lon)
+        self.junctions = {}       # trail ID -> indexes of its junctions, in order
+
+    def is_junction(self, point_id):
+        return len(self.point_trails.get(point_id, ())) > 1 or self.ends.get(point_id, 0) > 0
+
+    def add_trail(self, sequence):
+        point_ids = sequence.point_ids.tolist()
+        lengths = segment_lengths_km(sequence).tolist()
+        cumulative = [0.0] + list(itertools.accumulate(lengths))
+        self.trails[sequence.trail_id] = (
+            sequence.name, point_ids, cumulative, {point_id: index for index, point_id in enumerate(point_ids)}
+        )
+        for point_id, lat, lon in zip(point_ids, sequence.lat.tolist(), sequence.lon.tolist()):
+            self.coordinates[point_id] = (lat, lon)
+            self.point_trails.setdefault(point_id, set()).add(sequence.trail_id)
+        for point_id in {point_ids[0], point_ids[-1]}:
+            self.ends[point_id] = self.ends.get(point_id, 0) + 1
+
+    def remove_trail(self, trail_id):
+        _, point_ids, _, _ = self.trails.pop(trail_id)
+        self.junctions.pop(trail_id, None)
+        for point_id in point_ids:
+            trails = self.point_trails[point_id]
+            trails.discard(trail_id)
+            if not trails:
+                del self.point_trails[point_id]
+        for point_id in {point_ids[0], point_ids[-1]}:
+            self.ends[point_id] -= 1
+            if not self.ends[point_id]:
+                del self.ends[point_id]
+
+    def refresh(self):
+        version, sequences = trail_sequences.refresh()
+        with self.lock:
+            if version == self.version:
+                return
+            changed = trail_sequences.changed_since(self.version)
+            if changed is None:
+                self.reset()
+                changed = set(sequences)
+                metrics.increment("trail_network.rebuild")
+            else:
+                metrics.increment("trail_network.update", len(changed))
+
+            # Points of the changed trails may have become, or stopped being, junctions;
+            # the junctions of every other trail through them then need finding again
+            touched = {}
+            for trail_id in changed:
+                point_ids = list(self.trails[trail_id][1]) if trail_id in self.trails else []
+                sequence = sequences.get(trail_id)
+                if sequence is not None:
+                    point_ids.extend(sequence.point_ids.tolist())
+                for point_id in point_ids:
+                    if point_id not in touched:
+                        touched[point_id] = self.is_junction(point_id)
+
+            for trail_id in changed:
+                if trail_id in self.trails:
+                    self.remove_trail(trail_id)
+                sequence = sequences.get(trail_id)
+                if sequence is not None and len(sequence.point_ids):
+                    self.add_trail(sequence)
+
+            relink = set(changed)
+            for point_id, was_junction in touched.items():
+                if self.is_junction(point_id) != was_junction:
+                    relink.update(self.point_trails.get(point_id, ()))
+            for trail_id in relink:
+                if trail_id in self.trails:
+                    _, point_ids, _, _ = self.trails[trail_id]
+                    self.junctions[trail_id] = [
+                        index for index, point_id in enumerate(point_ids) if self.is_junction(point_id)
+                    ]
+            self.version = version
+
+    def shortest_route(self, origin, target, max_trails):
+        # Round k finds the shortest distance to each junction using at most k trails,
+        # by riding every trail through a junction that got closer in round k - 1, in
+        # both directions. Stops once max_trails rounds are done or nothing improves.
+        with self.lock:
+            if origin not in self.point_trails or target not in self.point_trails:
+                return None
+
+            # The origin and target may be part-way along a trail rather than at a junction
+            stops = {}
+            for point_id in (origin, target):
+                if not self.is_junction(point_id):
+                    (trail_id,) = self.point_trails[point_id]
+                    stops.setdefault(trail_id, []).append(self.trails[trail_id][3][point_id])
+
+            goal = self.coordinates[target]
+            best = {origin: 0.0}
+            rounds = [{origin: None}]
+            last_round = {origin: 0}
+            marked = {origin}
+            scanned = 0
+            for round_no in range(1, max_trails + 1):
+                bound = best.get(target, float("inf"))
+                improved = {}
+                for trail_id in {trail_id for point_id in marked for trail_id in self.point_trails[point_id]}:
+                    scanned += 1
+                    _, point_ids, cumulative, _ = self.trails[trail_id]
+                    indexes = self.junctions[trail_id]
+                    if trail_id in stops:
+                        indexes = sorted(set(indexes).union(stops[trail_id]))
+                    for ordered in (indexes, indexes[::-1]):
+                        boarded = None
+                        for index in ordered:
+                            point_id = point_ids[index]
+                            if boarded is not None:
+                                distance = boarded[0] + abs(cumulative[index] - cumulative[boarded[2]])
+                                current = improved[point_id][0] if point_id in improved else best.get(point_id, float("inf"))
+                                if distance < current and distance + haversine(self.coordinates[point_id], goal) < bound:
+                                    improved[point_id] = (distance, boarded[1], trail_id, boarded[2], index, boarded[3])
+                                    if point_id == target:
+                                        bound = distance
+                            if point_id in marked:
+                                # Board here if that beats staying on from further back
+                                start = best[point_id]
+                                if boarded is None or start < boarded[0] + abs(cumulative[index] - cumulative[boarded[2]]):
+                                    boarded = (start, point_id, index, last_round[point_id])
+
+                for point_id, label in improved.items():
+                    best[point_id] = label[0]
+                    last_round[point_id] = round_no
+                rounds.append(improved)
+                marked = set(improved)
+                if not marked:
+                    break
+
+            metrics.increment("trail_network.trails_scanned", scanned)
+            if target not in best:
+                return None
+            return self.describe(target, best[target], rounds, last_round[target])
+
+    def describe(self, target, distance, rounds, round_no):
+        # Follow the boarding points back to the origin, one leg per trail ridden
+        legs = []
+        point_id = target
+        while rounds[round_no][point_id] is not None:
+            _, boarded_at, trail_id, start, end, boarded_round = rounds[round_no][point_id]
+            # Getting off and straight back on the same trail (an equally short
+            # alternative was found first) reads as one leg
+            if legs and legs[-1][0] == trail_id and legs[-1][1] == end:
+                legs[-1] = (trail_id, start, legs[-1][2])
+            else:
+                legs.append((trail_id, start, end))
+            point_id, round_no = boarded_at, boarded_round
+        legs.reverse()
+
+        points = [point_id]
+        trails = []
+        for trail_id, start, end in legs:
+            name, point_ids, cumulative, _ = self.trails[trail_id]
+            stretch = point_ids[start:end + 1] if start <= end else point_ids[end:start + 1][::-1]
+            points.extend(stretch[1:])
+            trails.append({
+                "TrailID": trail_id,
+                "Trail_name": name,
+                "from_Location_Point": stretch[0],
+                "to_Location_Point": stretch[-1],
+                "distance_km": round(abs(cumulative[end] - cumulative[start]), 4),
+            })
+
+        return {
+            "distance_km": round(distance, 4),
+            "trails": trails,
+            "LocationPoints": points,
+        }
+
+trail_network = TrailNetwork()
+
+@read_only
+@coalesce
+def plan_route(to, max_trails=DEFAULT_MAX_TRAILS):
+    user = require_auth()
+    if not user:
+        abort(401, "Authentication required.")
+
+    # "from" is a Python keyword, so it is read from the query string directly
+    origin = request.args.get("from", type=int)
+    if origin is None:
+        abort(400, "from is required.")
+    max_trails = max(1, min(max_trails, MAX_TRAILS))
+
+    trail_network.refresh()
+    route = trail_network.shortest_route(origin, to, max_trails)
+    if route is None:
+        abort(404, f"No route from location point {origin} to {to} using at most {max_trails} trails.")
+
+    route["from"] = origin
+    route["to"] = to
+    return route, 200
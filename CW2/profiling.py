@@ -0,0 +1,172 @@
+import cProfile
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+from functools import wraps
+from flask import after_this_request, current_app, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.exceptions import HTTPException
+from authentication import require_auth_and_role
+import metrics
+
+# Admins send this header to profile one request; its value is ignored
+PROFILE_HEADER = "X-Profile"
+
+# Seconds between stack samples for the speedscope profile
+SAMPLE_INTERVAL = 0.001
+
+profile_numbers = itertools.count(1)
+
+class StackSampler(threading.Thread):
+    # Samples the stack of one thread, for a flame graph of where the time went
+    def __init__(self, thread_id):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.stopped = threading.Event()
+        self.frames = {}
+        self.samples = []
+        self.weights = []
+
+    def run(self):
+        last = time.perf_counter()
+        while not self.stopped.wait(SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(self.thread_id)
+            now = time.perf_counter()
+            if frame is None:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                key = (code.co_name, code.co_filename, code.co_firstlineno)
+                stack.append(self.frames.setdefault(key, len(self.frames)))
+                frame = frame.f_back
+            stack.reverse()
+            self.samples.append(stack)
+            self.weights.append(now - last)
+            last = now
+
+    def speedscope(self, name):
+        # https://www.speedscope.app/file-format-schema.json, "sampled" profile
+        frames = sorted(self.frames, key=self.frames.get)
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": name,
+            "exporter": "cw2 profiling.py",
+            "shared": {"frames": [{"name": function, "file": file, "line": line} for function, file, line in frames]},
+            "profiles": [{
+                "type": "sampled",
+                "name": name,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(self.weights),
+                "samples": self.samples,
+                "weights": self.weights,
+            }],
+        }
+
+class StatementLog:
+    # Every SQL statement run on one thread, with its duration. The listeners are only
+    # attached while a profiled request runs.
+    def __init__(self, thread_id):
+        self.thread_id = thread_id
+        self.statements = []
+
+    def before(self, conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == self.thread_id:
+            conn.info.setdefault("profile_started", []).append(time.perf_counter())
+
+    def after(self, conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() != self.thread_id:
+            return
+        started = conn.info["profile_started"].pop()
+        self.statements.append({
+            "statement": statement,
+            "parameters": repr(parameters)[:500],
+            "executemany": executemany,
+            "rowcount": cursor.rowcount,
+            "duration_ms": round((time.perf_counter() - started) * 1000, 3),
+        })
+
+    def __enter__(self):
+        event.listen(Engine, "before_cursor_execute", self.before)
+        event.listen(Engine, "after_cursor_execute", self.after)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(Engine, "before_cursor_execute", self.before)
+        event.remove(Engine, "after_cursor_execute", self.after)
+
+def profile_request(name, function, args, kwargs):
+    thread_id = threading.get_ident()
+    profile = cProfile.Profile()
+    sampler = StackSampler(thread_id)
+    status = 500
+    started = time.perf_counter()
+    with StatementLog(thread_id) as statements:
+        sampler.start()
+        profile.enable()
+        try:
+            result = function(*args, **kwargs)
+            status = result[1] if isinstance(result, tuple) and len(result) > 1 else 200
+        except HTTPException as error:
+            status = error.code
+            raise
+        finally:
+            # A streamed response is only profiled up to the point it starts streaming
+            profile.disable()
+            sampler.stopped.set()
+            sampler.join()
+            elapsed = time.perf_counter() - started
+            profile_id = save_profile(name, profile, sampler, statements, status, elapsed)
+
+            # Added as the response goes out, so error responses get it too
+            @after_this_request
+            def add_profile_id(response):
+                response.headers["X-Profile-Id"] = profile_id
+                return response
+
+    return result
+
+def save_profile(name, profile, sampler, statements, status, elapsed):
+    directory = current_app.config["PROFILE_DIR"]
+    os.makedirs(directory, exist_ok=True)
+    profile_id = f"{datetime.now():%Y%m%d-%H%M%S}-{name}-{os.getpid()}-{next(profile_numbers)}"
+    path = os.path.join(directory, profile_id)
+
+    # Open the .pstats file with `python -m pstats` or snakeviz, and the
+    # .speedscope.json file at https://www.speedscope.app
+    profile.dump_stats(f"{path}.pstats")
+    title = f"{request.method} {request.full_path.rstrip('?')}"
+    with open(f"{path}.speedscope.json", "w") as file:
+        json.dump(sampler.speedscope(title), file)
+    with open(f"{path}.sql.json", "w") as file:
+        json.dump({
+            "request": title,
+            "operation": name,
+            "status": status,
+            "duration_ms": round(elapsed * 1000, 3),
+            "sql_count": len(statements.statements),
+            "sql_duration_ms": round(sum(s["duration_ms"] for s in statements.statements), 3),
+            "statements": statements.statements,
+        }, file, indent=2)
+
+    metrics.increment("profiling.requests")
+    print(f"DEBUG: Profiled {title} in {elapsed * 1000:.1f} ms, written to {path}.*")
+    return profile_id
+
+def profiled(name, function):
+    # Normal requests only pay for one header lookup
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if PROFILE_HEADER not in request.headers:
+            return function(*args, **kwargs)
+        require_auth_and_role("admin")
+        return profile_request(name, function, args, kwargs)
+
+    return wrapper
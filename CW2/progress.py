@@ -0,0 +1,10 @@
+from flask import g, has_app_context
+
+def report_progress(done, total):
+    # Long-running handlers call this as they go; it only has an effect when the
+    # handler is running as a background job (see jobs.py)
+    if not has_app_context() or not total:
+        return
+    callback = g.get("job_progress")
+    if callback:
+        callback(min(100, int(done * 100 / total)))
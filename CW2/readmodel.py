@@ -0,0 +1,341 @@
+import threading
+import numpy as np
+from flask import g, has_app_context
+from sqlalchemy.orm import Session
+from config import app, db
+from models import Trail, Feature, TrailFeature, LocationPoint, TrailLocationPt
+from invalidation import subscribe
+import metrics
+
+# SQL Server caps a statement at 2100 parameters, so IN lists are chunked
+ID_CHUNK = 1000
+
+TRAIL_COLUMNS = (
+    "TrailID", "Trail_name", "Trail_Summary", "Trail_Description", "Difficulty", "Location",
+    "Length", "Elevation_gain", "Route_type", "OwnerID", "created", "timestamp", "Version",
+)
+
+# Fields of GET /trails, and of GET /trails/{trail_id} (what trail_schema dumps)
+BASIC_FIELDS = (
+    "Trail_name", "Trail_Summary", "Trail_Description", "Difficulty", "Location",
+    "Length", "Elevation_gain", "Route_type",
+)
+SCHEMA_FIELDS = BASIC_FIELDS + ("TrailID", "Version")
+
+def chunks(ids):
+    ids = sorted(ids)
+    return [ids[start:start + ID_CHUNK] for start in range(0, len(ids), ID_CHUNK)]
+
+def to_datetime64(values):
+    # Naive datetimes, one 8-byte value each instead of a datetime object
+    return np.array([value.replace(tzinfo=None) if value is not None else None for value in values], dtype="datetime64[us]")
+
+def isoformat(value):
+    # As marshmallow dumps a DateTime
+    return value.isoformat() if value is not None else None
+
+class TrailRecord:
+    # A trail's columns, its feature IDs and its points in Order_no order as arrays
+    __slots__ = TRAIL_COLUMNS + ("feature_ids", "point_ids", "order_nos", "lat", "lon")
+
+    def __init__(self, row, feature_ids, links, points):
+        for name, value in zip(TRAIL_COLUMNS, row):
+            setattr(self, name, value)
+        self.feature_ids = tuple(sorted(feature_ids))
+        self.point_ids = np.array([point_id for point_id, _ in links], dtype=np.int64)
+        self.order_nos = np.array([order_no for _, order_no in links], dtype=np.int32)
+        rows = points.rows(self.point_ids)
+        self.lat = points.lat[rows]
+        self.lon = points.lon[rows]
+
+class PointTable:
+    # Every location point as parallel arrays sorted by ID: 40 bytes a point plus a
+    # reference to its description
+    __slots__ = ("ids", "lat", "lon", "created", "timestamp", "descriptions")
+
+    def __init__(self, rows):
+        rows = sorted(rows)
+        self.ids = np.array([row[0] for row in rows], dtype=np.int64)
+        self.lat = np.array([row[1] for row in rows], dtype=np.float64)
+        self.lon = np.array([row[2] for row in rows], dtype=np.float64)
+        self.descriptions = [row[3] for row in rows]
+        self.created = to_datetime64([row[4] for row in rows])
+        self.timestamp = to_datetime64([row[5] for row in rows])
+
+    def rows(self, point_ids):
+        # Positions of point IDs that are known to exist. A trail committed while the
+        # table was loading can name a point it lacks; clipping keeps that from failing
+        # until the trail's invalidation brings the point in.
+        return np.minimum(np.searchsorted(self.ids, point_ids), max(len(self.ids) - 1, 0))
+
+    def row(self, point_id):
+        row = int(np.searchsorted(self.ids, point_id))
+        return row if row < len(self.ids) and self.ids[row] == point_id else None
+
+    def patched(self, changed, deleted):
+        # A new table with some points changed, added or deleted; this one is left as it is
+        keep = ~np.isin(self.ids, list(deleted) + [row[0] for row in changed])
+        kept = zip(
+            self.ids[keep].tolist(), self.lat[keep].tolist(), self.lon[keep].tolist(),
+            [description for description, keep_row in zip(self.descriptions, keep.tolist()) if keep_row],
+            self.created[keep].tolist(), self.timestamp[keep].tolist(),
+        )
+        return PointTable(list(kept) + list(changed))
+
+    def dump(self, rows):
+        # As location_points_schema dumps them
+        return [
+            {
+                "Location_Point": point_id,
+                "Latitude": lat,
+                "Longitude": lon,
+                "Description": self.descriptions[row],
+                "created": isoformat(created),
+                "timestamp": isoformat(timestamp),
+            }
+            for row, point_id, lat, lon, created, timestamp in zip(
+                rows.tolist(), self.ids[rows].tolist(), self.lat[rows].tolist(), self.lon[rows].tolist(),
+                self.created[rows].tolist(), self.timestamp[rows].tolist(),
+            )
+        ]
+
+class Snapshot:
+    # One consistent version of the catalogue. Never changed once published, so any
+    # number of requests can read it without locking.
+    __slots__ = ("trails", "features", "points", "basic_list", "feature_list")
+
+    def __init__(self, trails, features, points):
+        self.trails = trails
+        self.features = features
+        self.points = points
+        self.basic_list = None
+        self.feature_list = None
+
+    def basic_trails(self):
+        # Built once per snapshot; two requests racing to build it both get the same answer
+        if self.basic_list is None:
+            self.basic_list = [
+                {field: getattr(trail, field) for field in BASIC_FIELDS}
+                for _, trail in sorted(self.trails.items())
+            ]
+        return self.basic_list
+
+    def trail(self, trail_id):
+        # GET /trails/{trail_id} takes the ID as a string
+        try:
+            trail = self.trails.get(int(trail_id))
+        except (TypeError, ValueError):
+            return None
+        if trail is None:
+            return None
+        result = {field: getattr(trail, field) for field in SCHEMA_FIELDS}
+        result["created"] = isoformat(trail.created)
+        result["timestamp"] = isoformat(trail.timestamp)
+        return result
+
+    def trail_details(self):
+        details = []
+        for _, trail in sorted(self.trails.items()):
+            rows = self.points.rows(trail.point_ids)
+            result = {field: getattr(trail, field) for field in TRAIL_COLUMNS if field != "created"}
+            result["Features"] = [
+                {"Trail_FeatureID": feature_id, "Trail_Feature": self.features[feature_id]}
+                for feature_id in trail.feature_ids if feature_id in self.features
+            ]
+            result["LocationPoints"] = [
+                {
+                    "Location_Point": point_id,
+                    "Latitude": lat,
+                    "Longitude": lon,
+                    "Description": self.points.descriptions[row],
+                    "Order_no": order_no,
+                    "timestamp": timestamp,
+                }
+                for point_id, lat, lon, row, order_no, timestamp in zip(
+                    trail.point_ids.tolist(), trail.lat.tolist(), trail.lon.tolist(), rows.tolist(),
+                    trail.order_nos.tolist(), self.points.timestamp[rows].tolist(),
+                )
+            ]
+            details.append(result)
+        return details
+
+    def trail_location_points(self, trail_id):
+        trail = self.trails.get(trail_id)
+        if trail is None:
+            return None
+        return self.points.dump(self.points.rows(trail.point_ids))
+
+    def trail_features(self, trail_id):
+        trail = self.trails.get(trail_id)
+        if trail is None:
+            return None
+        return [
+            {"FeatureID": feature_id, "Feature": self.features[feature_id]}
+            for feature_id in trail.feature_ids if feature_id in self.features
+        ]
+
+    def all_features(self):
+        if self.feature_list is None:
+            self.feature_list = [
+                {"FeatureID": feature_id, "Feature": name} for feature_id, name in sorted(self.features.items())
+            ]
+        return self.feature_list
+
+    def feature(self, feature_id):
+        if feature_id not in self.features:
+            return None
+        return {"FeatureID": feature_id, "Feature": self.features[feature_id]}
+
+    def location_points(self):
+        return self.points.dump(np.arange(len(self.points.ids)))
+
+    def location_point(self, point_id):
+        row = self.points.row(point_id)
+        if row is None:
+            return None
+        return self.points.dump(np.array([row]))[0]
+
+def load_points(session, point_ids=None):
+    query = session.query(
+        LocationPoint.Location_Point, LocationPoint.Latitude, LocationPoint.Longitude,
+        LocationPoint.Description, LocationPoint.created, LocationPoint.timestamp,
+    )
+    if point_ids is None:
+        return [tuple(row) for row in query.all()]
+    return [tuple(row) for chunk in chunks(point_ids) for row in query.filter(LocationPoint.Location_Point.in_(chunk)).all()]
+
+def load_features(session, feature_ids=None):
+    query = session.query(Feature.Trail_FeatureID, Feature.Trail_Feature)
+    if feature_ids is None:
+        return dict(query.all())
+    return {
+        feature_id: name
+        for chunk in chunks(feature_ids)
+        for feature_id, name in query.filter(Feature.Trail_FeatureID.in_(chunk)).all()
+    }
+
+def load_trails(session, points, trail_ids=None):
+    trail_query = session.query(*[getattr(Trail, column) for column in TRAIL_COLUMNS])
+    feature_query = session.query(TrailFeature.TrailID, TrailFeature.Trail_FeatureID)
+    link_query = session.query(
+        TrailLocationPt.TrailID, TrailLocationPt.Location_Point, TrailLocationPt.Order_no
+    ).order_by(TrailLocationPt.TrailID, TrailLocationPt.Order_no)
+
+    queries = [(trail_query, feature_query, link_query)]
+    if trail_ids is not None:
+        queries = [
+            (
+                trail_query.filter(Trail.TrailID.in_(chunk)),
+                feature_query.filter(TrailFeature.TrailID.in_(chunk)),
+                link_query.filter(TrailLocationPt.TrailID.in_(chunk)),
+            )
+            for chunk in chunks(trail_ids)
+        ]
+
+    trails = {}
+    for trails_in, features_in, links_in in queries:
+        feature_ids = {}
+        for trail_id, feature_id in features_in.all():
+            feature_ids.setdefault(trail_id, []).append(feature_id)
+        links = {}
+        for trail_id, point_id, order_no in links_in.all():
+            links.setdefault(trail_id, []).append((point_id, order_no))
+        for row in trails_in.all():
+            trails[row[0]] = TrailRecord(row, feature_ids.get(row[0], ()), links.get(row[0], ()), points)
+    return trails
+
+class ReadModel:
+    # Serves catalogue reads from memory instead of the ORM. Invalidations only mark
+    # what changed; the next read builds a new snapshot that shares everything else
+    # with the last one and swaps it in.
+    def __init__(self):
+        self.snapshot = None
+        self.dirty = {"trail": set(), "feature": set(), "location_point": set()}
+        self.reload_all = True
+        self.lock = threading.Lock()
+        subscribe(self.on_invalidate)
+
+    def on_invalidate(self, topic, keys):
+        with self.lock:
+            if topic not in self.dirty:
+                return
+            if keys:
+                self.dirty[topic].update(keys)
+            else:
+                self.reload_all = True
+
+    def current(self):
+        # No lock unless something has changed since the snapshot was built
+        snapshot = self.snapshot
+        if snapshot is None or self.reload_all or any(self.dirty.values()):
+            snapshot = self.refresh()
+        return snapshot
+
+    def refresh(self):
+        with self.lock:
+            # Read on a connection of its own to the primary, never the request's
+            # session, so a snapshot only ever holds committed rows
+            with Session(db.engine) as session:
+                if self.reload_all:
+                    points = PointTable(load_points(session))
+                    snapshot = Snapshot(load_trails(session, points), load_features(session), points)
+                    metrics.increment("read_model.rebuild")
+                elif any(self.dirty.values()):
+                    snapshot = self.apply_changes(session, self.snapshot)
+                    metrics.increment("read_model.update")
+                else:
+                    return self.snapshot
+
+            self.snapshot = snapshot
+            self.reload_all = False
+            self.dirty = {topic: set() for topic in self.dirty}
+            return snapshot
+
+    def apply_changes(self, session, snapshot):
+        points = snapshot.points
+        trail_ids = set(self.dirty["trail"])
+        if self.dirty["location_point"]:
+            changed = load_points(session, self.dirty["location_point"])
+            deleted = self.dirty["location_point"] - {row[0] for row in changed}
+            points = points.patched(changed, deleted)
+            # Trails through a moved point carry its coordinates too
+            for chunk in chunks(self.dirty["location_point"]):
+                trail_ids.update(
+                    trail_id for (trail_id,) in session.query(TrailLocationPt.TrailID)
+                    .filter(TrailLocationPt.Location_Point.in_(chunk)).distinct()
+                )
+
+        features = snapshot.features
+        if self.dirty["feature"]:
+            features = dict(features)
+            loaded = load_features(session, self.dirty["feature"])
+            for feature_id in self.dirty["feature"]:
+                if feature_id in loaded:
+                    features[feature_id] = loaded[feature_id]
+                else:
+                    features.pop(feature_id, None)
+
+        trails = snapshot.trails
+        if trail_ids:
+            trails = dict(trails)
+            loaded = load_trails(session, points, trail_ids)
+            for trail_id in trail_ids:
+                if trail_id in loaded:
+                    trails[trail_id] = loaded[trail_id]
+                else:
+                    trails.pop(trail_id, None)
+
+        return Snapshot(trails, features, points)
+
+def use_read_model():
+    # A batch reads its own uncommitted writes, so its reads go through the ORM
+    if app.config["SNAPSHOT_FILE"]:
+        return True
+    return app.config["READ_MODEL"] and not (has_app_context() and g.get("defer_commit"))
+
+if app.config["SNAPSHOT_FILE"]:
+    # Read-only mode: the catalogue is a memory-mapped snapshot file with no database
+    from columnar import MappedReadModel
+    read_model = MappedReadModel(app.config["SNAPSHOT_FILE"])
+else:
+    read_model = ReadModel()
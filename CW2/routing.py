@@ -0,0 +1,96 @@
+import itertools
+import time
+from functools import wraps
+from flask import current_app, g, has_app_context, has_request_context, request
+from flask_sqlalchemy.session import Session
+import metrics
+
+# Cookie that carries the end of the read-your-writes window between workers
+READ_YOUR_WRITES_COOKIE = "cw2_read_primary_until"
+
+# Last write time per client, for clients that come back to the same worker
+_last_write = {}
+_replica_counter = itertools.count()
+
+class RoutingSession(Session):
+    # Send queries to the replica chosen for this request by @read_only.
+    # Flushes always go to the primary.
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_app_context():
+            bind_key = g.get("db_bind_key")
+            if bind_key:
+                return self._db.engines[bind_key]
+
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+def client_identity():
+    auth = request.authorization
+    if auth and auth.username:
+        return auth.username
+    return request.remote_addr
+
+def record_write():
+    # Called after every commit so the writer's next reads come from the primary
+    if not has_request_context():
+        return
+
+    now = time.time()
+    window = current_app.config["READ_YOUR_WRITES_SECONDS"]
+    _last_write[client_identity()] = now
+    g.read_primary_until = now + window
+
+    # Drop clients whose window has long passed
+    if len(_last_write) > 10000:
+        for identity, written_at in list(_last_write.items()):
+            if now - written_at > window:
+                _last_write.pop(identity, None)
+
+def choose_bind_key():
+    replica_keys = current_app.config["REPLICA_BIND_KEYS"]
+    if not replica_keys:
+        metrics.increment("db_route.primary.no_replica")
+        return None
+
+    # A batch shares one transaction with its writes, so it must read from the primary
+    if g.get("defer_commit"):
+        metrics.increment("db_route.primary.transaction")
+        return None
+
+    # Read-your-writes: stay on the primary for a short window after this client wrote
+    now = time.time()
+    window = current_app.config["READ_YOUR_WRITES_SECONDS"]
+    last_write = _last_write.get(client_identity())
+    cookie_until = request.cookies.get(READ_YOUR_WRITES_COOKIE, type=float)
+    if (last_write and now - last_write < window) or (cookie_until and now < cookie_until):
+        metrics.increment("db_route.primary.read_your_writes")
+        return None
+
+    metrics.increment("db_route.replica")
+    return replica_keys[next(_replica_counter) % len(replica_keys)]
+
+def read_only(handler):
+    # Mark a handler as read-only so its queries can be served by a replica
+    @wraps(handler)
+    def wrapper(*args, **kwargs):
+        previous = g.get("db_bind_key")
+        g.db_bind_key = choose_bind_key()
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            g.db_bind_key = previous
+
+    return wrapper
+
+def set_read_your_writes_cookie(response):
+    read_primary_until = g.get("read_primary_until")
+    if read_primary_until:
+        response.set_cookie(
+            READ_YOUR_WRITES_COOKIE,
+            str(read_primary_until),
+            max_age=int(current_app.config["READ_YOUR_WRITES_SECONDS"]) + 1,
+            httponly=True,
+        )
+    return response
+
+def init_app(app):
+    app.after_request(set_read_your_writes_cookie)
@@ -0,0 +1,396 @@
+import argparse
+import math
+import time
+import numpy as np
+from sqlalchemy import insert
+from config import app, db
+from facets import rebuild_facets
+from progress import report_progress
+from geometry import KM_PER_DEGREE, haversine_km
+from invalidation import ensure_started, invalidate
+from transactions import commit_changes
+from changes import take_change_seq
+from models import User, Trail, Feature, TrailFeature, LocationPoint, TrailLocationPt, coordinate_key, london_now
+
+# Sample data, loaded into every new database so there are accounts to log in with
+SAMPLE_DATA = [
+    {
+        "email": "grace@plymouth.ac.uk",
+        "role": "admin",
+        "trails": [
+            {
+                "Trail_name": "Forest Walk",
+                "Trail_Summary": "A peaceful trail through the forest.",
+                "Trail_Description": "Great spot to see deer early morning!",
+                "Difficulty": "Moderate",
+                "Location": "Dartmoor Forest",
+                "Length": 5.2,
+                "Elevation_gain": 200,
+                "Route_type": "Loop",
+                "features": ["Deer Watching", "Rocky Path"],
+                "locations": [
+                    {"Latitude": 50.123, "Longitude": -3.789, "Description": "Trailhead"},
+                    {"Latitude": 50.124, "Longitude": -3.790, "Description": "Deer Spot"},
+                ],
+            },
+            {
+                "Trail_name": "River Walk",
+                "Trail_Summary": "A scenic walk along the river.",
+                "Trail_Description": "Great for spotting birds and wildflowers.",
+                "Difficulty": "Easy",
+                "Location": "Tavy Valley",
+                "Length": 3.8,
+                "Elevation_gain": 50,
+                "Route_type": "Out & Back",
+                "features": ["Bird Watching", "Waterfront"],
+                "locations": [
+                    {"Latitude": 50.135, "Longitude": -3.754, "Description": "River Bridge"},
+                    {"Latitude": 50.136, "Longitude": -3.755, "Description": "Picnic Spot"},
+                ],
+            },
+        ],
+    },
+    {
+        "email": "tim@plymouth.ac.uk",
+        "role": "user"
+    },
+    {
+        "email": "ada@plymouth.ac.uk",
+        "role": "user"
+    },
+]
+
+# Synthetic trails are written this many points at a time, each batch in its own
+# transaction, so a large seed holds no long locks and an interrupted one keeps
+# every batch before it
+SEED_BATCH = 5000
+
+# SQL Server caps a statement at 2100 parameters, so IN lists are chunked
+LOOKUP_CHUNK = 1000
+
+# Synthetic trails are spread over these areas: name, centre latitude and longitude,
+# and the spread of trailheads around the centre in km
+REGIONS = [
+    ("Dartmoor", 50.57, -3.92, 15),
+    ("Exmoor", 51.13, -3.64, 12),
+    ("New Forest", 50.87, -1.63, 10),
+    ("Brecon Beacons", 51.88, -3.44, 15),
+    ("Snowdonia", 53.07, -3.92, 18),
+    ("Peak District", 53.35, -1.83, 15),
+    ("Yorkshire Dales", 54.23, -2.15, 18),
+    ("Lake District", 54.46, -3.09, 15),
+    ("Northumberland", 55.25, -2.25, 20),
+    ("Cairngorms", 57.08, -3.67, 25),
+]
+
+DIFFICULTIES = (("Easy", 0.45), ("Moderate", 0.4), ("Hard", 0.15))
+ROUTE_TYPES = (("Loop", 0.45), ("Out & Back", 0.35), ("Point to Point", 0.2))
+
+FEATURE_NAMES = [
+    "Waterfall", "Viewpoint", "Woodland", "Waterfront", "Bird Watching", "Deer Watching",
+    "Rocky Path", "Steep Climb", "Summit", "Moorland", "Stream Crossing", "Wildflowers",
+    "Historic Site", "Stone Circle", "Castle", "Cafe", "Pub", "Picnic Area", "Car Park",
+    "Dog Friendly", "Bridleway", "Boardwalk", "Stepping Stones", "Ridge", "Lake",
+    "Reservoir", "Beach", "Cliffs", "Cave", "Mine Workings", "Bog", "Heather",
+    "Ancient Woodland", "Wild Camping", "Accessible", "Bike Friendly", "Tor", "Quarry",
+    "Railway Path", "Nature Reserve",
+]
+
+NAME_WORDS = (
+    ("Old", "High", "Long", "Hidden", "Green", "Misty", "Quiet", "Upper", "Lower", "Windy"),
+    ("Ridge", "Valley", "River", "Forest", "Moor", "Tor", "Lake", "Combe", "Fell", "Glen"),
+    ("Walk", "Trail", "Way", "Path", "Circuit", "Ramble", "Loop", "Round"),
+)
+
+POINT_DESCRIPTIONS = ("Trailhead", "Gate", "Stile", "Footbridge", "Junction", "Viewpoint", "Cairn", "Signpost")
+
+# How far walkers go between recorded points (km), and how much the path turns per point
+STEP_KM = (0.03, 0.25)
+TURN_SPREAD = 0.35
+
+# Chance a synthetic trail starts where an earlier one started or ended, sharing
+# that point, so trails join up into a network like real ones
+SHARED_START = 0.25
+RECENT_ENDPOINTS = 50
+
+def weighted(rng, choices):
+    values, weights = zip(*choices)
+    return values[rng.choice(len(values), p=weights)]
+
+def walk(rng, start_lat, start_lon, count, route_type):
+    # A path that mostly keeps its heading; a loop turns a full circle over its length
+    headings = rng.uniform(0, 2 * math.pi) + np.cumsum(rng.normal(0, TURN_SPREAD, count - 1))
+    if route_type == "Loop":
+        headings += np.linspace(0, 2 * math.pi, count - 1)
+    steps = rng.uniform(*STEP_KM, count - 1)
+    lat = start_lat + np.concatenate(([0], np.cumsum(steps * np.cos(headings)))) / KM_PER_DEGREE
+    lon = start_lon + np.concatenate(([0], np.cumsum(
+        steps * np.sin(headings) / np.cos(np.radians(start_lat))
+    ))) / KM_PER_DEGREE
+    return lat, lon
+
+def elevation_gain(rng, count):
+    # Height changes a few metres between points, with the odd climb
+    changes = rng.normal(0, 4, count - 1) + rng.choice((0, 0, 0, 15), count - 1)
+    heights = np.maximum(0, rng.uniform(50, 500) + np.cumsum(changes))
+    return float(np.clip(np.diff(heights), 0, None).sum())
+
+def synthetic_trails(rng, count, points_per_trail, first_number, feature_names, owner_ids):
+    # Yields trails with their points and features; the same seed gives the same trails
+    recent = {region[0]: [] for region in REGIONS}
+    feature_weights = 1 / np.arange(1, len(feature_names) + 1)
+    feature_weights /= feature_weights.sum()
+
+    for index in range(count):
+        name, centre_lat, centre_lon, spread_km = REGIONS[rng.integers(len(REGIONS))]
+        route_type = weighted(rng, ROUTE_TYPES)
+        difficulty = weighted(rng, DIFFICULTIES)
+        point_count = max(2, round(rng.normal(points_per_trail, points_per_trail / 4)))
+
+        endpoints = recent[name]
+        if endpoints and rng.random() < SHARED_START:
+            start_lat, start_lon = endpoints[rng.integers(len(endpoints))]
+        else:
+            start_lat = centre_lat + rng.normal(0, spread_km) / KM_PER_DEGREE
+            start_lon = centre_lon + rng.normal(0, spread_km) / (KM_PER_DEGREE * math.cos(math.radians(centre_lat)))
+        lat, lon = walk(rng, start_lat, start_lon, point_count, route_type)
+        # Coordinates are stored to microdegrees, so round now to share points exactly
+        lat, lon = np.round(lat, 6), np.round(lon, 6)
+        endpoints.extend(((lat[0], lon[0]), (lat[-1], lon[-1])))
+        del endpoints[:-RECENT_ENDPOINTS]
+
+        descriptions = [None] * point_count
+        descriptions[0] = "Trailhead"
+        for position in rng.choice(point_count, size=min(point_count, 3), replace=False):
+            descriptions[position] = descriptions[position] or POINT_DESCRIPTIONS[rng.integers(1, len(POINT_DESCRIPTIONS))]
+
+        length = float(haversine_km(lat[:-1], lon[:-1], lat[1:], lon[1:]).sum())
+        words = [words[rng.integers(len(words))] for words in NAME_WORDS]
+        features = rng.choice(len(feature_names), size=min(int(rng.integers(0, 5)), len(feature_names)), replace=False, p=feature_weights)
+
+        yield {
+            "Trail_name": f"{' '.join(words)} {first_number + index}",
+            "Trail_Summary": f"A {difficulty.lower()} {route_type.lower()} of {length:.1f} km in the {name}.",
+            "Trail_Description": f"{len(features)} features along {point_count} recorded points.",
+            "Difficulty": difficulty,
+            "Location": name,
+            "Length": round(length, 2),
+            "Elevation_gain": round(elevation_gain(rng, point_count), 1),
+            "Route_type": route_type,
+            "OwnerID": owner_ids[rng.integers(len(owner_ids))],
+            "features": [feature_names[feature] for feature in features],
+            "locations": [
+                {"Latitude": float(latitude), "Longitude": float(longitude), "Description": description}
+                for latitude, longitude, description in zip(lat, lon, descriptions)
+            ],
+        }
+
+class Seeder:
+    # Bulk-loads users, features and trails with multi-row INSERTs, reading generated
+    # IDs back with RETURNING instead of flushing row by row. Points are shared by
+    # coordinate like everywhere else, so a trail crossing an existing point uses it.
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.rows = {"users": 0, "features": 0, "trails": 0, "location_points": 0, "trail_links": 0}
+        self.feature_ids = {}
+
+    def add_users(self, users):
+        now = london_now()
+        rows = [{"Email_address": user["email"], "Role": user["role"], "timestamp": now} for user in users]
+        if not rows:
+            return []
+        inserted = db.session.execute(
+            insert(User.__table__).returning(User.UserID, sort_by_parameter_order=True), rows
+        ).scalars().all()
+        self.rows["users"] += len(inserted)
+        return inserted
+
+    def add_features(self, names):
+        # Features are shared by name, so appending reuses the ones already there
+        missing = [name for name in dict.fromkeys(names) if name not in self.feature_ids]
+        for start in range(0, len(missing), LOOKUP_CHUNK):
+            chunk = missing[start:start + LOOKUP_CHUNK]
+            self.feature_ids.update(
+                db.session.query(Feature.Trail_Feature, Feature.Trail_FeatureID).filter(Feature.Trail_Feature.in_(chunk)).all()
+            )
+        missing = [name for name in missing if name not in self.feature_ids]
+        if missing:
+            now = london_now()
+            seq = take_change_seq(db.session)
+            self.feature_ids.update(db.session.execute(
+                insert(Feature.__table__).returning(Feature.Trail_Feature, Feature.Trail_FeatureID),
+                [
+                    {"Trail_Feature": name, "created": now, "timestamp": now, "Change_seq": seq, "Created_seq": seq}
+                    for name in missing
+                ],
+            ).all())
+            self.rows["features"] += len(missing)
+
+    def add_trails(self, trails):
+        if not trails:
+            return
+        now = london_now()
+        # Rows are stamped for the change feed as they are written, rather than updated
+        # again at commit
+        seq = take_change_seq(db.session)
+        stamps = {"created": now, "timestamp": now, "Change_seq": seq, "Created_seq": seq}
+        trail_ids = db.session.execute(
+            insert(Trail.__table__).returning(Trail.TrailID, sort_by_parameter_order=True),
+            [
+                dict({key: value for key, value in trail.items() if key not in ("features", "locations")}, **stamps)
+                for trail in trails
+            ],
+        ).scalars().all()
+        self.rows["trails"] += len(trail_ids)
+
+        # Reuse points that already exist, insert the rest
+        trail_keys = [
+            [coordinate_key(location["Latitude"], location["Longitude"]) for location in trail["locations"]]
+            for trail in trails
+        ]
+        new_points = {}
+        for trail, keys in zip(trails, trail_keys):
+            for key, location in zip(keys, trail["locations"]):
+                new_points.setdefault(key, location)
+        point_ids = {}
+        keys = list(new_points)
+        for start in range(0, len(keys), LOOKUP_CHUNK):
+            point_ids.update(
+                db.session.query(LocationPoint.Coord_key, LocationPoint.Location_Point)
+                .filter(LocationPoint.Coord_key.in_(keys[start:start + LOOKUP_CHUNK]))
+                .all()
+            )
+        rows = [
+            dict(location, Coord_key=key, **stamps)
+            for key, location in new_points.items() if key not in point_ids
+        ]
+        if rows:
+            inserted = db.session.execute(
+                insert(LocationPoint.__table__).returning(LocationPoint.Coord_key, LocationPoint.Location_Point), rows
+            ).all()
+            point_ids.update(inserted)
+            self.rows["location_points"] += len(inserted)
+
+        # A trail passes through a point at most once, so a path that comes back to
+        # the same spot keeps only its first visit
+        links, feature_links = [], []
+        for trail_id, trail, keys in zip(trail_ids, trails, trail_keys):
+            linked = set()
+            for key in keys:
+                point_id = point_ids[key]
+                if point_id not in linked:
+                    linked.add(point_id)
+                    links.append({"TrailID": trail_id, "Location_Point": point_id, "Order_no": len(linked)})
+            for name in dict.fromkeys(trail["features"]):
+                feature_links.append({"TrailID": trail_id, "Trail_FeatureID": self.feature_ids[name]})
+        db.session.execute(insert(TrailLocationPt.__table__), links)
+        if feature_links:
+            db.session.execute(insert(TrailFeature.__table__), feature_links)
+        self.rows["trail_links"] += len(links) + len(feature_links)
+
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        total = sum(self.rows.values())
+        counts = ", ".join(f"{count} {table.replace('_', ' ')}" for table, count in self.rows.items())
+        print(f"Inserted {counts} in {elapsed:.1f}s ({total / elapsed if elapsed else 0:.0f} rows/s).")
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        return dict(self.rows, seconds=round(elapsed, 2), rows_per_second=round(sum(self.rows.values()) / elapsed if elapsed else 0))
+
+def load_sample_data(seeder):
+    for user, user_id in zip(SAMPLE_DATA, seeder.add_users(SAMPLE_DATA)):
+        # Only admin users upload trails
+        if user["role"] == "admin" and "trails" in user:
+            trails = [dict(trail, OwnerID=user_id) for trail in user["trails"]]
+            seeder.add_features([name for trail in trails for name in trail["features"]])
+            seeder.add_trails(trails)
+
+def reset_database(keep_jobs=False):
+    # A reseed running as a background job must not drop the table it is tracked in
+    tables = [
+        table for table in db.metadata.sorted_tables
+        if not (keep_jobs and table.name == "cw2_job")
+    ]
+    db.metadata.drop_all(bind=db.engine, tables=tables)
+    print("Tables dropped successfully!")
+    db.metadata.create_all(bind=db.engine, tables=tables)
+    print("Tables created successfully!")
+
+def seed_database(trails=0, points_per_trail=50, users=None, features=len(FEATURE_NAMES), seed=0,
+                  append=False, keep_jobs=False, batch_points=SEED_BATCH):
+    # Without append, drops every table and loads the sample data before adding
+    # `trails` synthetic trails. Users default to one for every 10 trails, one in 20
+    # of them admins, who own the new trails.
+    if not append:
+        reset_database(keep_jobs)
+
+    seeder = Seeder()
+    if not append:
+        load_sample_data(seeder)
+        db.session.commit()
+
+    rng = np.random.default_rng(seed)
+    user_count = trails // 10 if users is None else users
+    first_user = (db.session.query(db.func.max(User.UserID)).scalar() or 0) + 1
+    new_users = [
+        {"email": f"walker{first_user + index}@example.com", "role": "admin" if index % 20 == 0 else "user"}
+        for index in range(user_count)
+    ]
+    user_ids = seeder.add_users(new_users)
+    owner_ids = [user_id for user_id, user in zip(user_ids, new_users) if user["role"] == "admin"]
+    if trails and not owner_ids:
+        owner_ids = [user_id for (user_id,) in db.session.query(User.UserID).filter(User.Role == "admin").all()]
+        if not owner_ids:
+            raise ValueError("Synthetic trails need an admin to own them; add some users.")
+
+    feature_names = FEATURE_NAMES[:features] + [f"Feature {number}" for number in range(len(FEATURE_NAMES) + 1, features + 1)]
+    if trails:
+        seeder.add_features(feature_names)
+    db.session.commit()
+
+    first_number = (db.session.query(db.func.max(Trail.TrailID)).scalar() or 0) + 1
+    batch, batch_size = [], 0
+    for index, trail in enumerate(synthetic_trails(rng, trails, points_per_trail, first_number, feature_names, owner_ids)):
+        batch.append(trail)
+        batch_size += len(trail["locations"])
+        if batch_size >= batch_points or index == trails - 1:
+            seeder.add_trails(batch)
+            db.session.commit()
+            batch, batch_size = [], 0
+            report_progress(index + 1, trails)
+            seeder.report()
+
+    rebuild_facets()
+    db.session.commit()
+    return seeder.summary()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load the sample data and synthetic trails at a chosen scale.")
+    parser.add_argument("--trails", type=int, default=0, help="synthetic trails to add")
+    parser.add_argument("--points", type=int, help="total points to add instead of --trails, in trails of --points-per-trail")
+    parser.add_argument("--points-per-trail", type=int, default=50, help="average points in a synthetic trail")
+    parser.add_argument("--users", type=int, help="users to add (default: one per 10 trails)")
+    parser.add_argument("--features", type=int, default=len(FEATURE_NAMES), help="distinct features trails draw from")
+    parser.add_argument("--seed", type=int, default=0, help="random seed; the same seed gives the same data")
+    parser.add_argument("--append", action="store_true", help="add to the existing data instead of rebuilding the database")
+    parser.add_argument("--batch", type=int, default=SEED_BATCH, help="points written per transaction")
+    args = parser.parse_args()
+
+    trail_count = -(-args.points // args.points_per_trail) if args.points else args.trails
+    with app.app_context():
+        # Servers running against the database reload what they hold of it
+        ensure_started(app)
+        summary = seed_database(
+            trails=trail_count,
+            points_per_trail=args.points_per_trail,
+            users=args.users,
+            features=args.features,
+            seed=args.seed,
+            append=args.append,
+            batch_points=args.batch,
+        )
+        for topic in ("trail", "feature", "location_point", "user"):
+            invalidate(topic)
+        commit_changes()
+        print(f"Database seeded: {summary}")
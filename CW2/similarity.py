@@ -0,0 +1,245 @@
+import threading
+from collections import Counter, namedtuple
+import numpy as np
+from authentication import require_auth_and_role
+from config import app
+from geometry import (
+    trail_sequences, haversine_km, project_to_segments, cell_of, cell_key, KM_PER_DEGREE
+)
+import metrics
+
+# Every trail is compared as this many points spaced evenly along it, so trails
+# recorded with different numbers of points can still be compared point for point
+SAMPLES = 32
+
+# Trails whose discrete Fréchet distance is within DUPLICATE_KM follow the same route
+DUPLICATE_KM = 0.1
+
+# Part of a trail lying within OVERLAP_KM of another counts as shared with it; trails
+# sharing at least MIN_OVERLAP of either one's length overlap
+OVERLAP_KM = 0.05
+MIN_OVERLAP = 0.5
+
+# A trail's samples, as float32 to keep the cache small, and the grid cells they fall in
+Signature = namedtuple("Signature", "trail_id name lat lon length_km cells")
+
+def make_signature(trail_id, name, lat, lon):
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    cumulative = np.concatenate(([0.0], np.cumsum(haversine_km(lat[:-1], lon[:-1], lat[1:], lon[1:]))))
+    along = np.linspace(0.0, cumulative[-1], SAMPLES)
+    if cumulative[-1] > 0:
+        lat, lon = np.interp(along, cumulative, lat), np.interp(along, cumulative, lon)
+    else:
+        lat, lon = np.full(SAMPLES, lat[0]), np.full(SAMPLES, lon[0])
+    cells = frozenset(np.unique(cell_key(*cell_of(lat, lon))).tolist())
+    return Signature(trail_id, name, lat.astype(np.float32), lon.astype(np.float32), float(cumulative[-1]), cells)
+
+def discrete_frechet(distances):
+    # Discrete Fréchet distance for a stack of (n, m) distance matrices at once. Cells on
+    # the same anti-diagonal only depend on the two before it, so each is one NumPy step.
+    count, n, m = distances.shape
+    coupling = np.full((count, n, m), np.inf)
+    coupling[:, 0, 0] = distances[:, 0, 0]
+    for diagonal in range(1, n + m - 1):
+        i = np.arange(max(0, diagonal - m + 1), min(n, diagonal + 1))
+        j = diagonal - i
+        reach = np.full((count, len(i)), np.inf)
+        for di, dj in ((1, 0), (0, 1), (1, 1)):
+            valid = (i >= di) & (j >= dj)
+            reach[:, valid] = np.minimum(reach[:, valid], coupling[:, i[valid] - di, j[valid] - dj])
+        coupling[:, i, j] = np.maximum(reach, distances[:, i, j])
+    return coupling[:, -1, -1]
+
+def compare(query, candidates):
+    # Similarity of one signature to many, as arrays over the candidates
+    q_lat, q_lon = query.lat.astype(np.float64), query.lon.astype(np.float64)
+    c_lat = np.stack([candidate.lat for candidate in candidates]).astype(np.float64)
+    c_lon = np.stack([candidate.lon for candidate in candidates]).astype(np.float64)
+    q_lat_all, q_lon_all = np.broadcast_to(q_lat, c_lat.shape), np.broadcast_to(q_lon, c_lon.shape)
+
+    # Each sample's distance to the other trail's line, in both directions
+    def to_line(lat, lon, other_lat, other_lon):
+        distances, _ = project_to_segments(
+            lat[:, :, None], lon[:, :, None],
+            other_lat[:, None, :-1], other_lon[:, None, :-1], other_lat[:, None, 1:], other_lon[:, None, 1:],
+        )
+        return distances.min(axis=2)
+
+    query_to_candidate = to_line(q_lat_all, q_lon_all, c_lat, c_lon)
+    candidate_to_query = to_line(c_lat, c_lon, q_lat_all, q_lon_all)
+    hausdorff = np.maximum(query_to_candidate.max(axis=1), candidate_to_query.max(axis=1))
+    overlap = (query_to_candidate <= OVERLAP_KM).mean(axis=1)
+    overlap_other = (candidate_to_query <= OVERLAP_KM).mean(axis=1)
+
+    # Hausdorff distance is a lower bound on Fréchet distance, so only pairs within
+    # DUPLICATE_KM of each other need the Fréchet pass. A trail walked the other way
+    # is the same route.
+    frechet = np.full(len(candidates), np.nan)
+    close = np.flatnonzero(hausdorff <= DUPLICATE_KM)
+    if len(close):
+        x_scale = np.cos(np.radians(q_lat.mean())) * KM_PER_DEGREE
+        samples = np.hypot(
+            (q_lon[None, :, None] - c_lon[close, None, :]) * x_scale,
+            (q_lat[None, :, None] - c_lat[close, None, :]) * KM_PER_DEGREE,
+        )
+        frechet[close] = np.minimum(discrete_frechet(samples), discrete_frechet(samples[:, :, ::-1]))
+    return hausdorff, overlap, overlap_other, frechet
+
+class SimilarityIndex:
+    # Signatures of every trail plus an inverted index from grid cell to trails, kept up
+    # to date trail by trail from the trail sequences. The duplicate report is built on
+    # first use and then only recomputed for the trails that change.
+    def __init__(self):
+        self.version = None
+        self.sequences = {}
+        self.signatures = {}
+        self.cell_trails = {}
+        self.pairs = None
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        version, sequences = trail_sequences.refresh()
+        with self.lock:
+            if version == self.version:
+                return
+            changed = trail_sequences.changed_since(self.version)
+            if changed is None:
+                self.signatures, self.cell_trails, self.pairs = {}, {}, None
+                changed = set(sequences)
+                metrics.increment("similarity.rebuild")
+            else:
+                metrics.increment("similarity.update", len(changed))
+
+            for trail_id in changed:
+                self.remove(trail_id)
+                sequence = sequences.get(trail_id)
+                if sequence is not None and len(sequence.point_ids):
+                    self.add(make_signature(trail_id, sequence.name, sequence.lat, sequence.lon))
+
+            self.sequences = sequences
+            if self.pairs is not None:
+                for trail_id in changed:
+                    if trail_id in self.signatures:
+                        self.find_pairs(trail_id)
+            self.version = version
+
+    def add(self, signature):
+        self.signatures[signature.trail_id] = signature
+        for cell in signature.cells:
+            self.cell_trails.setdefault(cell, set()).add(signature.trail_id)
+
+    def remove(self, trail_id):
+        signature = self.signatures.pop(trail_id, None)
+        if signature is None:
+            return
+        for cell in signature.cells:
+            trails = self.cell_trails[cell]
+            trails.discard(trail_id)
+            if not trails:
+                del self.cell_trails[cell]
+        if self.pairs is not None:
+            for other in self.pairs.pop(trail_id, {}):
+                self.pairs.get(other, {}).pop(trail_id, None)
+
+    def candidates(self, signature, point_ids):
+        # Trails sharing a location point, or enough grid cells to possibly overlap
+        shared_points = Counter()
+        with trail_sequences.lock:
+            for point_id in point_ids:
+                shared_points.update(trail_sequences.point_trails.get(point_id, ()))
+
+        shared_cells = Counter()
+        for cell in signature.cells:
+            shared_cells.update(self.cell_trails.get(cell, ()))
+
+        found = set(shared_points)
+        for trail_id, count in shared_cells.items():
+            other = self.signatures[trail_id]
+            if count >= MIN_OVERLAP * min(len(signature.cells), len(other.cells)):
+                found.add(trail_id)
+        found.discard(signature.trail_id)
+        return [self.signatures[trail_id] for trail_id in found if trail_id in self.signatures], shared_points
+
+    def similar(self, signature, point_ids, after=None):
+        candidates, shared_points = self.candidates(signature, point_ids)
+        if after is not None:
+            candidates = [candidate for candidate in candidates if candidate.trail_id > after]
+        metrics.increment("similarity.candidates", len(candidates))
+        if not candidates:
+            return []
+        hausdorff, overlap, overlap_other, frechet = compare(signature, candidates)
+
+        results = []
+        for index, candidate in enumerate(candidates):
+            duplicate = frechet[index] <= DUPLICATE_KM
+            if not duplicate and max(overlap[index], overlap_other[index]) < MIN_OVERLAP:
+                continue
+            results.append({
+                "TrailID": candidate.trail_id,
+                "Trail_name": candidate.name,
+                "relation": "duplicate" if duplicate else "overlap",
+                "frechet_km": None if np.isnan(frechet[index]) else round(float(frechet[index]), 4),
+                "hausdorff_km": round(float(hausdorff[index]), 4),
+                "overlap": round(float(overlap[index]), 4),
+                "overlap_other": round(float(overlap_other[index]), 4),
+                "shared_points": shared_points.get(candidate.trail_id, 0),
+            })
+        results.sort(key=lambda result: (result["relation"] != "duplicate", -result["overlap"]))
+        return results
+
+    def find_pairs(self, trail_id, after=None):
+        # Similar trails are found from either side, so the full report only compares
+        # each trail with those after it
+        signature = self.signatures[trail_id]
+        point_ids = self.sequences[trail_id].point_ids.tolist()
+        self.pairs.setdefault(trail_id, {})
+        for result in self.similar(signature, point_ids, after):
+            other = result["TrailID"]
+            self.pairs[trail_id][other] = result
+            # The same comparison seen from the other trail
+            self.pairs.setdefault(other, {})[trail_id] = dict(
+                result, TrailID=trail_id, Trail_name=signature.name,
+                overlap=result["overlap_other"], overlap_other=result["overlap"],
+            )
+
+    def report(self):
+        with self.lock:
+            if self.pairs is None:
+                self.pairs = {}
+                for trail_id in self.signatures:
+                    self.find_pairs(trail_id, after=trail_id)
+            report = []
+            for trail_id in sorted(self.pairs):
+                for other, result in sorted(self.pairs[trail_id].items()):
+                    if trail_id < other:
+                        report.append(dict(
+                            result, TrailID=trail_id, Trail_name=self.signatures[trail_id].name,
+                            Other_TrailID=other, Other_Trail_name=result["Trail_name"],
+                        ))
+            return report
+
+similarity_index = SimilarityIndex()
+
+def check_new_trail(location_points, existing_point_ids):
+    # Trails that a trail about to be created (POST /trails body) duplicates or overlaps
+    if app.config["DUPLICATE_TRAIL_CHECK"] == "off":
+        return []
+    # The trail sequences reload on their own session, so this only ever sees
+    # committed trails, even inside an idempotent request's transaction
+    similarity_index.refresh()
+    signature = make_signature(
+        None, None,
+        [point["Latitude"] for point in location_points],
+        [point["Longitude"] for point in location_points],
+    )
+    with similarity_index.lock:
+        return similarity_index.similar(signature, existing_point_ids)
+
+def find_duplicates(relation=None):
+    require_auth_and_role("admin")
+    similarity_index.refresh()
+    report = similarity_index.report()
+    if relation:
+        report = [pair for pair in report if pair["relation"] == relation]
+    return {"pairs": report}, 200
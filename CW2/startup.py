@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+basedir = pathlib.Path(__file__).parent.resolve()
+SPEC_SOURCE = basedir / "swagger.yml"
+
+# Build-time artifact: swagger.yml parsed and validated, stored as JSON with the
+# hash of the YAML it came from. Created with `python startup.py --compile`.
+COMPILED_SPEC = basedir / "swagger.compiled.json"
+
+# Wall-clock time of each startup phase in milliseconds, in the order they ran
+timings = {}
+
+@contextmanager
+def phase(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = round((time.perf_counter() - started) * 1000, 1)
+
+def source_hash():
+    return hashlib.sha256(SPEC_SOURCE.read_bytes()).hexdigest()
+
+def compile_spec():
+    # Parse and fully validate the spec once, at build time
+    import yaml
+    from connexion.spec import Specification
+
+    spec = yaml.safe_load(SPEC_SOURCE.read_text())
+    Specification.from_dict(spec)
+
+    COMPILED_SPEC.write_text(json.dumps({"source_sha256": source_hash(), "spec": spec}))
+    print(f"Compiled {SPEC_SOURCE.name} to {COMPILED_SPEC.name}")
+
+def load_compiled_spec():
+    # Returns the compiled spec, or None if it is missing or older than swagger.yml
+    if not COMPILED_SPEC.exists():
+        return None
+
+    compiled = json.loads(COMPILED_SPEC.read_text())
+    if SPEC_SOURCE.exists() and compiled["source_sha256"] != source_hash():
+        print(f"DEBUG: {COMPILED_SPEC.name} is out of date, loading {SPEC_SOURCE.name} instead.")
+        return None
+
+    return compiled["spec"]
+
+@contextmanager
+def skip_spec_validation():
+    # The compiled spec was validated when it was built, so skip Connexion's
+    # jsonschema validation of the whole document while it is loaded
+    from connexion.spec import Specification
+
+    original = Specification.__dict__["_validate_spec"]
+    Specification._validate_spec = classmethod(lambda cls, spec: None)
+    try:
+        yield
+    finally:
+        Specification._validate_spec = original
+
+def make_resolver(app):
+    # Handlers are wrapped with their rate limits and concurrency caps as they are
+    # resolved. A read-only snapshot server only resolves what the file can answer.
+    if app.config["SNAPSHOT_FILE"]:
+        from columnar import SnapshotResolver
+        return SnapshotResolver()
+
+    from admission import AdmissionResolver
+    return AdmissionResolver()
+
+def add_api(connex_app):
+    spec = load_compiled_spec()
+    if spec is None:
+        return connex_app.add_api(SPEC_SOURCE, resolver=make_resolver(connex_app.app))
+
+    with skip_spec_validation():
+        return connex_app.add_api(spec, resolver=make_resolver(connex_app.app))
+
+def parse_importtime(output):
+    # Lines look like "import time:   self [us] | cumulative | imported package"
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), depth, int(self_us) / 1000, int(cumulative_us) / 1000))
+    return imports
+
+def print_import_profile(limit=20):
+    # Start the app in a fresh interpreter with -X importtime and report where the time went
+    code = "import json, startup; import app; print(json.dumps(startup.timings))"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=basedir, capture_output=True, text=True, env=os.environ.copy()
+    )
+    if result.returncode != 0:
+        print(result.stderr)
+        sys.exit(result.returncode)
+
+    phases = json.loads(result.stdout.strip().splitlines()[-1])
+    imports = parse_importtime(result.stderr)
+
+    print("Startup phases:")
+    for name, elapsed in phases.items():
+        print(f"  {name:<30} {elapsed:>9.1f} ms")
+
+    # The app's own modules and what they import directly, by cumulative time
+    print("\nSlowest imports near the top of the tree (cumulative):")
+    top_level = sorted((i for i in imports if i[1] <= 2), key=lambda i: i[3], reverse=True)
+    for name, depth, self_ms, cumulative_ms in top_level[:limit]:
+        print(f"  {name:<50} {cumulative_ms:>9.1f} ms")
+
+    print("\nSlowest individual modules (self):")
+    for name, depth, self_ms, cumulative_ms in sorted(imports, key=lambda i: i[2], reverse=True)[:limit]:
+        print(f"  {name:<50} {self_ms:>9.1f} ms")
+
+    print(f"\nTotal import time: {sum(i[2] for i in imports):.1f} ms")
+
+if __name__ == "__main__":
+    if "--compile" in sys.argv:
+        compile_spec()
+    else:
+        print("Usage: python startup.py --compile")
@@ -1,20 +1,61 @@
-from datetime import datetime
 from math import radians, cos, sin, sqrt, atan2
 from flask import make_response, abort, request
 from config import db
 from models import (
     Trail, trails_schema, trail_schema,
     LocationPoint, location_point_schema, location_points_schema,
-    TrailLocationPt, trail_location_pt_schema, Feature, TrailFeature, feature_schema
+    TrailLocationPt, trail_location_pt_schema, Feature, TrailFeature, feature_schema,
+    coordinate_key, london_now
 )
 from authentication import require_auth, require_auth_and_role
-
+from transactions import commit_changes
+from progress import report_progress
+from routing import read_only
+from coalescing import coalesce
+from circuit import serve_stale
+from idempotency import idempotent
+from versioning import etag_header, trail_etag_headers, check_if_match, lock_trail, retry_on_conflict
+from changes import record_tombstone, mark_changed
+from invalidation import LocalCache, invalidate
+from readmodel import read_model, use_read_model
+from config import app
+import facets
+import similarity
+
+# Per-worker caches of the catalogue lists, dropped by invalidations from any worker
+trail_list_cache = LocalCache(["trail"], ttl=app.config["LOCAL_CACHE_TTL_SECONDS"])
+feature_list_cache = LocalCache(["feature"], ttl=app.config["LOCAL_CACHE_TTL_SECONDS"])
+
+# SQL Server caps a statement at 2100 parameters, so IN lists are chunked
+KEY_LOOKUP_CHUNK = 1000
+
+def find_points_by_key(keys):
+    # Resolve coordinate keys to existing LocationPoints, keyed by Coord_key
+    keys = list(set(keys))
+    found = {}
+    for start in range(0, len(keys), KEY_LOOKUP_CHUNK):
+        chunk = keys[start:start + KEY_LOOKUP_CHUNK]
+        for point in LocationPoint.query.filter(LocationPoint.Coord_key.in_(chunk)).all():
+            found[point.Coord_key] = point
+    return found
+
+@read_only
+@serve_stale
+@coalesce
 def get_all_trails():
-    # Fetch all trails
-    trails = Trail.query.all()
+    if use_read_model():
+        trails = read_model.current().basic_trails()
+    else:
+        trails = trail_list_cache.get_or_compute("all", load_basic_trails)
     if not trails:
         abort(404, "No trails found")
 
+    return trails
+
+def load_basic_trails():
+    # Fetch all trails
+    trails = Trail.query.all()
+
     # Return basic trail information
     return [
         {
@@ -30,11 +71,20 @@ def get_all_trails():
         for trail in trails
     ]
 
+@read_only
+@serve_stale
+@coalesce
 def get_all_trails_details():
     user = require_auth()
     if not user:
         abort(401, "Authentication required.")
 
+    if use_read_model():
+        all_trails_with_details = read_model.current().trail_details()
+        if not all_trails_with_details:
+            abort(404, "No trails found")
+        return all_trails_with_details
+
     trails = Trail.query.all()
     if not trails:
         abort(404, "No trails found")
@@ -89,6 +139,7 @@ def get_all_trails_details():
             "Features": formatted_features,
             "LocationPoints": formatted_location_points,
             "timestamp": trail.timestamp,
+            "Version": trail.Version,
         }
 
         all_trails_with_details.append(formatted_trail)
@@ -96,6 +147,7 @@ def get_all_trails_details():
     return all_trails_with_details
 
 
+@idempotent
 def create_trail():
     user = require_auth_and_role("admin")  # Ensure only admin users can create trails
     if not user:
@@ -124,6 +176,32 @@ def create_trail():
     if existing_trail:
         abort(406, f"Trail with name {trail_name} already exists.")
 
+    # Validate the points and work out their coordinate keys up front
+    seen_keys = set()
+    for loc in location_points:
+        if loc.get("Latitude") is None or loc.get("Longitude") is None or loc.get("Description") is None:
+            abort(400, "Each location point must have Latitude, Longitude, and Description.")
+        check_coordinates(loc["Latitude"], loc["Longitude"])
+        key = coordinate_key(loc["Latitude"], loc["Longitude"])
+        if key in seen_keys:
+            abort(400, f"Duplicate location point ({loc['Latitude']}, {loc['Longitude']}) in trail.")
+        seen_keys.add(key)
+        loc["Coord_key"] = key
+
+    # Resolve every existing point in one lookup instead of one query per point
+    existing_points = find_points_by_key(seen_keys)
+
+    # Same route as an existing trail under a different name
+    similar_trails = similarity.check_new_trail(
+        location_points, [point.Location_Point for point in existing_points.values()]
+    )
+    duplicates = [trail for trail in similar_trails if trail["relation"] == "duplicate"]
+    if duplicates and app.config["DUPLICATE_TRAIL_CHECK"] == "reject":
+        abort(406, {
+            "detail": f"Trail {trail_name} follows the same route as an existing trail.",
+            "similar_trails": duplicates,
+        })
+
     # Create the trail object (without OwnerID)
     new_trail = trail_schema.load(trail_data, session=db.session)
 
@@ -133,22 +211,20 @@ def create_trail():
     # Add the trail to the session
     db.session.add(new_trail)
     db.session.flush()
+    facets.trail_added(new_trail)
 
     # Handle LocationPoints and check distances
     MAX_DISTANCE = 10.0
     location_point_details = []
-    for index, loc in enumerate(location_points):
-        latitude = loc.get("Latitude")
-        longitude = loc.get("Longitude")
-        description = loc.get("Description")
+    new_points = []
+    for loc in location_points:
+        latitude = loc["Latitude"]
+        longitude = loc["Longitude"]
+        description = loc["Description"]
 
-        if latitude is None or longitude is None or description is None:
-            abort(400, "Each location point must have Latitude, Longitude, and Description.")
-
-        # Check if the location point already exists
-        existing_point = LocationPoint.query.filter_by(Latitude=latitude, Longitude=longitude).one_or_none()
+        existing_point = existing_points.get(loc["Coord_key"])
         if existing_point:
-            location_point_id = existing_point.Location_Point
+            location_point = existing_point
         else:
             # Validate distances with all existing points in the trail
             for existing_loc in location_point_details:
@@ -170,53 +246,77 @@ def create_trail():
                         "distance_km": round(distance, 2)
                     })
 
-            # Create a new location point
-            new_location_point = LocationPoint(
+            location_point = LocationPoint(
                 Latitude=latitude,
                 Longitude=longitude,
                 Description=description,
-                timestamp=datetime.now()
+                Coord_key=loc["Coord_key"],
+                timestamp=london_now()
             )
-            db.session.add(new_location_point)
-            db.session.flush()  # Get the new location point ID
-            location_point_id = new_location_point.Location_Point
-
-        # Add the location point to the trail
-        new_trail_location = TrailLocationPt(
-            TrailID=new_trail.TrailID,
-            Location_Point=location_point_id,
-            Order_no=index + 1
-        )
-        db.session.add(new_trail_location)
+            new_points.append(location_point)
 
-        # Append details for the response
         location_point_details.append({
-            "Location_Point": location_point_id,
+            "point": location_point,
             "Latitude": latitude,
             "Longitude": longitude,
             "Description": description,
-            "Order_no": index + 1
+            "Order_no": len(location_point_details) + 1
         })
 
-    db.session.commit()
+    # Insert all missing points in a single batched flush
+    if new_points:
+        db.session.add_all(new_points)
+        db.session.flush()
+
+    # Add the location points to the trail
+    db.session.add_all([
+        TrailLocationPt(
+            TrailID=new_trail.TrailID,
+            Location_Point=details["point"].Location_Point,
+            Order_no=details["Order_no"]
+        )
+        for details in location_point_details
+    ])
+
+    # Swap the ORM objects for their IDs in the response
+    for details in location_point_details:
+        details["Location_Point"] = details.pop("point").Location_Point
+
+    invalidate("trail", new_trail.TrailID)
+    # With no keys this would invalidate every location point
+    if new_points:
+        invalidate("location_point", *[point.Location_Point for point in new_points])
+    commit_changes()
 
     # Construct enhanced response
     response_data = trail_schema.dump(new_trail)
     response_data["LocationPoints"] = location_point_details
+    if similar_trails:
+        response_data["similar_trails"] = similar_trails
 
     return response_data, 201
 
+@read_only
+@serve_stale
+@coalesce
 def get_one_trail(trail_id):
     user = require_auth()
     if not user:
         abort(401, "Authentication required.")
-        
+
+    if use_read_model():
+        trail = read_model.current().trail(trail_id)
+        if trail is None:
+            abort(404, f"Trail with ID {trail_id} not found")
+        return trail, 200, etag_header(trail["Version"])
+
     trail = Trail.query.filter(Trail.TrailID == trail_id).one_or_none()
     if trail is not None:
-        return trail_schema.dump(trail)
+        return trail_schema.dump(trail), 200, etag_header(trail.Version)
     else:
         abort(404, f"Trail with ID {trail_id} not found")
 
+@retry_on_conflict
 def update_trail(trail_id):
     user = require_auth_and_role("admin")  
     if not user:
@@ -228,14 +328,20 @@ def update_trail(trail_id):
     existing_trail = Trail.query.filter(Trail.TrailID == trail_id).one_or_none()
     if not existing_trail:
         abort(404, f"Trail with ID {trail_id} not found.")
+    check_if_match(existing_trail)
 
-    # Update only provided fields
+    # Update only provided fields; the version is the server's to set
+    old_facet_values = facets.trail_facet_values(existing_trail)
     for key, value in trail_data.items():
-        setattr(existing_trail, key, value)
+        if key != "Version":
+            setattr(existing_trail, key, value)
+    facets.trail_changed(old_facet_values, existing_trail)
 
-    db.session.commit()
-    return trail_schema.dump(existing_trail), 200
+    invalidate("trail", existing_trail.TrailID)
+    commit_changes()
+    return trail_schema.dump(existing_trail), 200, etag_header(existing_trail.Version)
 
+@retry_on_conflict
 def delete_trail(trail_id):
     user = require_auth_and_role("admin")  
     if not user:
@@ -244,29 +350,48 @@ def delete_trail(trail_id):
     existing_trail = Trail.query.filter(Trail.TrailID == trail_id).one_or_none()
     if not existing_trail:
         abort(404, f"Trail with ID {trail_id} not found.")
+    check_if_match(existing_trail)
+
+    # Take the trail out of the facet counts
+    feature_ids = [link.Trail_FeatureID for link in TrailFeature.query.filter_by(TrailID=trail_id).all()]
+    facets.trail_removed(existing_trail, feature_ids)
 
     # Delete associated TrailFeature entries
     TrailFeature.query.filter_by(TrailID=trail_id).delete()
 
     # Delete associated TrailLocationPt entries
     trail_location_pts = TrailLocationPt.query.filter_by(TrailID=trail_id).all()
-    for trail_location_pt in trail_location_pts:
+    for index, trail_location_pt in enumerate(trail_location_pts):
+        report_progress(index, len(trail_location_pts))
         location_point = LocationPoint.query.filter(LocationPoint.Location_Point == trail_location_pt.Location_Point).one_or_none()
         if location_point:
             # Check if the location point is linked to other trails
             linked_trails_count = TrailLocationPt.query.filter_by(Location_Point=location_point.Location_Point).count()
             if linked_trails_count == 1:
                 db.session.delete(location_point)
+                record_tombstone("location_point", location_point.Location_Point)
+                invalidate("location_point", location_point.Location_Point)
 
     db.session.delete(existing_trail)
-    db.session.commit()
+    record_tombstone("trail", existing_trail.TrailID)
+    invalidate("trail", existing_trail.TrailID)
+    commit_changes()
     return make_response(f"Trail with ID {trail_id} successfully deleted", 200)
 
+@read_only
+@serve_stale
+@coalesce
 def get_location_point(location_point_id):
     user = require_auth()
     if not user:
         abort(401, "Authentication required.")
 
+    if use_read_model():
+        location_point = read_model.current().location_point(location_point_id)
+        if location_point is None:
+            abort(404, f"Location point with ID {location_point_id} not found")
+        return location_point
+
     location_point = LocationPoint.query.filter(LocationPoint.Location_Point == location_point_id).one_or_none()
 
     if location_point is not None:
@@ -274,24 +399,43 @@ def get_location_point(location_point_id):
     else:
         abort(404, f"Location point with ID {location_point_id} not found")
 
+@read_only
+@serve_stale
+@coalesce
 def get_all_features():
     user = require_auth()
     if not user:
         abort(401, "Authentication required.")
 
-    # Fetch all features from the database
-    features = Feature.query.all()
+    # Fetch all features (cached per worker)
+    if use_read_model():
+        features = read_model.current().all_features()
+    else:
+        features = feature_list_cache.get_or_compute("all", load_features)
     if not features:
         return {"message": "No features found in the database."}, 200
-    
-    # Serialize and return features
-    return [{"FeatureID": feature.Trail_FeatureID, "Feature": feature.Trail_Feature} for feature in features], 200
 
+    return features, 200
+
+def load_features():
+    # Fetch all features from the database and serialize them
+    features = Feature.query.all()
+    return [{"FeatureID": feature.Trail_FeatureID, "Feature": feature.Trail_Feature} for feature in features]
+
+@read_only
+@serve_stale
+@coalesce
 def get_feature_by_id(feature_id):
     user = require_auth()
     if not user:
         abort(401, "Authentication required.")
 
+    if use_read_model():
+        feature = read_model.current().feature(feature_id)
+        if feature is None:
+            abort(404, f"Feature with ID {feature_id} not found.")
+        return feature, 200
+
     # Fetch the feature with the given ID
     feature = Feature.query.filter(Feature.Trail_FeatureID == feature_id).one_or_none()
     if not feature:
@@ -310,20 +454,43 @@ def delete_feature_by_id(feature_id):
     if not feature:
         abort(404, f"Feature with ID {feature_id} not found.")
 
+    # Mark the trails that lose this feature as updated
+    linked_trail_ids = [
+        link.TrailID for link in TrailFeature.query.filter_by(Trail_FeatureID=feature_id).all()
+    ]
+    if linked_trail_ids:
+        Trail.query.filter(Trail.TrailID.in_(linked_trail_ids)).update(
+            {"timestamp": london_now(), "Version": Trail.Version + 1}, synchronize_session=False
+        )
+        mark_changed(Trail, linked_trail_ids)
+        invalidate("trail", *linked_trail_ids)
+
     # Delete all associations in TrailFeature
     TrailFeature.query.filter_by(Trail_FeatureID=feature_id).delete()
+    facets.feature_deleted(feature_id)
 
     # Delete the feature itself
     db.session.delete(feature)
-    db.session.commit()
+    record_tombstone("feature", feature_id)
+    invalidate("feature", feature_id)
+    commit_changes()
 
     return make_response(f"Feature with ID {feature_id} and its associations successfully deleted.", 200)
 
+@read_only
+@serve_stale
+@coalesce
 def get_all_location_points():
     user = require_auth()
     if not user:
         abort(401, "Authentication required.")
 
+    if use_read_model():
+        location_points = read_model.current().location_points()
+        if not location_points:
+            abort(404, "No location points found")
+        return location_points
+
     # Query all location points
     location_points = LocationPoint.query.all()
 
@@ -334,6 +501,7 @@ def get_all_location_points():
     # Return serialized location points
     return location_points_schema.dump(location_points)
 
+@retry_on_conflict
 def update_location_point(location_point_id):
     user = require_auth_and_role("admin")  
     if not user:
@@ -349,6 +517,25 @@ def update_location_point(location_point_id):
     new_lat = request_data.get("Latitude", location_point.Latitude)
     new_lon = request_data.get("Longitude", location_point.Longitude)
     new_description = request_data.get("Description", location_point.Description)
+    check_coordinates(new_lat, new_lon)
+
+    # Moving onto another point's coordinates would break the unique coordinate key
+    clashing_point = LocationPoint.query.filter(
+        LocationPoint.Coord_key == coordinate_key(new_lat, new_lon),
+        LocationPoint.Location_Point != location_point_id
+    ).one_or_none()
+    if clashing_point:
+        abort(400, f"Location point with ID {clashing_point.Location_Point} already exists at these coordinates.")
+
+    # Moving the point changes every trail it is on. Each trail is locked before its
+    # points are read, in ID order so two moves cannot deadlock, and If-Match has to
+    # list the ETag of every one of them.
+    trails = Trail.query.join(TrailLocationPt).filter(
+        TrailLocationPt.Location_Point == location_point_id
+    ).order_by(Trail.TrailID).all()
+    for trail in trails:
+        check_if_match(trail)
+        lock_trail(trail)
 
     # Check if the updated point exceeds 10 km for any associated trail
     MAX_DISTANCE = 10.0
@@ -388,17 +575,29 @@ def update_location_point(location_point_id):
     location_point.Latitude = new_lat
     location_point.Longitude = new_lon
     location_point.Description = new_description
-    location_point.timestamp = datetime.now()
+    location_point.timestamp = london_now()
 
-    db.session.commit()
+    invalidate("location_point", location_point.Location_Point)
+    if trails:
+        invalidate("trail", *[trail.TrailID for trail in trails])
+    commit_changes()
 
-    return location_point_schema.dump(location_point), 200
+    return location_point_schema.dump(location_point), 200, trail_etag_headers(trails)
 
+@read_only
+@serve_stale
+@coalesce
 def get_point_locations_for_trail(trail_id):
     user = require_auth()
     if not user:
         abort(401, "Authentication required.")
 
+    if use_read_model():
+        location_points = read_model.current().trail_location_points(trail_id)
+        if location_points is None:
+            abort(404, f"Trail with ID {trail_id} not found.")
+        return location_points
+
     # Check if the trail exists
     trail = Trail.query.filter(Trail.TrailID == trail_id).one_or_none()
     if not trail:
@@ -412,6 +611,7 @@ def get_point_locations_for_trail(trail_id):
     # Return the location points as JSON
     return location_points_schema.dump(trail_location_points)
 
+@idempotent
 def add_location_point():
     user = require_auth_and_role("admin")  
     if not user:
@@ -432,9 +632,10 @@ def add_location_point():
     latitude = request_data["Latitude"]
     longitude = request_data["Longitude"]
     description = request_data["Description"]
+    check_coordinates(latitude, longitude)
 
     # Check if the location point already exists
-    existing_point = LocationPoint.query.filter_by(Latitude=latitude, Longitude=longitude).one_or_none()
+    existing_point = LocationPoint.query.filter_by(Coord_key=coordinate_key(latitude, longitude)).one_or_none()
     if existing_point:
         return location_point_schema.dump(existing_point), 200 
 
@@ -443,10 +644,12 @@ def add_location_point():
         Latitude=latitude,
         Longitude=longitude,
         Description=description,
-        timestamp=datetime.now()
+        timestamp=london_now()
     )
     db.session.add(new_point)
-    db.session.commit()
+    db.session.flush()
+    invalidate("location_point", new_point.Location_Point)
+    commit_changes()
 
     return location_point_schema.dump(new_point), 201
 
@@ -467,20 +670,25 @@ def delete_location_point(location_point_id):
 
     # Delete the location point
     db.session.delete(location_point)
-    db.session.commit()
+    record_tombstone("location_point", location_point_id)
+    invalidate("location_point", location_point_id)
+    commit_changes()
 
     return {"message": f"Location point with ID {location_point_id} successfully deleted."}, 200
 
 
+@retry_on_conflict
 def update_trail_location_point(trail_id, location_point_id):
     user = require_auth_and_role("admin")  
     if not user:
         abort(403, "Unable to authenticate user.")
 
-    # Fetch the trail
+    # Fetch the trail and take its version before reading the order numbers
     trail = Trail.query.filter(Trail.TrailID == trail_id).one_or_none()
     if not trail:
         abort(404, f"Trail with ID {trail_id} not found.")
+    check_if_match(trail)
+    lock_trail(trail)
 
     # Fetch the location point relationship
     trail_location = TrailLocationPt.query.filter_by(
@@ -517,11 +725,14 @@ def update_trail_location_point(trail_id, location_point_id):
             ).update({"Order_no": TrailLocationPt.Order_no + 1}, synchronize_session=False)
 
         trail_location.Order_no = new_order_no
+        invalidate("trail", trail.TrailID)
 
-    db.session.commit()
+    commit_changes()
 
-    return trail_location_pt_schema.dump(trail_location), 200
+    return trail_location_pt_schema.dump(trail_location), 200, etag_header(trail.Version)
 
+@retry_on_conflict
+@idempotent
 def add_location_point_to_trail(trail_id, location_point_id):
     user = require_auth_and_role("admin")  
     if not user:
@@ -531,6 +742,7 @@ def add_location_point_to_trail(trail_id, location_point_id):
     trail = Trail.query.filter(Trail.TrailID == trail_id).one_or_none()
     if not trail:
         abort(404, f"Trail with ID {trail_id} not found.")
+    check_if_match(trail)
 
     # Fetch the location point
     location_point = LocationPoint.query.filter(LocationPoint.Location_Point == location_point_id).one_or_none()
@@ -548,6 +760,9 @@ def add_location_point_to_trail(trail_id, location_point_id):
     # Fetch the optional Order_no from query parameters
     order_no = request.args.get("Order_no", type=int)  # Optional, defaults to None
 
+    # Take the trail's version before reading the order numbers
+    lock_trail(trail)
+
     # Determine the maximum existing order number for the trail
     max_order_no = db.session.query(db.func.max(TrailLocationPt.Order_no)).filter_by(TrailID=trail_id).scalar() or 0
 
@@ -586,19 +801,23 @@ def add_location_point_to_trail(trail_id, location_point_id):
         Order_no=order_no,
     )
     db.session.add(new_trail_location_pt)
-    db.session.commit()
+    invalidate("trail", trail.TrailID)
+    commit_changes()
 
-    return location_point_schema.dump(location_point), 201
+    return location_point_schema.dump(location_point), 201, etag_header(trail.Version)
 
+@retry_on_conflict
 def delete_location_point_from_trail(trail_id, location_point_id):
     user = require_auth_and_role("admin")  
     if not user:
         abort(403, "Unable to authenticate user.")
 
-    # Check if the trail exists
+    # Check if the trail exists, and take its version before reading the order numbers
     trail = Trail.query.filter(Trail.TrailID == trail_id).one_or_none()
     if not trail:
         abort(404, f"Trail with ID {trail_id} not found.")
+    check_if_match(trail)
+    lock_trail(trail)
 
     # Fetch the location point relationship
     trail_location_pt = TrailLocationPt.query.filter_by(
@@ -619,16 +838,26 @@ def delete_location_point_from_trail(trail_id, location_point_id):
     remaining_points = TrailLocationPt.query.filter_by(TrailID=trail_id).order_by(TrailLocationPt.Order_no).all()
     for index, point in enumerate(remaining_points):
         point.Order_no = index + 1
+    invalidate("trail", trail.TrailID)
 
-    db.session.commit()
+    commit_changes()
 
-    return make_response(f"Location point with ID {location_point_id} successfully removed from trail {trail_id}", 200)
+    return make_response(f"Location point with ID {location_point_id} successfully removed from trail {trail_id}", 200, etag_header(trail.Version))
 
+@read_only
+@serve_stale
+@coalesce
 def get_features_for_trail(trail_id):
     user = require_auth()
     if not user:
         abort(401, "Authentication required.")
 
+    if use_read_model():
+        features = read_model.current().trail_features(trail_id)
+        if features is None:
+            abort(404, f"Trail with ID {trail_id} not found.")
+        return features, 200
+
     # Check if the trail exists
     trail = Trail.query.filter(Trail.TrailID == trail_id).one_or_none()
     if not trail:
@@ -642,6 +871,8 @@ def get_features_for_trail(trail_id):
     # Return the features as JSON
     return [{"FeatureID": feature.Trail_FeatureID, "Feature": feature.Trail_Feature} for feature in features], 200
 
+@retry_on_conflict
+@idempotent
 def add_feature_to_trail(trail_id, feature_id):
     user = require_auth_and_role("admin")  
     if not user:
@@ -651,6 +882,7 @@ def add_feature_to_trail(trail_id, feature_id):
     trail = Trail.query.filter(Trail.TrailID == trail_id).one_or_none()
     if not trail:
         abort(404, f"Trail with ID {trail_id} not found.")
+    check_if_match(trail)
 
     # Check if the feature exists
     feature = Feature.query.filter(Feature.Trail_FeatureID == feature_id).one_or_none()
@@ -670,12 +902,16 @@ def add_feature_to_trail(trail_id, feature_id):
         Trail_FeatureID=feature_id
     )
     db.session.add(new_trail_feature)
-    db.session.commit()
+    facets.feature_linked(feature_id)
+    trail.timestamp = london_now()
+    invalidate("trail", trail.TrailID)
+    commit_changes()
 
     return make_response(
-        f"Feature '{feature.Trail_Feature}' successfully added to trail {trail.Trail_name}", 201
+        f"Feature '{feature.Trail_Feature}' successfully added to trail {trail.Trail_name}", 201, etag_header(trail.Version)
     )
 
+@idempotent
 def add_new_feature():
     user = require_auth_and_role("admin")  
     if not user:
@@ -692,7 +928,9 @@ def add_new_feature():
 
     new_feature = Feature(Trail_Feature=feature_name)
     db.session.add(new_feature)
-    db.session.commit()
+    db.session.flush()
+    invalidate("feature", new_feature.Trail_FeatureID)
+    commit_changes()
 
     return feature_schema.dump(new_feature), 201
 
@@ -719,10 +957,12 @@ def update_feature(feature_id):
 
     # Update the feature
     feature.Trail_Feature = new_feature_name
-    db.session.commit()
+    invalidate("feature", feature.Trail_FeatureID)
+    commit_changes()
 
     return make_response(f"Feature successfully updated to '{new_feature_name}'", 200)
 
+@retry_on_conflict
 def delete_feature_from_trail(trail_id, feature_id):
     user = require_auth_and_role("admin")  
     if not user:
@@ -732,6 +972,7 @@ def delete_feature_from_trail(trail_id, feature_id):
     trail = Trail.query.filter(Trail.TrailID == trail_id).one_or_none()
     if not trail:
         abort(404, f"Trail with ID {trail_id} not found.")
+    check_if_match(trail)
 
     # Check if the feature exists
     feature = Feature.query.filter(Feature.Trail_FeatureID == feature_id).one_or_none()
@@ -747,9 +988,12 @@ def delete_feature_from_trail(trail_id, feature_id):
 
     # Remove the association without deleting the feature
     db.session.delete(trail_feature)
-    db.session.commit()
+    facets.feature_unlinked(feature_id)
+    trail.timestamp = london_now()
+    invalidate("trail", trail.TrailID)
+    commit_changes()
 
-    return make_response(f"Feature '{feature.Trail_Feature}' successfully removed from trail {trail.Trail_name}", 200)
+    return make_response(f"Feature '{feature.Trail_Feature}' successfully removed from trail {trail.Trail_name}", 200, etag_header(trail.Version))
 
 def calculate_distance(lat1, lon1, lat2, lon2):
     R = 6371.0  # Earth radius in kilometers
@@ -760,4 +1004,13 @@ def calculate_distance(lat1, lon1, lat2, lon2):
     a = sin(dlat / 2)**2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon / 2)**2
     c = 2 * atan2(sqrt(a), sqrt(1 - a))
 
-    return R * c
\ No newline at end of file
+    return R * c
+
+def check_coordinates(latitude, longitude):
+    # coordinate_key needs numbers in range; a longitude past 180 would spill into the
+    # latitude part of the key and collide with another point's
+    for value in (latitude, longitude):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            abort(400, f"Location point ({latitude!r}, {longitude!r}) must have numeric Latitude and Longitude.")
+    if not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+        abort(400, f"Location point ({latitude}, {longitude}) is out of range.")
@@ -0,0 +1,17 @@
+from flask import g
+from config import db
+from routing import record_write
+from invalidation import publish_pending
+
+def commit_changes():
+    # Inside a batch every handler shares one transaction, so only flush here
+    # and let the batch commit (or roll back) once at the end
+    if g.get("defer_commit"):
+        db.session.flush()
+        return
+
+    db.session.commit()
+    record_write()
+
+    # Tell every worker to drop cached copies of what this transaction changed
+    publish_pending()
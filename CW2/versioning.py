@@ -0,0 +1,64 @@
+from functools import wraps
+from flask import abort, g, request
+from sqlalchemy.orm.exc import StaleDataError
+from config import db
+from models import london_now
+from invalidation import discard_pending
+import metrics
+
+# How many more times a write without If-Match runs when another write to the same
+# trail commits between its read and its own update
+MAX_VERSION_RETRIES = 3
+
+def etag_header(version):
+    # A trail's ETag is its version
+    return {"ETag": f'"{version}"'}
+
+def trail_etag_headers(trails):
+    # A location point can be on several trails, so moving it sends every trail's
+    # version in Trail-ETags, and the ETag as well when there is only one
+    if not trails:
+        return {}
+    headers = {"Trail-ETags": ", ".join(f'{trail.TrailID}="{trail.Version}"' for trail in trails)}
+    if len(trails) == 1:
+        headers.update(etag_header(trails[0].Version))
+    return headers
+
+def check_if_match(trail):
+    # With If-Match the write only applies to the version of the trail the client saw.
+    # The comparison is weak because a compressed response weakens the ETag it sends.
+    if request.if_match and not request.if_match.contains_weak(str(trail.Version)):
+        abort(412, f"Trail {trail.TrailID} has changed; it is now at version {trail.Version}.")
+
+def lock_trail(trail):
+    # Bumps the version before anything else is written. The update is conditional on
+    # the version just read, and holds the trail's row lock for the rest of the
+    # transaction, so writers to one trail read its points one after another.
+    trail.timestamp = london_now()
+    db.session.flush()
+
+def retry_on_conflict(handler):
+    # Trail has a version_id_col, so an update or delete of a trail that another
+    # transaction has changed since it was read matches no row and raises
+    # StaleDataError. Without If-Match the handler runs again on a fresh read, since
+    # a relative edit like a reorder is still valid; with If-Match the client's
+    # precondition has failed. Goes above @idempotent.
+    @wraps(handler)
+    def wrapper(*args, **kwargs):
+        for attempt in range(MAX_VERSION_RETRIES + 1):
+            try:
+                return handler(*args, **kwargs)
+            except StaleDataError:
+                metrics.increment("versioning.conflict")
+                # A batch cannot retry part of its transaction; it rolls back as a whole
+                if g.get("defer_commit"):
+                    abort(409, "The trail was changed by another request; retry the batch.")
+                db.session.rollback()
+                discard_pending()
+                if request.if_match:
+                    abort(412, "The trail was changed by another request since the version in If-Match.")
+                print(f"DEBUG: Version conflict in {handler.__name__}, attempt {attempt + 1}.")
+
+        abort(409, f"The trail kept changing; gave up after {MAX_VERSION_RETRIES + 1} attempts.")
+
+    return wrapper